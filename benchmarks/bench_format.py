@@ -0,0 +1,52 @@
+"""Microbenchmarks for cliphandler.Format.
+
+Measures how fast Formats can be made and compared, next to the raw name
+lookup that interning saves for registered formats. On Windows that lookup is
+a GetClipboardFormatName call; elsewhere it runs against a MemoryBackend,
+where it's only a dict lookup and so understates the saving.
+
+Run from the repository root:
+    python -m benchmarks.bench_format
+"""
+
+import timeit
+
+import cliphandler as ch
+import clipbackend
+
+
+def rate(statement, number=200000, **names):
+    """Operations per second for statement, best of three runs."""
+    seconds = min(timeit.repeat(statement, globals=names, number=number, repeat=3))
+    return number / seconds
+
+
+def main():
+    if clipbackend.wc is not None:
+        backend = clipbackend.Win32Backend()
+    else:
+        backend = clipbackend.MemoryBackend()
+    html_id = backend.register_format("HTML Format")
+    print(f"name lookups on {type(backend).__name__}")
+    text = ch.Format(13)
+    html = ch.Format(html_id, backend)
+    formats = [ch.Format(x) for x in (1, 2, 8, 17, 13)]
+    lookup = {x: x.name for x in formats}
+    results = [
+        ("Format(13)", rate("Format(13)", Format=ch.Format)),
+        ("Format(registered)", rate("Format(html_id, backend)", Format=ch.Format,
+                                    html_id=html_id, backend=backend)),
+        ("name lookup, uncached", rate("translate(html_id, backend)",
+                                       translate=ch.Format.translate_format,
+                                       html_id=html_id, backend=backend)),
+        ("Format == Format", rate("text == html", text=text, html=html)),
+        ("Format == int", rate("text == 13", text=text)),
+        ("int in [Format]", rate("13 in formats", formats=formats)),
+        ("dict[int] lookup", rate("lookup[13]", lookup=lookup)),
+    ]
+    for name, ops in results:
+        print(f"{name:24} {ops / 1e6:8.2f} M ops/s")
+
+
+if __name__ == '__main__':
+    main()
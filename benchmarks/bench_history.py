@@ -0,0 +1,68 @@
+"""Cold start benchmark for cliphistory.HistoryStore.
+
+Writes a history of 50k three-format clips (unicode text, CF_TEXT bytes and
+HTML) to a temporary directory, then times reopening it: reading the index and
+the previews of the most recent clips, as the app does on startup. The target
+is 250 ms. Also reports the append rate and how long loading one old clip
+takes once the history is open.
+
+Run from the repository root:
+    python -m benchmarks.bench_history
+"""
+
+import time
+import tempfile
+
+import cliphandler as ch
+import clipbackend
+import cliphistory
+
+COLD_START_TARGET = 0.25
+
+
+def write_history(path, backend, clips):
+    html = ch.Format(49443, backend)
+    start = time.perf_counter()
+    with cliphistory.HistoryStore(path, backend=backend) as store:
+        for i in range(clips):
+            text = f"copied text {i} " * 8
+            store.append(ch.Clip([
+                ch.Datum(text, 13),
+                ch.Datum(text.encode(), 1),
+                ch.Datum(f"<b>{text}</b>".encode(), html),
+            ], seq_num=i))
+    return clips / (time.perf_counter() - start)
+
+
+def cold_start(path, backend, runs=5):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        store = cliphistory.HistoryStore(path, backend=backend)
+        times.append(time.perf_counter() - start)
+        store.close()
+    return min(times)
+
+
+def load_old(path, backend, loads=1000):
+    with cliphistory.HistoryStore(path, backend=backend) as store:
+        start = time.perf_counter()
+        for i in range(loads):
+            store.load(i * 37 % len(store)).find(13).data
+        return (time.perf_counter() - start) / loads
+
+
+def main(clips=50000):
+    backend = clipbackend.MemoryBackend({49443: "HTML Format"})
+    with tempfile.TemporaryDirectory() as path:
+        rate = write_history(path, backend, clips)
+        print(f"append     {rate:10.0f} clips/s")
+        seconds = cold_start(path, backend)
+        verdict = "ok" if seconds <= COLD_START_TARGET else "OVER TARGET"
+        print(f"cold start {seconds * 1000:10.2f} ms for {clips} clips "
+              f"(target {COLD_START_TARGET * 1000:.0f} ms: {verdict})")
+        print(f"load old   {load_old(path, backend) * 1e6:10.2f} us per clip")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Image encoding benchmark for Datum.
+
+Encodes a 1920x1080 screenshot-sized image with each of Datum.IMAGE_CODECS
+and reports:
+- encode throughput: megapixels per second encoding one image at a time, and
+    the size of the result
+- pool throughput: megapixels per second with a batch of images submitted to
+    Datum.image_pool at once
+- caller stall: how long making a Datum from the image blocks the calling
+    thread, with the pool and with image_pool = None
+
+Run from the repository root:
+    python -m benchmarks.bench_image
+"""
+
+import sys
+import time
+
+from PySide2 import QtGui
+
+import cliphandler as ch
+
+
+def screenshot(width=1920, height=1080):
+    """Something with the flat areas, gradients and edges of a real desktop."""
+    image = QtGui.QImage(width, height, QtGui.QImage.Format_ARGB32)
+    image.fill(QtGui.QColor(240, 240, 240))
+    painter = QtGui.QPainter(image)
+    gradient = QtGui.QLinearGradient(0, 0, width, height)
+    gradient.setColorAt(0, QtGui.QColor(30, 60, 120))
+    gradient.setColorAt(1, QtGui.QColor(200, 120, 40))
+    painter.fillRect(0, 0, width, height // 3, gradient)
+    for x in range(0, width, 9):
+        painter.setPen(QtGui.QColor(x % 255, 80, 160))
+        painter.drawLine(x, height // 3, width - x, height)
+    painter.end()
+    return image
+
+
+def megapixels(image):
+    return image.width() * image.height() / 1e6
+
+
+def serial(image, codec, runs=5):
+    """Megapixels per second encoding on the calling thread, and bytes out."""
+    start = time.perf_counter()
+    for _ in range(runs):
+        datum = ch.Datum.from_image(image, codec).materialize()
+    seconds = (time.perf_counter() - start) / runs
+    return megapixels(image) / seconds, len(datum.data)
+
+
+def pooled(image, codec, images=8):
+    start = time.perf_counter()
+    datums = [ch.Datum.from_image(image, codec) for _ in range(images)]
+    for datum in datums:
+        datum.materialize()
+    return megapixels(image) * images / (time.perf_counter() - start)
+
+
+def caller_stall(image, codec, runs=5):
+    start = time.perf_counter()
+    datums = [ch.Datum.from_image(image, codec) for _ in range(runs)]
+    seconds = (time.perf_counter() - start) / runs
+    for datum in datums:
+        datum.materialize()
+    return seconds
+
+
+def main():
+    app = QtGui.QGuiApplication.instance() or QtGui.QGuiApplication(sys.argv)
+    image = screenshot()
+    workers = ch.Datum.image_pool._max_workers
+    for codec in ch.Datum.IMAGE_CODECS:
+        ch.Datum.image_pool = None
+        rate, size = serial(image, codec)
+        blocking = caller_stall(image, codec)
+        ch.Datum.image_pool = ch.image_pool
+        pool_rate = pooled(image, codec)
+        stall = caller_stall(image, codec)
+        print(f"{codec:9} {rate:7.1f} MP/s serial  {pool_rate:7.1f} MP/s on "
+              f"{workers} workers  {size / 1024:8.0f} KiB  caller stall "
+              f"{blocking * 1000:7.2f} ms -> {stall * 1000:5.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Memory benchmark for clip history.
+
+Builds a history of 100k three-format clips (unicode text, CF_TEXT bytes and
+HTML) and reports how many bytes each clip costs on top of its payloads. The
+payloads are made before tracing starts, so only Clip, Datum and Format
+overhead is counted.
+
+Run from the repository root:
+    python -m benchmarks.bench_memory
+"""
+
+import gc
+import tracemalloc
+
+import cliphandler as ch
+import clipbackend
+
+
+def build_history(payloads, html):
+    history = []
+    for text, text_bytes, html_bytes in payloads:
+        history.append(ch.Clip([
+            ch.Datum(text, 13),
+            ch.Datum(text_bytes, 1),
+            ch.Datum(html_bytes, html),
+        ]))
+    return history
+
+
+def bytes_per_clip(clips=100000):
+    backend = clipbackend.MemoryBackend({49443: "HTML Format"})
+    html = ch.Format(49443, backend)
+    payloads = [(f"copied text {i}", f"copied text {i}".encode(),
+                 f"<b>copied text {i}</b>".encode()) for i in range(clips)]
+    gc.collect()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    history = build_history(payloads, html)
+    gc.collect()
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(history) == clips
+    return (end - start) / clips
+
+
+def main():
+    print(f"{bytes_per_clip():8.1f} bytes per clip, excluding payloads")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Benchmarks for the cliphandler data model and capture loop.
+
+Everything runs against a clipbackend.MemoryBackend:
+- Format: construction of standard and registered formats, and comparison
+- Datum: making Datums from text, bytes and a QImage, and pickling them
+- Clip: add_data, find, +, == (with and without content digests known) and
+    slicing on clips of 10 and 1000 formats, and building a clip up a Datum
+    at a time with +
+- Monitor: capturing a change by calling check_clipboard directly, and end to
+    end with Monitor on its own thread, from the copy to new_card_from_clipboard
+
+cases() is what benchmarks.suite runs; main() prints the same numbers.
+
+Run from the repository root:
+    python -m benchmarks.bench_model
+"""
+
+import sys
+import pickle
+import timeit
+
+from PySide2 import QtGui
+
+import cliphandler as ch
+import clipbackend
+from benchmarks.bench_monitor import Harness
+
+
+def make_backend(formats=2000):
+    """A MemoryBackend that knows Windows' id for PNG, and names for formats
+    1000 and up, which the Clip cases use to get clips with lots of formats."""
+    names = {1000 + i: f"Format {i}" for i in range(formats)}
+    names[ch.Datum.IMAGE_CODECS["png"][1]] = "PNG"
+    return clipbackend.MemoryBackend(names)
+
+
+def format_cases(backend):
+    html_id = backend.register_format("HTML Format")
+    text = ch.Format(13)
+    html = ch.Format(html_id, backend)
+    return [
+        ("format.standard", lambda: ch.Format(13), 100000),
+        ("format.registered", lambda: ch.Format(html_id, backend), 100000),
+        ("format.eq_format", lambda: text == html, 100000),
+        ("format.eq_int", lambda: text == 13, 100000),
+    ]
+
+
+def image(width=256, height=256):
+    image = QtGui.QImage(width, height, QtGui.QImage.Format_ARGB32)
+    image.fill(QtGui.QColor(40, 90, 160))
+    painter = QtGui.QPainter(image)
+    for x in range(0, width, 7):
+        painter.setPen(QtGui.QColor(x % 255, 200, 80))
+        painter.drawLine(x, 0, width - x, height)
+    painter.end()
+    return image
+
+
+def datum_image(picture):
+    # encode on this thread, so the case measures the encode and not the pool
+    pool, ch.Datum.image_pool = ch.Datum.image_pool, None
+    try:
+        return ch.Datum(picture)
+    finally:
+        ch.Datum.image_pool = pool
+
+
+def datum_cases(backend):
+    text = "some copied text, " * 20
+    payload = bytes(range(256)) * 64
+    html = ch.Format(backend.register_format("HTML Format"), backend)
+    picture = image()
+    pickled_text = pickle.dumps(ch.Datum(text))
+    pickled_bytes = pickle.dumps(ch.Datum(payload, html))
+    return [
+        ("datum.text", lambda: ch.Datum(text), 20000),
+        ("datum.bytes", lambda: ch.Datum(payload, html), 20000),
+        ("datum.qimage_png", lambda: datum_image(picture), 20),
+        ("datum.pickle_text", lambda: pickle.loads(pickle.dumps(ch.Datum(text))), 10000),
+        ("datum.unpickle_text", lambda: pickle.loads(pickled_text), 10000),
+        ("datum.unpickle_bytes", lambda: pickle.loads(pickled_bytes), 10000),
+    ]
+
+
+def make_clip(backend, size, tag="", seq_num=None):
+    return ch.Clip([ch.Datum(f"{tag} {i}", ch.Format(1000 + i, backend))
+                    for i in range(size)], seq_num)
+
+
+def clip_cases(backend, size):
+    datums = list(make_clip(backend, size, "payload"))
+    clip = make_clip(backend, size)
+    # equal all the way to the last Datum
+    same = make_clip(backend, size, seq_num=clip.seq_num)
+    other = make_clip(backend, size, "other")
+    # as in a dict or set, which has the digests worked out already
+    digested = make_clip(backend, size, seq_num=clip.seq_num)
+    digested_same = make_clip(backend, size, seq_num=clip.seq_num)
+    hash(digested), hash(digested_same)
+    wanted = [1000 + size * 2, 1000 + size - 1]
+    number = max(10, 20000 // size)
+    return [
+        (f"clip.add_data[{size}]", lambda: ch.Clip(datums), number),
+        (f"clip.find[{size}]", lambda: clip.find(wanted), number * 10),
+        (f"clip.add[{size}]", lambda: clip + other, number),
+        (f"clip.eq[{size}]", lambda: clip == same, number),
+        (f"clip.eq_digested[{size}]", lambda: digested == digested_same, number * 10),
+        (f"clip.slice[{size}]", lambda: clip[size // 4:size // 2], number * 10),
+        (f"clip.sum[{size}]", lambda: sum(datums, ch.Clip()), max(1, number // 20)),
+    ]
+
+
+def monitor_cases():
+    backend = clipbackend.MemoryBackend()
+    monitor = ch.Monitor(handler=ch.Handler(backend), coalesce=0)
+    copies = iter(range(10 ** 9))
+
+    def capture():
+        backend.copy({13: f"copy {next(copies)}", 1: b"copy"})
+        monitor.check_clipboard()
+
+    return [("monitor.capture", capture, 2000)]
+
+
+def threaded_capture(copies=200):
+    """Seconds per copy from setting the clipboard to Monitor's signal, with
+    Monitor on its own thread and notified of changes."""
+    with Harness(notified=True, coalesce=0) as harness:
+        # until Monitor has started on its thread, only the fallback poll
+        # would catch a copy, so wait for one before timing
+        start = None
+        for i in range(copies + 1):
+            harness.timeout.start(2000)
+            harness.backend.copy({13: f"copy {i}"})
+            harness.loop.exec_()
+            if start is None:
+                start = timeit.default_timer()
+        seconds = timeit.default_timer() - start
+        harness.timeout.stop()
+        if harness.cards != copies + 1:
+            raise RuntimeError(f"Monitor caught {harness.cards} of {copies + 1} copies")
+    return seconds / copies
+
+
+def cases():
+    """(name, function, calls per run) for every case timed by repetition."""
+    backend = make_backend()
+    # unpickled Datums look their formats up on the default backend
+    clipbackend.set_default(backend)
+    return (format_cases(backend) + datum_cases(backend) + clip_cases(backend, 10) +
+            clip_cases(backend, 1000) + monitor_cases())
+
+
+def app():
+    """The application that QImage painting and Monitor's thread need."""
+    return QtGui.QGuiApplication.instance() or QtGui.QGuiApplication(sys.argv)
+
+
+def main():
+    application = app()
+    for name, function, number in cases():
+        seconds = min(timeit.repeat(function, number=number, repeat=3)) / number
+        print(f"{name:24} {1 / seconds:14.1f} ops/s")
+    print(f"{'monitor.capture_threaded':24} {1 / threaded_capture():14.1f} ops/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Benchmarks for cliphandler.Monitor's capture loop.
+
+Runs Monitor against a clipbackend.MemoryBackend and compares adaptive
+polling with notification-driven capture:
+- idle CPU: process CPU time burned per second of wall time while nothing is
+    being copied
+- idle wakeups: sequence number checks per second while nothing is being copied
+- change-to-signal latency: time from a fake application setting the
+    clipboard to Monitor emitting new_card_from_clipboard, with coalescing off
+- bursts: a fake application emptying the clipboard, then setting text, then
+    text and HTML, a few ms apart; reports cards emitted per burst, the
+    clipboard states a burst went through that were never read, and how long
+    coalescing held reads back, with and without a coalescing window
+
+Run from the repository root:
+    python -m benchmarks.bench_monitor
+"""
+
+import sys
+import time
+import statistics
+
+from PySide2 import QtCore
+
+import cliphandler as ch
+import clipbackend
+
+
+class CountingBackend(clipbackend.MemoryBackend):
+    """Counts sequence number checks, so idle wakeups can be measured."""
+    def __init__(self):
+        super().__init__()
+        self.peeks = 0
+
+    def seq(self):
+        self.peeks += 1
+        return super().seq()
+
+
+class Harness(QtCore.QObject):
+    """Owns a Monitor on its own thread, the way the app runs it."""
+    start_monitor = QtCore.Signal()
+    stop_monitor = QtCore.Signal()
+
+    def __init__(self, notified, coalesce=ch.Monitor.COALESCE_WINDOW):
+        super().__init__()
+        self.backend = CountingBackend()
+        self.handler = ch.Handler(self.backend)
+        # None takes the backend's notifier; False polls
+        self.monitor = ch.Monitor(notifier=None if notified else False,
+                                  handler=self.handler, coalesce=coalesce)
+        self.thread = QtCore.QThread()
+        self.monitor.moveToThread(self.thread)
+        self.start_monitor.connect(self.monitor.begin)
+        self.stop_monitor.connect(self.monitor.end)
+        self.monitor.new_card_from_clipboard.connect(self.on_new_card)
+        self.loop = QtCore.QEventLoop()
+        self.timeout = QtCore.QTimer()
+        self.timeout.setSingleShot(True)
+        self.timeout.timeout.connect(self.loop.quit)
+        self.last_card = None
+        self.cards = 0
+        self.quit_on_card = True
+
+    def on_new_card(self, clip):
+        self.last_card = time.perf_counter()
+        self.cards += 1
+        if self.quit_on_card:
+            self.loop.quit()
+
+    def __enter__(self):
+        self.thread.start()
+        self.start_monitor.emit()
+        return self
+
+    def __exit__(self, *args):
+        self.stop_monitor.emit()
+        time.sleep(0.05)
+        self.thread.quit()
+        self.thread.wait()
+
+
+def idle_cost(notified, seconds=2.0):
+    """Fraction of one core the process uses, and sequence checks per second,
+    while the clipboard is idle."""
+    with Harness(notified) as harness:
+        # long enough for the poll to back off to its ceiling
+        time.sleep(1.0)
+        peeks_start = harness.backend.peeks
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        time.sleep(seconds)
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        peeks = harness.backend.peeks - peeks_start
+    return cpu / wall, peeks / wall
+
+
+def change_latency(notified, copies=200):
+    """Seconds from a clipboard change to new_card_from_clipboard."""
+    latencies = []
+    with Harness(notified, coalesce=0) as harness:
+        for i in range(copies):
+            harness.last_card = None
+            harness.timeout.start(2000)
+            start = time.perf_counter()
+            harness.backend.copy({13: f"copy {i}"})
+            harness.loop.exec_()
+            harness.timeout.stop()
+            if harness.last_card is None:
+                raise RuntimeError(f"Monitor missed copy {i}")
+            latencies.append(harness.last_card - start)
+            # let the Monitor settle back into its idle schedule
+            time.sleep(0.01)
+    return latencies
+
+
+def bursts(notified, coalesce, count=20, gap=0.003):
+    """Cards per burst, and the Monitor's coalescing stats."""
+    with Harness(notified, coalesce) as harness:
+        harness.quit_on_card = False
+        for i in range(count):
+            harness.backend.copy({})
+            time.sleep(gap)
+            harness.backend.copy({13: f"burst {i}"})
+            time.sleep(gap)
+            harness.backend.copy({13: f"burst {i}", 1: f"burst {i}".encode()})
+            # let the Monitor see it all, then settle
+            harness.timeout.start(ch.Monitor.COALESCE_LIMIT + 100)
+            harness.loop.exec_()
+        stats = dict(harness.monitor.coalesce_stats)
+    return harness.cards / count, stats
+
+
+def report_bursts(name, notified):
+    for coalesce in (0, ch.Monitor.COALESCE_WINDOW):
+        cards, stats = bursts(notified, coalesce)
+        reads = max(stats["reads"], 1)
+        print(f"{name:8} coalesce {coalesce:3} ms: {cards:4.2f} cards/burst  "
+              f"{stats['states_skipped'] / reads:4.2f} states skipped/read  held "
+              f"{stats['held_ms'] / reads:6.2f} ms avg, {stats['max_held_ms']:6.2f} ms max")
+
+
+def report(name, notified):
+    cpu, wakeups = idle_cost(notified)
+    latencies = sorted(change_latency(notified))
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:8} idle cpu {cpu * 100:6.1f}%  wakeups {wakeups:6.1f}/s  "
+          f"latency median {statistics.median(latencies) * 1000:6.2f} ms  "
+          f"p99 {p99 * 1000:6.2f} ms")
+
+
+def main():
+    app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication(sys.argv)
+    report("polling", notified=False)
+    report("notified", notified=True)
+    report_bursts("polling", notified=False)
+    report_bursts("notified", notified=True)
+
+
+if __name__ == '__main__':
+    main()
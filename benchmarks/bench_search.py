@@ -0,0 +1,111 @@
+"""Benchmark for clipsearch.SearchIndex.
+
+Indexes 100k synthetic text clips (8-40 words each, drawn from a 20k word
+vocabulary with a Zipf-like skew) and reports:
+- build time: adding every clip, one at a time, the way captures arrive
+- index memory: tracemalloc growth while building, excluding the source text
+- query latency: median and p99 over queries typed a character at a time, in
+    substring and prefix mode, next to a linear scan over the same text
+
+Run from the repository root:
+    python -m benchmarks.bench_search
+"""
+
+import time
+import random
+import statistics
+import tracemalloc
+
+import clipsearch
+
+
+def make_corpus(clips, seed=1):
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocabulary = ["".join(rng.choice(letters) for _ in range(rng.randint(2, 10)))
+                  for _ in range(20000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    return [" ".join(rng.choices(vocabulary, weights, k=rng.randint(8, 40)))
+            for _ in range(clips)]
+
+
+def make_queries(corpus, count=200, seed=2):
+    """Every prefix of one or two words taken from random clips, as typed."""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        words = rng.choice(corpus).split()
+        start = rng.randrange(len(words) - 1)
+        phrase = " ".join(words[start:start + rng.randint(1, 2)])
+        queries.extend(phrase[:end] for end in range(1, len(phrase) + 1))
+    return queries
+
+
+def build(corpus):
+    index = clipsearch.SearchIndex()
+    for key, text in enumerate(corpus):
+        index.add_text(key, text)
+    return index
+
+
+def build_time(corpus):
+    start = time.perf_counter()
+    index = build(corpus)
+    return index, time.perf_counter() - start
+
+
+def build_memory(corpus):
+    """Measured on a separate build, as tracing slows building down."""
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    index = build(corpus)
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(index) == len(corpus)
+    return end - start
+
+
+def latencies(search, queries):
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def linear_scan(corpus, limit=50):
+    def search(query):
+        words = query.casefold().split()
+        results = []
+        for key in range(len(corpus) - 1, -1, -1):
+            text = corpus[key].casefold()
+            if all(word in text for word in words):
+                results.append(key)
+                if len(results) == limit:
+                    break
+        return results
+    return search
+
+
+def report(name, times):
+    p99 = times[int(len(times) * 0.99) - 1]
+    print(f"{name:10} median {statistics.median(times) * 1000:8.3f} ms  "
+          f"p99 {p99 * 1000:8.3f} ms  ({len(times)} queries)")
+
+
+def main(clips=100000):
+    corpus = make_corpus(clips)
+    queries = make_queries(corpus)
+    memory = build_memory(corpus)
+    index, seconds = build_time(corpus)
+    print(f"build      {seconds:8.2f} s for {clips} clips "
+          f"({clips / seconds:.0f} clips/s)")
+    print(f"memory     {memory / 2 ** 20:8.1f} MiB ({memory / clips:.0f} bytes per clip)")
+    report("substring", latencies(index.search, queries))
+    report("prefix", latencies(lambda query: index.search(query, prefix=True), queries))
+    report("linear", latencies(linear_scan(corpus), queries[:len(queries) // 10]))
+
+
+if __name__ == '__main__':
+    main()
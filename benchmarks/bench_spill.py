@@ -0,0 +1,67 @@
+"""Memory benchmark for reading very large clipboard payloads.
+
+Reads a text payload of a few hundred MB, once into memory and once spilled
+to a memory-mapped file (Handler.spill_threshold), and reports the time
+taken and the peak memory Python allocated for the read.
+
+MemoryBackend hands back the very object it holds, which would make the
+in-memory read look free, so this runs on a backend that keeps the payload
+as raw UTF-16 and decodes a fresh str for every read, the way win32clipboard
+does.
+
+Run from the repository root:
+    python -m benchmarks.bench_spill
+"""
+
+import time
+import tracemalloc
+
+import cliphandler as ch
+import clipbackend
+
+
+class RawBackend(clipbackend.MemoryBackend):
+    """Holds text as the clipboard does, and copies it out on every read."""
+    def get_data(self, format_id):
+        data = super().get_data(format_id)
+        if format_id == 13:
+            return data.decode("utf-16-le")
+        return bytes(data)
+
+    def data_size(self, format_id):
+        return len(super().get_data(format_id))
+
+    def read_chunks(self, format_id, chunk_size):
+        view = memoryview(super().get_data(format_id))
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+
+
+def read(backend, spill_threshold):
+    """Seconds and peak bytes allocated to read the clipboard, keeping the
+    result until both are measured."""
+    handler = ch.Handler(backend, spill_threshold=spill_threshold)
+    tracemalloc.start()
+    start = time.perf_counter()
+    with handler:
+        clip = handler.read(lazy=False)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert len(clip) == 1
+    return seconds, peak
+
+
+def main(megabytes=256):
+    backend = RawBackend()
+    text = ("a large selection of text " * (megabytes * 1024 * 1024 // 52)).encode("utf-16-le")
+    backend.copy({13: bytearray(text)})
+    print(f"{len(text) / 2 ** 20:.0f} MiB of UTF-16 text")
+    del text
+    for name, threshold in (("in memory", None), ("spilled", 64 * 1024 * 1024)):
+        seconds, peak = read(backend, threshold)
+        print(f"{name:10} {seconds * 1000:8.0f} ms  peak allocated {peak / 2 ** 20:8.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Throughput benchmark for clipboard access under concurrency.
+
+Runs against a clipbackend.MemoryBackend, with several threads at once:
+- seq checks: Monitor.check_seq calls per second, across all threads
+- round trips: Handler write-then-read cycles per second, across all threads
+- mixed: seq checks per second while one thread does round trips, and the
+    round trips per second it manages meanwhile
+
+Run from the repository root:
+    python -m benchmarks.bench_throughput
+"""
+
+import time
+import threading
+
+import cliphandler as ch
+import clipbackend
+
+
+def run_threads(targets, seconds):
+    """Run each target(stop) on its own thread for seconds; returns their
+    results."""
+    stop = threading.Event()
+    results = [None] * len(targets)
+
+    def runner(index, target):
+        results[index] = target(stop)
+
+    threads = [threading.Thread(target=runner, args=(i, target))
+               for i, target in enumerate(targets)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def seq_checker(backend):
+    monitor = ch.Monitor(handler=ch.Handler(backend))
+
+    def check(stop):
+        checks = 0
+        while not stop.is_set():
+            monitor.check_seq()
+            checks += 1
+        return checks
+    return check
+
+
+def round_tripper(backend, name):
+    handler = ch.Handler(backend)
+
+    def round_trip(stop):
+        trips = 0
+        while not stop.is_set():
+            with handler:
+                handler.write(ch.Clip(f"{name} {trips}"))
+                handler.read(lazy=False)
+            trips += 1
+        return trips
+    return round_trip
+
+
+def main(seconds=1.0):
+    for threads in (1, 4):
+        backend = clipbackend.MemoryBackend()
+        checks = sum(run_threads([seq_checker(backend) for _ in range(threads)], seconds))
+        trips = sum(run_threads([round_tripper(backend, i) for i in range(threads)], seconds))
+        mixed = run_threads([round_tripper(backend, "writer")] +
+                            [seq_checker(backend) for _ in range(threads)], seconds)
+        print(f"{threads} thread(s): seq checks {checks / seconds:10.0f}/s  "
+              f"round trips {trips / seconds:8.0f}/s  mixed: seq checks "
+              f"{sum(mixed[1:]) / seconds:10.0f}/s with {mixed[0] / seconds:6.0f} "
+              f"round trips/s")
+
+
+if __name__ == '__main__':
+    main()
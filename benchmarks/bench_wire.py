@@ -0,0 +1,85 @@
+"""Encode and decode throughput of clipwire messages against pickle.
+
+Three clips, all against a clipbackend.MemoryBackend:
+- copy: what copying a link from a browser puts on the clipboard, a few
+    short text and HTML formats
+- formats: 200 small formats, where the per-Datum overhead shows
+- image: text plus a 4 MB binary payload, where copying the payload shows
+
+Each is encoded and decoded with clipwire and with pickle. Decoding a
+message from bytes doesn't copy its binary payloads, so wire.decode should
+barely notice the image; "decode_mmap" decodes from a read-only mapping of
+a file, the way another process would pick a clip up.
+
+cases() is what benchmarks.suite runs; main() prints the same numbers, with
+the size of each encoding.
+
+Run from the repository root:
+    python -m benchmarks.bench_wire
+"""
+
+import mmap
+import pickle
+import timeit
+import tempfile
+
+import cliphandler as ch
+import clipbackend
+import clipwire
+from benchmarks.bench_model import make_backend
+
+
+def clips(backend):
+    html = ch.Format(backend.register_format("HTML Format"), backend)
+    link = "https://example.com/a/fairly/long/path?with=a&query=string"
+    copy = ch.Clip([link, ch.Datum(f'<a href="{link}">{link}</a>'.encode(), html),
+                    ch.Datum(link.encode(), 1)])
+    formats = ch.Clip([ch.Datum(f"format {i}".encode(), ch.Format(1000 + i, backend))
+                       for i in range(200)])
+    image = ch.Clip(["a screenshot", ch.Datum(bytes(range(256)) * 16384, 8)])
+    return {"copy": copy, "formats": formats, "image": image}
+
+
+def mapped(message):
+    """message in an anonymous file, mapped read-only."""
+    with tempfile.TemporaryFile() as file:
+        file.write(message)
+        file.flush()
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def cases():
+    """(name, function, calls per run) for every case."""
+    backend = make_backend()
+    # unpickled Datums look their formats up on the default backend
+    clipbackend.set_default(backend)
+    results = []
+    for name, clip in clips(backend).items():
+        message = clipwire.encode(clip)
+        pickled = pickle.dumps(clip)
+        mapping = mapped(message)
+        number = 20 if name == "image" else 2000 if name == "copy" else 100
+        results += [
+            (f"wire.encode[{name}]", lambda clip=clip: clipwire.encode(clip), number),
+            (f"wire.decode[{name}]",
+             lambda message=message: clipwire.decode(message, backend), number),
+            (f"wire.decode_mmap[{name}]",
+             lambda mapping=mapping: clipwire.decode(mapping, backend), number),
+            (f"pickle.dumps[{name}]", lambda clip=clip: pickle.dumps(clip), number),
+            (f"pickle.loads[{name}]", lambda pickled=pickled: pickle.loads(pickled), number),
+        ]
+    return results
+
+
+def main():
+    backend = make_backend()
+    for name, clip in clips(backend).items():
+        print(f"{name:8} wire {len(clipwire.encode(clip)):10} bytes   "
+              f"pickle {len(pickle.dumps(clip)):10} bytes")
+    for name, function, number in cases():
+        seconds = min(timeit.repeat(function, number=number, repeat=3)) / number
+        print(f"{name:28} {1 / seconds:14.1f} ops/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Write pipeline benchmark for Monitor.load.
+
+A modus paging through cards loads clips in quick succession while another
+application keeps grabbing the clipboard. Against a clipbackend.MemoryBackend
+held open by a competing thread for a few ms at a time, it reports:
+- caller time: how long each load blocks whoever asked for it, writing
+    straight through a Handler and through Monitor's WriteQueue
+- writes: how many clips actually reached the clipboard, and how many were
+    superseded before they got there
+- queue wait and write time percentiles from WriteQueue.stats()
+
+Run from the repository root:
+    python -m benchmarks.bench_writes
+"""
+
+import time
+import logging
+import threading
+
+import cliphandler as ch
+import clipbackend
+
+
+def competitor(backend, stop, hold=0.003, gap=0.002):
+    """Another application opening the clipboard over and over."""
+    while not stop.is_set():
+        try:
+            backend.open()
+        except clipbackend.AccessDenied:
+            time.sleep(gap)
+            continue
+        time.sleep(hold)
+        backend.close()
+        time.sleep(gap)
+
+
+def run(load, count, interval):
+    """Call load count times, interval seconds apart; returns the mean and
+    worst time a call took, in ms."""
+    stalls = []
+    for i in range(count):
+        start = time.perf_counter()
+        load(ch.Clip(f"card {i}"))
+        stalls.append(time.perf_counter() - start)
+        time.sleep(interval)
+    return sum(stalls) / count * 1000, max(stalls) * 1000
+
+
+def main(count=100, interval=0.001):
+    # every denied open is logged, which would swamp the results
+    logging.disable(logging.WARNING)
+    for queued in (False, True):
+        backend = clipbackend.MemoryBackend()
+        stop = threading.Event()
+        other = threading.Thread(target=competitor, args=(backend, stop))
+        other.start()
+        monitor = ch.Monitor(handler=ch.Handler(backend))
+        if queued:
+            load = monitor.load
+        else:
+            def load(clip):
+                with monitor.handler:
+                    monitor.handler.write(clip)
+        mean, worst = run(load, count, interval)
+        monitor.write_queue.flush()
+        stop.set()
+        other.join()
+        print(f"{'queued' if queued else 'direct'}: caller time {mean:7.3f} ms "
+              f"mean {worst:7.2f} ms worst")
+        if queued:
+            stats = monitor.write_queue.stats()
+            print(f"  {stats['written']} written, {stats['superseded']} superseded, "
+                  f"deepest queue {stats['max_depth']}")
+            for name in ("wait_us", "write_us"):
+                times = stats[name]
+                print(f"  {name[:-3]:5} p50 {times['p50'] / 1000:6.2f} ms  "
+                      f"p99 {times['p99'] / 1000:6.2f} ms  max {times['max'] / 1000:6.2f} ms")
+        monitor.write_queue.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Runs the benchmark suite and writes the results as JSON, so regressions
+can be tracked from one release to the next.
+
+The cases are the ones in benchmarks.bench_model and benchmarks.bench_wire,
+all against a clipbackend.MemoryBackend, so the suite runs anywhere PySide2
+does. Each result has the case's name, its operations per second (the best
+of --repeat runs), and seconds per operation; the file also records the
+Python, PySide2, platform and git commit the results came from.
+
+--compare prints every case's speed against an earlier results file, and
+exits with status 1 if any case got more than --tolerance slower.
+
+Run from the repository root:
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --compare results.json
+"""
+
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import subprocess
+
+import PySide2
+
+from benchmarks import bench_model, bench_wire
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result(name, seconds, number, repeat):
+    return {
+        "name": name,
+        "ops_per_sec": 1 / seconds,
+        "seconds_per_op": seconds,
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def run(selected=None, repeat=5, scale=1.0):
+    """Time every case whose name contains selected; returns the results,
+    fastest run of each."""
+    results = []
+    for name, function, number in bench_model.cases() + bench_wire.cases():
+        if selected and selected not in name:
+            continue
+        number = max(1, int(number * scale))
+        function()  # warm up caches and interning
+        seconds = min(timeit.repeat(function, number=number, repeat=repeat)) / number
+        results.append(result(name, seconds, number, repeat))
+    name = "monitor.capture_threaded"
+    if not selected or selected in name:
+        copies = max(10, int(200 * scale))
+        seconds = min(bench_model.threaded_capture(copies) for _ in range(repeat))
+        results.append(result(name, seconds, copies, repeat))
+    return results
+
+
+def report(results):
+    return {
+        "meta": {
+            "time": time.time(),
+            "commit": commit(),
+            "python": platform.python_version(),
+            "pyside2": PySide2.__version__,
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+
+def compare(old, new, tolerance):
+    """Print new against old; returns the names of cases that got slower than
+    tolerance allows."""
+    before = {entry["name"]: entry["ops_per_sec"] for entry in old["results"]}
+    slower = []
+    for entry in new["results"]:
+        name, ops = entry["name"], entry["ops_per_sec"]
+        if name not in before:
+            print(f"{name:28} {ops:14.1f} ops/s  (new)")
+            continue
+        change = ops / before[name] - 1
+        flag = ""
+        if change < -tolerance:
+            flag = "  SLOWER"
+            slower.append(name)
+        print(f"{name:28} {ops:14.1f} ops/s  {change * 100:+7.1f}%{flag}")
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the benchmark suite.")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against this results file")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction slower than --compare that counts as a "
+                             "regression (default 0.1)")
+    parser.add_argument("--filter", help="only run cases with this in their name")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--quick", action="store_true",
+                        help="a tenth of the work, for a smoke test")
+    args = parser.parse_args(argv)
+
+    app = bench_model.app()
+    results = report(run(args.filter, args.repeat, 0.1 if args.quick else 1.0))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=1)
+    if args.compare:
+        with open(args.compare) as file:
+            old = json.load(file)
+        if compare(old, results, args.tolerance):
+            return 1
+    elif not args.output:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,668 @@
+"""This module holds the clipboard backends that cliphandler.Handler talks to.
+
+A backend is the only thing that touches a real clipboard. Handler and Monitor
+deal in Clips and Formats and leave the platform calls to one of:
+- Win32Backend: the system clipboard through win32clipboard
+- QtBackend: the system clipboard through QClipboard, for non-Windows builds
+- MemoryBackend: a thread-safe in-process clipboard for tests and benchmarks
+
+Backend errors are raised as ClipboardError subclasses so callers don't need
+to know which library is underneath.
+
+signals emitted:
+seq_changed() (from ClipboardNotifier)
+"""
+
+import ctypes
+import functools
+import threading
+import logging
+
+from PySide2 import QtCore, QtGui
+from PySide2.QtCore import Signal
+
+try:
+    import win32clipboard as wc
+    import pywintypes
+except ImportError:  # not on Windows
+    wc = None
+    pywintypes = None
+
+
+class ClipboardError(Exception):
+    """Something went wrong talking to the clipboard. strerror carries the
+    platform message, like pywintypes.error does."""
+    def __init__(self, strerror):
+        super().__init__(strerror)
+        self.strerror = strerror
+
+
+class AccessDenied(ClipboardError):
+    """Someone else has the clipboard open."""
+
+
+class InvalidHandle(ClipboardError):
+    """The clipboard refused a format id or a piece of data."""
+
+
+class NotOpen(ClipboardError):
+    """The calling thread doesn't have the clipboard open."""
+
+
+class FormatUnavailable(ClipboardError, TypeError):
+    """The requested format isn't on the clipboard. Also a TypeError, since
+    that is what win32clipboard raises for it."""
+
+
+class ClipboardNotifier(QtCore.QObject):
+    """Pushes seq_changed whenever the clipboard contents change, so Monitor
+    can react to changes instead of spinning on the sequence number.
+
+    Anything that can tell when the clipboard moved can subclass this and emit
+    seq_changed; emitting from another thread is fine, Qt queues the signal
+    onto the Monitor's thread.
+    """
+    seq_changed = Signal()
+
+
+class QtNotifier(ClipboardNotifier):
+    """Relays QClipboard.dataChanged. On Windows Qt drives this from
+    WM_CLIPBOARDUPDATE, so it costs nothing while the clipboard is idle.
+
+    Has to be created after the QApplication, on the GUI thread.
+    """
+    def __init__(self, clipboard=None, parent=None):
+        super().__init__(parent)
+        if clipboard is None:
+            clipboard = QtGui.QGuiApplication.clipboard()
+        self.clipboard = clipboard
+        self.clipboard.dataChanged.connect(self.seq_changed)
+
+
+class Backend:
+    """The set of clipboard operations Handler needs. Formats are plain int
+    ids here; wrapping them in cliphandler types is Handler's job.
+
+    open/close bracket everything except seq, format_name and notifier, the
+    same way OpenClipboard/CloseClipboard do on Windows.
+    """
+    def open(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def empty(self):
+        raise NotImplementedError
+
+    def set_data(self, format_id, data):
+        raise NotImplementedError
+
+    def get_data(self, format_id):
+        """Returns the data for one format, or raises FormatUnavailable."""
+        raise NotImplementedError
+
+    def data_size(self, format_id):
+        """Returns the size in bytes of one format's payload as the clipboard
+        holds it, without reading it, or None if that can't be known."""
+        return None
+
+    def get_data_prefix(self, format_id, size):
+        """Returns at most size bytes of one format's payload. Text counts as
+        UTF-16, which is how the clipboard holds it. Payloads that aren't
+        text or bytes (a bitmap handle, CF_HDROP's tuple of paths) can't be
+        cut down and come back whole. Backends that can read part of a
+        payload should override this; the default reads all of it."""
+        data = self.get_data(format_id)
+        if isinstance(data, str):
+            return data[:size // 2]
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return data[:size]
+        return data
+
+    def read_chunks(self, format_id, chunk_size):
+        """Yields one format's payload as the clipboard holds it, chunk_size
+        bytes at a time; text comes as UTF-16, without its terminator.
+        Backends that can read the clipboard's memory in place should
+        override this; the default reads all of it first."""
+        data = self.get_data(format_id)
+        if isinstance(data, str):
+            step = chunk_size // 2
+            for start in range(0, len(data), step):
+                yield data[start:start + step].encode("utf-16-le", "surrogatepass")
+            return
+        view = memoryview(data)
+        for start in range(0, view.nbytes, chunk_size):
+            yield view[start:start + chunk_size]
+
+    def enum_formats(self):
+        """Returns the ids of every format on the clipboard, in clipboard order."""
+        raise NotImplementedError
+
+    def format_name(self, format_id):
+        """Returns the registered name of a non-standard format id, or raises
+        InvalidHandle if there is no such format."""
+        raise NotImplementedError
+
+    def register_format(self, name):
+        """Returns the id for a named format, registering it if it's new."""
+        raise NotImplementedError
+
+    def seq(self):
+        """Returns the clipboard sequence number, which changes every time
+        the contents do."""
+        raise NotImplementedError
+
+    def notifier(self):
+        """Returns a ClipboardNotifier for this clipboard, or None if the
+        backend can only be polled."""
+        return None
+
+
+class Win32Backend(Backend):
+    """The Windows system clipboard, through win32clipboard.
+    ref http://timgolden.me.uk/pywin32-docs/win32clipboard.html
+    """
+    ERRORS = {
+        "Access is denied.": AccessDenied,
+        "The handle is invalid.": InvalidHandle,
+        "Thread does not have a clipboard open.": NotOpen,
+    }
+    UNICODETEXT = 13
+    BYTE_TEXT = (1, 7)  # CF_TEXT, CF_OEMTEXT
+    HDROP = 15
+    # CF_BITMAP, CF_METAFILEPICT, CF_PALETTE, CF_ENHMETAFILE and friends
+    GDI_FORMATS = (2, 3, 9, 14, 0x0082, 0x0083, 0x008E)
+
+    def __init__(self):
+        if wc is None:
+            raise RuntimeError("win32clipboard is not available on this platform!")
+
+    @classmethod
+    def _translate(cls, error):
+        return cls.ERRORS.get(error.strerror, ClipboardError)(error.strerror)
+
+    def open(self):
+        try:
+            wc.OpenClipboard()
+        except pywintypes.error as e:
+            raise self._translate(e) from e
+
+    def close(self):
+        try:
+            wc.CloseClipboard()
+        except pywintypes.error as e:
+            raise self._translate(e) from e
+
+    def empty(self):
+        try:
+            wc.EmptyClipboard()
+        except pywintypes.error as e:
+            raise self._translate(e) from e
+
+    def set_data(self, format_id, data):
+        try:
+            wc.SetClipboardData(format_id, data)
+        except pywintypes.error as e:
+            raise self._translate(e) from e
+
+    def get_data(self, format_id):
+        try:
+            return wc.GetClipboardData(format_id)
+        except TypeError as e:
+            raise FormatUnavailable(str(e)) from e
+        except pywintypes.error as e:
+            raise self._translate(e) from e
+
+    def data_size(self, format_id):
+        handle = self._global_handle(format_id)
+        if handle is None:
+            return None
+        return _kernel32().GlobalSize(handle) or None
+
+    def get_data_prefix(self, format_id, size):
+        """Copies just the first size bytes out of the clipboard's memory, so
+        a huge payload doesn't get copied just to be cut down."""
+        if format_id == self.HDROP:  # win32clipboard unpacks this one for us
+            return super().get_data_prefix(format_id, size)
+        handle = self._global_handle(format_id)
+        kernel32 = _kernel32()
+        pointer = kernel32.GlobalLock(handle) if handle is not None else None
+        if not pointer:
+            return super().get_data_prefix(format_id, size)
+        try:
+            raw = ctypes.string_at(pointer, min(size, kernel32.GlobalSize(handle)))
+        finally:
+            kernel32.GlobalUnlock(handle)
+        if format_id == self.UNICODETEXT:
+            # an odd size or a split surrogate pair leaves a partial character
+            return raw[:len(raw) // 2 * 2].decode("utf-16-le", errors="ignore").split("\0", 1)[0]
+        if format_id in self.BYTE_TEXT:
+            end = raw.find(b"\0")
+            return raw if end < 0 else raw[:end]
+        return raw
+
+    def read_chunks(self, format_id, chunk_size):
+        """Copies the payload out of the clipboard's memory a chunk at a time,
+        so it never has to be held whole. chunk_size should be even, to keep
+        UTF-16 text aligned."""
+        handle = self._global_handle(format_id)
+        kernel32 = _kernel32()
+        pointer = kernel32.GlobalLock(handle) if handle is not None else None
+        if not pointer:
+            yield from super().read_chunks(format_id, chunk_size)
+            return
+        try:
+            size = kernel32.GlobalSize(handle)
+            for offset in range(0, size, chunk_size):
+                chunk = ctypes.string_at(pointer + offset, min(chunk_size, size - offset))
+                end = self._terminator(format_id, chunk)
+                if end >= 0:
+                    yield chunk[:end]
+                    return
+                yield chunk
+        finally:
+            kernel32.GlobalUnlock(handle)
+
+    @classmethod
+    def _terminator(cls, format_id, chunk):
+        """Where the NUL that ends a text payload is in chunk, or -1."""
+        if format_id == cls.UNICODETEXT:
+            end = chunk.find(b"\0\0")
+            while end >= 0 and end % 2:
+                end = chunk.find(b"\0\0", end + 1)
+            return end
+        if format_id in cls.BYTE_TEXT:
+            return chunk.find(b"\0")
+        return -1
+
+    def _global_handle(self, format_id):
+        """The HGLOBAL behind one format, or None for formats that aren't
+        stored as global memory (bitmaps, metafiles, and so on)."""
+        if format_id in self.GDI_FORMATS:
+            return None
+        try:
+            return wc.GetClipboardDataHandle(format_id)
+        except TypeError as e:
+            raise FormatUnavailable(str(e)) from e
+        except pywintypes.error as e:
+            raise self._translate(e) from e
+
+    def enum_formats(self):
+        all_formats = []
+        current_format = wc.EnumClipboardFormats(0)
+        while current_format != 0:
+            all_formats.append(current_format)
+            current_format = wc.EnumClipboardFormats(current_format)
+        return all_formats
+
+    def format_name(self, format_id):
+        try:
+            return wc.GetClipboardFormatName(format_id)
+        except pywintypes.error as e:
+            raise self._translate(e) from e
+
+    def register_format(self, name):
+        try:
+            return wc.RegisterClipboardFormat(name)
+        except pywintypes.error as e:
+            raise self._translate(e) from e
+
+    def seq(self):
+        return wc.GetClipboardSequenceNumber()
+
+    def notifier(self):
+        if QtGui.QGuiApplication.instance() is None:
+            return None
+        return QtNotifier()
+
+
+class MemoryBackend(Backend):
+    """A thread-safe clipboard that lives in this process.
+
+    It copies the Win32 behaviour Handler relies on: one thread at a time can
+    have it open (anyone else gets AccessDenied), every empty and set bumps the
+    sequence number, formats enumerate in the order they were set, and
+    registered format names come from register_format.
+
+    copy() plays the part of another application setting the clipboard.
+    """
+    FIRST_REGISTERED = 0xC000
+
+    def __init__(self, names=None):
+        self._lock = threading.Lock()
+        self._owner = None
+        self._data = {}
+        self._seq = 1
+        self._names = dict(names) if names else {}
+        self._notifier = None
+
+    def register_format(self, name):
+        with self._lock:
+            for format_id, format_name in self._names.items():
+                if format_name == name:
+                    return format_id
+            format_id = max(self._names, default=self.FIRST_REGISTERED - 1) + 1
+            self._names[format_id] = name
+            return format_id
+
+    def open(self):
+        with self._lock:
+            if self._owner is not None:
+                raise AccessDenied("Access is denied.")
+            self._owner = threading.get_ident()
+
+    def close(self):
+        with self._lock:
+            self._check_open()
+            self._owner = None
+
+    def empty(self):
+        with self._lock:
+            self._check_open()
+            self._data.clear()
+            self._seq += 1
+        self._changed()
+
+    def set_data(self, format_id, data):
+        if data is None:
+            raise InvalidHandle("The handle is invalid.")
+        with self._lock:
+            self._check_open()
+            self._data[format_id] = data
+            self._seq += 1
+        self._changed()
+
+    def get_data(self, format_id):
+        with self._lock:
+            self._check_open()
+            try:
+                return self._data[format_id]
+            except KeyError:
+                raise FormatUnavailable("Specified clipboard format is not available")
+
+    def data_size(self, format_id):
+        # not through get_data, which subclasses wrap to count reads
+        data = MemoryBackend.get_data(self, format_id)
+        if isinstance(data, str):
+            return len(data) * 2
+        try:
+            return len(data)
+        except TypeError:
+            return None
+
+    def enum_formats(self):
+        with self._lock:
+            self._check_open()
+            return list(self._data)
+
+    def format_name(self, format_id):
+        try:
+            return self._names[format_id]
+        except KeyError:
+            raise InvalidHandle("The handle is invalid.")
+
+    def seq(self):
+        return self._seq
+
+    def notifier(self):
+        if self._notifier is None:
+            self._notifier = ClipboardNotifier()
+        return self._notifier
+
+    def copy(self, data):
+        """Replace the whole clipboard in one go, like another application
+        would. data maps format ids to payloads. Raises AccessDenied if the
+        clipboard is open."""
+        with self._lock:
+            if self._owner is not None:
+                raise AccessDenied("Access is denied.")
+            self._data = dict(data)
+            self._seq += len(self._data) + 1
+        self._changed()
+
+    def _check_open(self):
+        if self._owner != threading.get_ident():
+            raise NotOpen("Thread does not have a clipboard open.")
+
+    def _changed(self):
+        if self._notifier is not None:
+            self._notifier.seq_changed.emit()
+
+
+class GuiThreadCall(QtCore.QObject):
+    """Runs functions on the thread it lives on, for callers on any thread.
+    A caller on another thread waits until the function has run there, so
+    that thread has to be running its event loop."""
+    _call = Signal()
+    # one per thread, kept for good: a QObject can only be deleted on its
+    # own thread, and the last reference to one could go anywhere
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, thread):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._pending = None
+        self._outcome = None
+        self.moveToThread(thread)
+        self._call.connect(self._run, QtCore.Qt.BlockingQueuedConnection)
+
+    @classmethod
+    def on(cls, thread):
+        """The GuiThreadCall that runs functions on thread."""
+        with cls._instances_lock:
+            instance = cls._instances.get(thread)
+            if instance is None:
+                instance = cls._instances[thread] = cls(thread)
+            return instance
+
+    def run(self, function, *args):
+        """Returns function(*args), or raises what it raised."""
+        if QtCore.QThread.currentThread() is self.thread():
+            return function(*args)
+        with self._lock:
+            self._pending = (function, args)
+            try:
+                self._call.emit()
+                value, error = self._outcome
+            finally:
+                self._pending = self._outcome = None
+        if error is not None:
+            raise error
+        return value
+
+    @QtCore.Slot()
+    def _run(self):
+        function, args = self._pending
+        try:
+            self._outcome = function(*args), None
+        except Exception as e:
+            self._outcome = None, e
+
+
+def _on_gui_thread(method):
+    """Makes a QtBackend method run on the clipboard's thread."""
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        return self._gui.run(method, self, *args)
+    return wrapper
+
+
+class QtBackend(Backend):
+    """The system clipboard through QClipboard, for builds without
+    win32clipboard. QClipboard only works on the GUI thread, so calls from
+    other threads (WriteQueue's, say) are run there and wait for it.
+
+    Qt deals in MIME types, so format ids are mapped onto them: unicode text
+    is text/plain, and registered formats use their name if it is already a
+    MIME type or Qt's windows-mime wrapper if it isn't. MIME types nobody has
+    mapped yet get new ids as they turn up. The clipboard has no sequence
+    number either, so seq counts dataChanged signals instead.
+
+    Writes collect into one QMimeData that is handed over on close.
+    """
+    UNICODETEXT = 13
+    FIRST_REGISTERED = 0xC000
+    # the registered ids cliphandler hands out itself
+    REGISTERED = {
+        49443: "HTML Format",
+        49927: "PNG",
+    }
+    MIME_TYPES = {
+        "HTML Format": "text/html",
+        "PNG": "image/png",
+    }
+
+    def __init__(self, clipboard=None):
+        if clipboard is None:
+            clipboard = QtGui.QGuiApplication.clipboard()
+        self.clipboard = clipboard
+        self._gui = GuiThreadCall.on(clipboard.thread())
+        self._lock = threading.Lock()
+        self._names = dict(self.REGISTERED)
+        self._pending = None
+        self._seq = 1
+        self.clipboard.dataChanged.connect(self._changed)
+
+    def _changed(self):
+        self._seq += 1
+
+    def _mime_type(self, format_id):
+        if format_id == self.UNICODETEXT:
+            return "text/plain"
+        name = self.format_name(format_id)
+        if name in self.MIME_TYPES:
+            return self.MIME_TYPES[name]
+        if "/" in name:
+            return name
+        return f'application/x-qt-windows-mime;value="{name}"'
+
+    def _format_id(self, mime_type):
+        if mime_type == "text/plain":
+            return self.UNICODETEXT
+        for format_id in self._names:
+            if self._mime_type(format_id) == mime_type:
+                return format_id
+        return self.register_format(mime_type)
+
+    def open(self):
+        if not self._lock.acquire(blocking=False):
+            raise AccessDenied("Access is denied.")
+
+    def close(self):
+        if not self._lock.locked():
+            raise NotOpen("Thread does not have a clipboard open.")
+        try:
+            if self._pending is not None:
+                self._gui.run(self.clipboard.setMimeData, self._pending)
+                self._pending = None
+        finally:
+            self._lock.release()
+
+    @_on_gui_thread
+    def empty(self):
+        self._pending = QtCore.QMimeData()
+        self.clipboard.clear()
+
+    @_on_gui_thread
+    def set_data(self, format_id, data):
+        if data is None:
+            raise InvalidHandle("The handle is invalid.")
+        if self._pending is None:
+            self._pending = QtCore.QMimeData()
+        if format_id == self.UNICODETEXT:
+            self._pending.setText(data)
+        elif isinstance(data, str):
+            self._pending.setData(self._mime_type(format_id), data.encode())
+        else:
+            self._pending.setData(self._mime_type(format_id), QtCore.QByteArray(data))
+
+    @_on_gui_thread
+    def get_data(self, format_id):
+        mime_data = self.clipboard.mimeData()
+        mime_type = self._mime_type(format_id)
+        if mime_data is None or not mime_data.hasFormat(mime_type):
+            raise FormatUnavailable("Specified clipboard format is not available")
+        if format_id == self.UNICODETEXT:
+            return mime_data.text()
+        return mime_data.data(mime_type).data()
+
+    @_on_gui_thread
+    def data_size(self, format_id):
+        mime_data = self.clipboard.mimeData()
+        mime_type = self._mime_type(format_id)
+        if mime_data is None or not mime_data.hasFormat(mime_type):
+            raise FormatUnavailable("Specified clipboard format is not available")
+        if format_id == self.UNICODETEXT:
+            return len(mime_data.text()) * 2
+        return mime_data.data(mime_type).size()
+
+    @_on_gui_thread
+    def enum_formats(self):
+        mime_data = self.clipboard.mimeData()
+        if mime_data is None:
+            return []
+        return [self._format_id(mime_type) for mime_type in mime_data.formats()]
+
+    def format_name(self, format_id):
+        try:
+            return self._names[format_id]
+        except KeyError:
+            raise InvalidHandle("The handle is invalid.")
+
+    def register_format(self, name):
+        for format_id, format_name in self._names.items():
+            if format_name == name:
+                return format_id
+        format_id = max(self._names, default=self.FIRST_REGISTERED - 1) + 1
+        self._names[format_id] = name
+        return format_id
+
+    def seq(self):
+        return self._seq
+
+    def notifier(self):
+        return QtNotifier(self.clipboard)
+
+
+_kernel32_dll = None
+
+
+def _kernel32():
+    """kernel32 with the global memory functions typed for 64-bit handles."""
+    global _kernel32_dll
+    if _kernel32_dll is None:
+        kernel32 = ctypes.windll.kernel32
+        kernel32.GlobalSize.argtypes = [ctypes.c_void_p]
+        kernel32.GlobalSize.restype = ctypes.c_size_t
+        kernel32.GlobalLock.argtypes = [ctypes.c_void_p]
+        kernel32.GlobalLock.restype = ctypes.c_void_p
+        kernel32.GlobalUnlock.argtypes = [ctypes.c_void_p]
+        _kernel32_dll = kernel32
+    return _kernel32_dll
+
+
+_default = None
+
+
+def get_default():
+    """Returns the backend Handlers use when they aren't given one: the
+    Win32 clipboard where there is one, then Qt's, then an in-memory one."""
+    global _default
+    if _default is None:
+        if wc is not None:
+            _default = Win32Backend()
+        elif QtGui.QGuiApplication.instance() is not None:
+            _default = QtBackend()
+        else:
+            logging.warning("No system clipboard available, using an "
+                            "in-memory clipboard.")
+            _default = MemoryBackend()
+    return _default
+
+
+def set_default(backend):
+    """Makes backend the one Handlers and Formats use by default."""
+    global _default
+    _default = backend
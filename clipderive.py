@@ -0,0 +1,272 @@
+"""This module turns clipboard payloads into what cards and previews show -
+plain text out of "HTML Format", a str out of CF_TEXT bytes, a QImage out
+of CF_DIB or PNG - and remembers the results.
+
+Conversions are registered with register() by source format and the kind
+of thing they make ("text", "qimage"). The source is a standard format id,
+or a registered format's name, since registered ids change between
+sessions. derive(datum, kind) runs the conversion that fits the Datum's
+format.
+
+Results are kept in `cache`, a DerivedCache keyed on the Datum's content
+digest, so every Datum holding the same payload shares them. It drops the
+least recently used results to stay within one byte budget for all Datums;
+stats() has its hits, misses and evictions. Conversion times go into
+clipstats.metrics as "derive.<kind>".
+"""
+
+import re
+import sys
+import struct
+import threading
+import collections
+from html.parser import HTMLParser
+from time import perf_counter
+
+from PySide2 import QtGui
+
+import clipstats
+from cliphandler import Format
+
+
+def sizeof(value):
+    """Roughly how many bytes a derived value holds on to."""
+    if isinstance(value, QtGui.QImage):
+        return value.sizeInBytes()
+    return sys.getsizeof(value)
+
+
+class DerivedCache:
+    """A least recently used cache of derived values, holding at most budget
+    bytes of them in all (as measured by sizeof). A value bigger than the
+    whole budget isn't kept."""
+    BUDGET = 64 * 1024 * 1024
+
+    def __init__(self, budget=BUDGET):
+        self.budget = budget
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """The value kept under key, marked as just used, or default."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        """Keep value under key, evicting older values to make room. Returns
+        False if the value is too big to keep at all."""
+        if size is None:
+            size = sizeof(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.budget:
+                return False
+            self._entries[key] = (value, size)
+            self.size += size
+            self._evict()
+        return True
+
+    def resize(self, budget):
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.budget:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "entries": len(self),
+            "bytes": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hit_ratio,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+cache = DerivedCache()
+
+# (source format id or name, kind): function(data)
+_conversions = {}
+_MISSING = object()
+
+
+def register(source, kind, function):
+    """Register function(data) as the way to make kind out of payloads of
+    source, a format id, Format, or registered format's name. Replaces any
+    conversion already registered for the pair."""
+    if isinstance(source, Format):
+        source = source.id
+    _conversions[(source, kind)] = function
+
+
+def _find(format_, kind):
+    for source in (format_.id, format_.name):
+        function = _conversions.get((source, kind))
+        if function is not None:
+            return source, function
+    return None
+
+
+def kinds(format_):
+    """The kinds that can be derived from a format."""
+    format_ = Format(format_) if not isinstance(format_, Format) else format_
+    return sorted({kind for source, kind in _conversions
+                   if source in (format_.id, format_.name)})
+
+
+def derive(datum, kind):
+    """kind made out of datum's payload, from the cache if it's there.
+    Raises LookupError if nothing makes kind out of the Datum's format."""
+    found = _find(datum.format, kind)
+    if found is None:
+        raise LookupError(f"Nothing is registered to make {kind} from {datum.format}")
+    source, function = found
+    key = (source, kind, datum.content_digest)
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+    start = perf_counter()
+    data = datum.data
+    value = function(data)
+    clipstats.metrics.time(f"derive.{kind}", start)
+    # a payload handed back as it is costs nothing more to keep
+    cache.put(key, value, 0 if value is data else None)
+    return value
+
+
+class HTMLText(HTMLParser):
+    """Collects the text of an HTML fragment, a line per block element."""
+    BLOCKS = {"address", "blockquote", "br", "dd", "div", "dl", "dt", "h1", "h2", "h3",
+              "h4", "h5", "h6", "hr", "li", "ol", "p", "pre", "table", "tr", "ul"}
+    SKIPPED = {"head", "script", "style", "template"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED:
+            self._skipping += 1
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+    def text(self):
+        lines = (" ".join(line.split()) for line in "".join(self.parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+
+# CF_HTML's description header: "StartFragment:00000123" and so on
+HTML_OFFSET = re.compile(rb"^(StartHTML|EndHTML|StartFragment|EndFragment):(-?\d+)\r?$",
+                         re.MULTILINE)
+
+
+def html_text(data):
+    """The plain text of a CF_HTML payload's fragment (or of all of it, if
+    the header doesn't say where the fragment is)."""
+    data = bytes(data)
+    offsets = {name: int(value) for name, value in
+               HTML_OFFSET.findall(data[:data.find(b"<") if b"<" in data else len(data)])}
+    start, end = offsets.get(b"StartFragment", -1), offsets.get(b"EndFragment", -1)
+    if not 0 <= start <= end <= len(data):
+        start, end = max(0, offsets.get(b"StartHTML", 0)), len(data)
+    parser = HTMLText()
+    parser.feed(data[start:end].decode("utf-8", errors="replace"))
+    parser.close()
+    return parser.text()
+
+
+def unicode_text(data):
+    if isinstance(data, memoryview):
+        # spilled, so still UTF-16
+        return str(data, "utf-16-le", errors="replace")
+    return data
+
+
+def byte_text(encoding):
+    def decode(data):
+        if isinstance(data, str):
+            return data
+        return str(data, encoding, errors="replace")
+    return decode
+
+
+def file_list(data):
+    """CF_HDROP, which win32clipboard unpacks to a tuple of paths."""
+    return "\n".join(data)
+
+
+def dib_image(data):
+    """A QImage of a CF_DIB or CF_DIBV5: a BMP file without its file header,
+    which has to be put back for Qt to read it."""
+    data = bytes(data)
+    header_size, = struct.unpack_from("<I", data)
+    if header_size == 12:  # BITMAPCOREHEADER, with 3 byte palette entries
+        bit_count, = struct.unpack_from("<H", data, 10)
+        palette = (1 << bit_count) * 3 if bit_count <= 8 else 0
+    else:
+        bit_count, compression = struct.unpack_from("<HI", data, 14)
+        colors, = struct.unpack_from("<I", data, 32)
+        if not colors and bit_count <= 8:
+            colors = 1 << bit_count
+        palette = colors * 4
+        if header_size == 40 and compression == 3:  # BI_BITFIELDS masks
+            palette += 12
+    file_header = struct.pack("<2sIHHI", b"BM", 14 + len(data), 0, 0,
+                              14 + header_size + palette)
+    return QtGui.QImage.fromData(file_header + data, "BMP")
+
+
+def png_image(data):
+    return QtGui.QImage.fromData(bytes(data), "PNG")
+
+
+register(13, "text", unicode_text)  # CF_UNICODETEXT
+register(1, "text", byte_text("cp1252"))  # CF_TEXT
+register(7, "text", byte_text("cp437"))  # CF_OEMTEXT
+register(15, "text", file_list)  # CF_HDROP
+register("HTML Format", "text", html_text)
+register(8, "qimage", dib_image)  # CF_DIB
+register(17, "qimage", dib_image)  # CF_DIBV5
+register("PNG", "qimage", png_image)
@@ -5,25 +5,45 @@ talk to via signals/slots.
 signals emitted:
 clipboard_updated()
 new_card_from_clipboard(Clip)
+load_finished(Clip, str)
 
 slots caught:
 load_card_to_clipboard(Clip/Card/string)
 """
 
-import sys
+import re
+import math
+import codecs
+import mmap
+import pickle
+import itertools
+import tempfile
+import collections
+import hashlib
 import logging
-from time import sleep
+import threading
+import weakref
+from time import sleep, perf_counter
+from concurrent.futures import ThreadPoolExecutor
 
 from PySide2 import QtCore
 from PySide2.QtCore import Signal, Slot
 
-import win32clipboard as wc
-import pywintypes
+import clipbackend
+import clipstats
+from clipstats import Histogram
+from clipbackend import ClipboardError, InvalidHandle, AccessDenied, NotOpen, \
+    FormatUnavailable
 
 
 class Format:
     """This class represents a single clipboard format. Reference
     https://docs.microsoft.com/en-us/windows/desktop/dataxchg/standard-clipboard-formats
+
+    Formats are interned: Format(13) hands back the same object every time,
+    and a registered format's name is only looked up on its backend the first
+    time its id turns up. That makes Formats immutable. They hash like their
+    id, so a dict keyed by Format can be looked up with a plain int.
     """
 
     STANDARD_FORMATS = {
@@ -56,27 +76,76 @@ class Format:
     }
 
     @staticmethod
-    def translate_format(format_id):
+    def translate_format(format_id, backend=None):
         if format_id in Format.STANDARD_FORMATS:
             # return "standard format " + \
             #        ClipboardRenderer.STANDARD_FORMATS[CBFormat]
             return Format.STANDARD_FORMATS[format_id][3:]
-        return wc.GetClipboardFormatName(format_id)
+        if backend is None:
+            backend = clipbackend.get_default()
+        return backend.format_name(format_id)
+
+    __slots__ = ("id", "name")
+
+    _standard = {}
+    _registered = weakref.WeakKeyDictionary()
+    _lock = threading.Lock()
 
-    def __init__(self, format_id=None):
-        """ Initialize a new Format."""
+    def __new__(cls, format_id=None, backend=None):
+        """ Get the Format for an id. Non-standard names are looked up on
+        backend, or the default backend if it's None."""
         if isinstance(format_id, Format):
-            self.id = format_id.id
-            self.name = format_id.name
-        elif format_id:
+            return format_id
+        if not format_id:
+            format_id = None
+        if format_id is None or format_id in cls.STANDARD_FORMATS:
+            interned = cls._standard
+        else:
+            if backend is None:
+                backend = clipbackend.get_default()
+            interned = cls._registered.get(backend)
+            if interned is None:
+                with cls._lock:
+                    interned = cls._registered.setdefault(backend, {})
+        format_ = interned.get(format_id)
+        if format_ is None:
             # if format_id == 3:  # CF_METAFILEPICT
             #     raise ValueError("CF_METAFILEPICT format not supported "
             #                      "by win32clipboard!")
-            self.id = format_id
-            self.name = self.translate_format(format_id)
-        else:
-            self.id = None
-            self.name = None
+            name = None
+            if format_id is not None:
+                name = cls.translate_format(format_id, backend)
+            format_ = object.__new__(cls)
+            object.__setattr__(format_, "id", format_id)
+            object.__setattr__(format_, "name", name)
+            with cls._lock:
+                # another thread may have got here first; everyone gets its copy
+                format_ = interned.setdefault(format_id, format_)
+        return format_
+
+    @classmethod
+    def forget_names(cls, backend=None):
+        """Drop the cached names of registered formats, for one backend or all
+        of them, so they're looked up again. Formats already handed out keep
+        the name they had."""
+        with cls._lock:
+            if backend is None:
+                cls._registered = weakref.WeakKeyDictionary()
+            else:
+                cls._registered.pop(backend, None)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Format is interned and can't be changed; "
+                             "use Format(id) for a different format")
+
+    def __reduce__(self):
+        return Format, (self.id,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __str__(self):
         if self.id:
@@ -86,58 +155,557 @@ class Format:
 
     def __eq__(self, other):
         # return self.id == other.id and self.name == other.name
+        if other is self:
+            return True
+        if isinstance(other, Format):
+            return self.id == other.id
         if isinstance(other, int):
             return self.id == other
-        return self.id == other.id
+        return NotImplemented
 
     def __ne__(self, other):
         return not self == other
 
+    def __hash__(self):
+        return hash(self.id)
+
+
+class StaleClipError(ClipboardError):
+    """A deferred Datum was read after the clipboard it came from changed."""
+
+
+class LockTimeout(ClipboardError):
+    """Handler couldn't get the clipboard lock before its deadline."""
+
+
+def payload_digest(payload, kind=None):
+    """The 16 byte BLAKE2b digest of a payload. Text is digested as UTF-8 and
+    buffers as their bytes, each under its own kind so "a" and b"a" differ;
+    anything else is digested as its pickle. kind overrides the payload's
+    own, for raw bytes that stand for something else."""
+    if kind is None:
+        if payload is None:
+            payload, kind = b"", b"none"
+        elif isinstance(payload, str):
+            payload, kind = payload.encode("utf-8", "surrogatepass"), b"str"
+        elif isinstance(payload, (bytes, bytearray, memoryview)):
+            kind = b"bytes"
+        else:
+            payload, kind = pickle.dumps(payload), b"pickle"
+    return hashlib.blake2b(payload, digest_size=16, person=kind).digest()
+
+
+# as many whole characters of a repr as there are: escapes like \x9c, \u2603
+# and \n, and everything else, up to a partial escape
+_WHOLE_CHARACTERS = re.compile(
+    r"(?:[^\\]|\\x[0-9a-f]{2}|\\u[0-9a-f]{4}|\\U[0-9a-f]{8}|\\[^xuU])*", re.DOTALL)
+
+
+def shorten_preview(preview, length):
+    """A repr preview cut to at most length characters, between escapes
+    rather than in the middle of one. Not for text, where a backslash is
+    just a backslash."""
+    if len(preview) <= length:
+        return preview
+    if "\\" not in preview[:length]:
+        return preview[:length]
+    return _WHOLE_CHARACTERS.match(preview, 0, length).group()
+
+
+def payload_preview(payload, length=80, encoding=None):
+    """At most length characters showing the start of payload, made from no
+    more of it than that takes. With an encoding, a binary payload is decoded,
+    stopping short of a character whose bytes aren't all there; without one,
+    it's shown the way repr shows bytes."""
+    if isinstance(payload, str):
+        return payload[:length]
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        if encoding is not None:
+            # no encoding text comes in takes more than 4 bytes a character
+            decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+            return decoder.decode(payload[:length * 4])[:length]
+        return shorten_preview(repr(bytes(payload[:length])), length)
+    return shorten_preview(str(payload), length)
+
+
+# how encode_payload stores a payload; clipwire and cliphistory record these
+PAYLOAD_NONE = 0
+PAYLOAD_STR = 1
+PAYLOAD_BYTES = 2
+PAYLOAD_PICKLE = 3
+PAYLOAD_UTF16 = 4  # spilled CF_UNICODETEXT, kept as the clipboard holds it
+
+
+def frozen_view(payload):
+    """True if payload is a read-only view of something that can't change
+    under it (bytes, or an mmap opened with ACCESS_READ), so it can be held
+    on to instead of copied."""
+    return isinstance(payload, memoryview) and payload.readonly \
+        and isinstance(payload.obj, (bytes, mmap.mmap))
+
+
+def encode_payload(data, format_id):
+    """(kind, bytes) to store a Datum's payload as, for decode_payload to
+    turn back into it. Buffers, spilled ones included, are stored as they
+    are, so they can be written straight from their mapping."""
+    if data is None:
+        return PAYLOAD_NONE, b""
+    if isinstance(data, str):
+        return PAYLOAD_STR, data.encode("utf-8", "surrogatepass")
+    if isinstance(data, memoryview) and format_id == 13:
+        return PAYLOAD_UTF16, data
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return PAYLOAD_BYTES, data
+    return PAYLOAD_PICKLE, pickle.dumps(data)
+
+
+def decode_payload(kind, view, keep_views=False):
+    """The payload encode_payload stored as kind, from a memoryview of what
+    it stored. With keep_views, binary payloads and spilled text come back as
+    the view itself, which is only right if it's a frozen_view; otherwise
+    they're copied, and spilled text is decoded to a str."""
+    if kind == PAYLOAD_NONE:
+        return None
+    if kind == PAYLOAD_STR:
+        return str(view, "utf-8", "surrogatepass")
+    if kind == PAYLOAD_BYTES:
+        return view if keep_views and view.nbytes else bytes(view)
+    if kind == PAYLOAD_UTF16:
+        return view if keep_views and view.nbytes else str(view, "utf-16-le", "surrogatepass")
+    if kind == PAYLOAD_PICKLE:
+        return pickle.loads(view)
+    raise ValueError(f"Unknown payload kind {kind}")
+
+
+class Blob:
+    """One payload in a BlobStore, shared by every Datum with that content.
+    A text blob that ASCII CF_TEXT shares keeps the CF_TEXT bytes in encoded,
+    so they're neither encoded again nor held more than once."""
+    __slots__ = ("store", "digest", "payload", "size", "refs", "encoded")
+
+    def __init__(self, store, digest, payload, size):
+        self.store = store
+        self.digest = digest
+        self.payload = payload
+        self.size = size
+        self.refs = 0
+        self.encoded = None
+
+
+class BlobStore:
+    """A content-addressed, reference-counted table of clipboard payloads.
+
+    Datums hand their str and bytes payloads to the store and keep the Blob
+    they get back, so the same URL copied twenty times is held once. ASCII
+    CF_TEXT is stored as text, so it shares with the matching
+    CF_UNICODETEXT; its bytes are kept alongside, once, for the CF_TEXT
+    Datums to hand out. Payloads under min_size bytes aren't worth the
+    bookkeeping and stay with their Datum.
+    """
+    def __init__(self, min_size=32):
+        self.min_size = min_size
+        self._blobs = {}
+        self._lock = threading.Lock()
+        self.references = 0
+        self.stored_bytes = 0
+        self.logical_bytes = 0
+
+    def acquire(self, payload, as_text=False):
+        """Returns the Blob for payload with a reference taken, adding it if
+        it's new, or None if the store doesn't keep payloads like this one.
+        If as_text, ASCII bytes are stored as the str they decode to, and the
+        first bytes given for it are kept as its encoded form."""
+        encoded = None
+        if isinstance(payload, str):
+            raw = payload.encode("utf-8", "surrogatepass")
+            kind = b"str"
+        elif isinstance(payload, bytes):
+            raw = payload
+            kind = b"bytes"
+            if as_text and payload.isascii():
+                encoded = payload
+                payload = payload.decode("ascii")
+                kind = b"str"
+        else:
+            return None
+        if len(raw) < self.min_size:
+            return None
+        digest = payload_digest(raw, kind)
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is None:
+                blob = self._blobs[digest] = Blob(self, digest, payload, len(raw))
+                self.stored_bytes += blob.size
+            if encoded is not None and blob.encoded is None:
+                blob.encoded = encoded
+                self.stored_bytes += len(encoded)
+            self._take(blob)
+        return blob
+
+    def retain(self, blob):
+        """Take another reference to a blob this store handed out."""
+        with self._lock:
+            self._take(blob)
+
+    def release(self, blob):
+        """Drop a reference; the blob is forgotten once nothing refers to it."""
+        with self._lock:
+            blob.refs -= 1
+            self.references -= 1
+            self.logical_bytes -= blob.size
+            if blob.refs == 0:
+                del self._blobs[blob.digest]
+                self.stored_bytes -= blob.size
+                if blob.encoded is not None:
+                    self.stored_bytes -= len(blob.encoded)
+
+    def _take(self, blob):
+        blob.refs += 1
+        self.references += 1
+        self.logical_bytes += blob.size
+
+    @property
+    def saved_bytes(self):
+        """Bytes not held thanks to deduplication."""
+        return self.logical_bytes - self.stored_bytes
+
+    @property
+    def dedup_ratio(self):
+        """Bytes referenced per byte stored; 1.0 means nothing was shared."""
+        if self.stored_bytes == 0:
+            return 1.0
+        return self.logical_bytes / self.stored_bytes
+
+    def stats(self):
+        return {
+            "blobs": len(self),
+            "references": self.references,
+            "stored_bytes": self.stored_bytes,
+            "logical_bytes": self.logical_bytes,
+            "saved_bytes": self.saved_bytes,
+            "dedup_ratio": self.dedup_ratio,
+        }
+
+    def __len__(self):
+        return len(self._blobs)
+
+
+blob_store = BlobStore()
+
+
+def encode_image(image, image_format="PNG", quality=-1, header=0):
+    """Encode a QImage with one of Qt's image writers and return the bytes,
+    dropping the first header bytes. The encoded image is copied out of Qt
+    once, straight into the bytes returned."""
+    ba = QtCore.QByteArray()
+    buffer = QtCore.QBuffer(ba)
+    buffer.open(QtCore.QIODevice.WriteOnly)
+    image.save(buffer, image_format, quality)
+    buffer.close()
+    with memoryview(ba) as view:
+        return bytes(view[header:])
+
+
+def spill(chunks, directory=None):
+    """Write chunks of a payload to a temporary file and map it back
+    read-only, so holding the payload costs page cache rather than memory.
+    Returns a memoryview of the mapping. The file has no name, and goes away
+    once nothing refers to the view."""
+    with tempfile.TemporaryFile(prefix="clip-spill-", dir=directory) as file:
+        for chunk in chunks:
+            file.write(chunk)
+        if not file.tell():
+            return b""
+        file.flush()
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapping)
+
+
+# Qt releases the GIL while it encodes, so these really run in parallel
+image_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image_encode")
+
+
+class EncodedImage:
+    """The loader of a Datum whose image is still being encoded: waits for
+    the encode to finish when the Datum's data is used."""
+    def __init__(self, future):
+        self.future = future
+
+    def __call__(self):
+        return self.future.result()
+
 
 class Datum:
-    """Contains a single clipboard data-format pair"""
+    """Contains a single clipboard data-format pair.
+
+    A Datum can be deferred: it knows its format but only fetches its payload
+    the first time data is used (see Handler.read). Call materialize() to
+    fetch it early.
+
+    QImages are encoded on Datum.image_pool (or right away, if that's None)
+    with the codec named by Datum.image_codec, so a big screenshot doesn't
+    stall the thread that made the Datum. Until the encode finishes the Datum
+    is deferred, and using its data waits for it.
+
+    Binary payloads are held as immutable bytes: the bytes a backend hands
+    over are kept as they are, and only mutable buffers (bytearray,
+    memoryview, QByteArray) are copied, once, to freeze them. Read-only
+    memoryviews of bytes or of a read-only mmap are kept as they are, and
+    keep what they view alive. view exposes a payload as a memoryview, and
+    Handler.write passes the same bytes object to the backend.
+
+    Payloads too big to hold in memory are spilled (see Handler): data is
+    then a read-only memoryview of a memory-mapped file, holding the payload
+    as the clipboard does, so text is UTF-16.
+
+    A preview of PREVIEW_LENGTH characters (see payload_preview) is made
+    from the start of the payload when it's set: at capture for an eager
+    read, and when a deferred payload is fetched. string_preview and str()
+    use it, so showing a history never reads a whole payload.
+
+    Datums are equal when their formats and data are, and hash on their
+    format and content_digest, so they can go in sets and be dict keys;
+    don't change the data or format of one that's in a set. Comparing two
+    Datums whose digests are known (see content_digest) only compares the
+    digests.
+
+    Histories hold a lot of these, so Datum uses __slots__ and looks up its
+    serializers in a class-level table. Payloads are kept in Datum.store (a
+    BlobStore, or None to keep every payload separately), so identical
+    payloads across Datums are held once.
+    """
+    __slots__ = ("_data", "_blob", "_loader", "_digest", "_preview", "format")
+
+    # type name of the data: name of the method that serializes it
+    DATA_TYPES = {
+        "QImage": "_load_qimage",
+    }
+    BYTE_TEXT_FORMATS = (1, 7)  # CF_TEXT, CF_OEMTEXT
+    PREVIEW_LENGTH = 80
+    store = blob_store
+
+    # codec: (Qt image format, clipboard format, quality, header bytes to drop)
+    # Qt's PNG quality runs from 0 (smallest) to 100 (fastest)
+    IMAGE_CODECS = {
+        "png": ("PNG", 49927, -1, 0),
+        "png_fast": ("PNG", 49927, 80, 0),
+        # CF_DIB is a BMP file without its 14 byte BITMAPFILEHEADER
+        "dib": ("BMP", 8, -1, 14),
+    }
+    image_codec = "png"
+    image_quality = None  # None uses the codec's
+    image_pool = image_pool
+
     def __init__(self, data=None, format_=None):
-        self.data_types = None
+        self._blob = None
+        self._loader = None
+        self._digest = None
+        self._preview = None
         if data is None:
-            self.data = None
+            self._data = None
             self.format = Format(None)
         elif isinstance(data, Datum):
-            self.data = data.data
+            self._data = data._data
+            self._blob = data._blob
+            if self._blob is not None:
+                self._blob.store.retain(self._blob)
+            self._loader = data._loader
+            self._digest = data._digest
+            self._preview = data._preview
             self.format = data.format
         else:
-            self.data, serial_format = self.serialize(data)
+            payload, serial_format = self.serialize(data)
             if format_:
                 self.format = Format(format_)
             else:
                 self.format = Format(serial_format)
+            self._set_payload(payload)
+
+    def __del__(self):
+        blob = getattr(self, "_blob", None)
+        if blob is not None:
+            blob.store.release(blob)
+
+    def __reduce__(self):
+        data = self.data
+        encoding = self._preview_encoding(data)
+        if encoding is not None:
+            # spilled text only reads as text while it's a view, so the copy
+            # gets the str it stands for
+            data = str(data, encoding, "surrogatepass")
+        elif isinstance(data, memoryview):
+            data = data.tobytes()
+        return Datum, (data, self.format)
+
+    @classmethod
+    def deferred(cls, format_, loader):
+        """Make a Datum that only knows its format. loader() is called for the
+        payload the first time data is used."""
+        datum = cls()
+        datum.format = Format(format_)
+        datum._loader = loader
+        return datum
+
+    @property
+    def data(self):
+        if self._loader is not None:
+            self.materialize()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._loader = None
+        self._set_payload(value)
+
+    @property
+    def view(self):
+        """A read-only memoryview of a binary payload, to slice or hand to
+        anything that takes a buffer without copying it. None if the payload
+        isn't binary."""
+        data = self.data
+        if isinstance(data, bytes):
+            return memoryview(data)
+        if isinstance(data, memoryview):
+            return data
+        return None
+
+    @property
+    def spilled(self):
+        """True if the payload is held in a file rather than in memory."""
+        if self._loader is not None:
+            self.materialize()
+        data = self._data
+        return isinstance(data, memoryview) and isinstance(data.obj, mmap.mmap)
+
+    @property
+    def digest(self):
+        """The digest of the blob the payload is kept in, else None. Blobs
+        hold ASCII CF_TEXT as text, so this is shared with the matching
+        CF_UNICODETEXT; content_digest tells them apart."""
+        if self._loader is not None:
+            self.materialize()
+        return self._blob.digest if self._blob is not None else None
+
+    @property
+    def content_digest(self):
+        """The payload_digest() of data, worked out the first time it's
+        needed and kept. Datums whose data are equal have the same one."""
+        if self._digest is None:
+            data = self.data
+            # fetching a deferred payload may have brought its blob's digest
+            if self._digest is None:
+                self._digest = payload_digest(data)
+        return self._digest
+
+    def _set_payload(self, payload):
+        self._digest = None
+        self._preview = None
+        if isinstance(payload, EncodedImage):
+            # becomes the real payload once the encode is done
+            self._loader = payload
+            payload = None
+        elif frozen_view(payload):
+            # spilled, or a view into an immutable buffer (see clipwire):
+            # frozen already, and too big to be worth copying
+            pass
+        elif isinstance(payload, (bytearray, memoryview)):
+            payload = bytes(payload)
+        elif isinstance(payload, QtCore.QByteArray):
+            payload = payload.data()
+        if self._loader is None:
+            self._preview = payload_preview(payload, self.PREVIEW_LENGTH,
+                                            self._preview_encoding(payload))
+        blob = None
+        if self.store is not None:
+            blob = self.store.acquire(payload, self.format.id in self.BYTE_TEXT_FORMATS)
+        old_blob, self._blob = self._blob, blob
+        if blob is None:
+            self._data = payload
+        elif isinstance(payload, bytes) and isinstance(blob.payload, str):
+            # ASCII CF_TEXT sharing a blob with its unicode twin
+            self._data = blob.encoded
+        else:
+            self._data = blob.payload
+            # the blob's digest is data's content digest, for free
+            self._digest = blob.digest
+        if old_blob is not None:
+            old_blob.store.release(old_blob)
+
+    @classmethod
+    def from_image(cls, image, codec=None, quality=None):
+        """Make a Datum from a QImage with a particular codec (a key of
+        IMAGE_CODECS) and quality, rather than the class defaults."""
+        datum = cls()
+        payload, format_id = datum._encode_qimage(image, codec, quality)
+        datum.format = Format(format_id)
+        datum._set_payload(payload)
+        return datum
+
+    @property
+    def deferred_load(self):
+        """True if the payload hasn't been fetched yet."""
+        return self._loader is not None
+
+    @property
+    def encoding(self):
+        """True while an image payload is still being encoded."""
+        return isinstance(self._loader, EncodedImage) and not self._loader.future.done()
+
+    def materialize(self):
+        """Fetch a deferred payload now, while the clipboard still has it.
+        Does nothing for Datums that already have their data."""
+        if self._loader is not None:
+            payload = self._loader()
+            self._loader = None
+            self._set_payload(payload)
+        return self
 
     def serialize(self, data):
-        if self.data_types is None:
-            self.data_types = {
-                "QImage": self._load_qimage
-            }
         if data is not None:
             data_type = type(data).__name__
-            return self.data_types.get(data_type, self._load_arbitrary)(data)
+            return getattr(self, self.DATA_TYPES.get(data_type, "_load_arbitrary"))(data)
 
     @staticmethod
     def _load_arbitrary(data):
         return data, 13
 
-    @staticmethod
-    def _load_qimage(data):
-        # TODO: support multiple image formats
-        ba = QtCore.QByteArray()
-        buffer = QtCore.QBuffer(ba)
-        buffer.open(QtCore.QIODevice.WriteOnly)
-        data.save(buffer, "PNG")
-        return buffer.data(), 49927
-
-    def string_preview(self, length=80):
-        preview = str(self.data)
-        if len(preview) > length:
-            preview = preview[:length]
-        return preview
+    def _load_qimage(self, data):
+        return self._encode_qimage(data)
+
+    def _encode_qimage(self, image, codec=None, quality=None):
+        image_format, format_id, codec_quality, header = \
+            self.IMAGE_CODECS[codec or self.image_codec]
+        if quality is None:
+            quality = self.image_quality
+        if quality is None:
+            quality = codec_quality
+        if self.image_pool is None:
+            return encode_image(image, image_format, quality, header), format_id
+        # QImage copies share their pixels until one is painted on, so this
+        # is cheap and the caller can carry on using the original
+        future = self.image_pool.submit(
+            encode_image, type(image)(image), image_format, quality, header)
+        return EncodedImage(future), format_id
+
+    def _preview_encoding(self, payload):
+        if isinstance(payload, memoryview) and self.format.id == 13:
+            # spilled CF_UNICODETEXT
+            return "utf-16-le"
+        return None
+
+    def string_preview(self, length=PREVIEW_LENGTH):
+        """The start of the payload as at most length characters. Up to
+        PREVIEW_LENGTH, that's cut from the preview made when the payload was
+        set; longer previews read as much of the payload as they need."""
+        if self._loader is not None:
+            self.materialize()
+        data = self._data
+        if length > self.PREVIEW_LENGTH or self._preview is None:
+            data = self.data
+            return payload_preview(data, length, self._preview_encoding(data))
+        if isinstance(data, str) or self._preview_encoding(data):
+            return self._preview[:length]
+        return shorten_preview(self._preview, length)
 
     def __str__(self):
         return f"<{self.format} '{self.string_preview(40)}'>"
@@ -149,22 +717,264 @@ class Datum:
         return Clip(other) + self
 
     def __eq__(self, other):
+        if other is self:
+            return True
         if isinstance(other, Datum):
-            return self.data == other.data and self.format == other.format
+            if self.format is not other.format and self.format != other.format:
+                return False
+            # digesting a payload costs more than comparing it once, so
+            # digests are only used when both are known
+            mine, theirs = self._digest, other._digest
+            if mine is not None and theirs is not None:
+                return mine == theirs
+            return self.data == other.data
         else:
             return False
 
     def __ne__(self, other):
         return not self == other
 
+    def __hash__(self):
+        return hash((self.format.id, self.content_digest))
+
+
+class Rope:
+    """An immutable sequence that shares structure with the ropes it's made
+    from, so concatenating, slicing, replacing or deleting an item costs
+    O(log n) rather than a copy of the whole sequence.
+
+    A rope is either a leaf holding up to LEAF_SIZE items in a tuple, or a
+    node joining two ropes, kept balanced like an AVL tree: the depths of a
+    node's two sides never differ by more than one.
+    """
+    __slots__ = ("_items", "_left", "_right", "_length", "_depth")
+
+    LEAF_SIZE = 32
+
+    def __new__(cls, items=()):
+        if isinstance(items, Rope):
+            return items
+        items = tuple(items)
+        if len(items) <= cls.LEAF_SIZE:
+            return cls._leaf(items)
+        level = [cls._leaf(items[start:start + cls.LEAF_SIZE])
+                 for start in range(0, len(items), cls.LEAF_SIZE)]
+        while len(level) > 1:
+            level = [level[i] + level[i + 1] if i + 1 < len(level) else level[i]
+                     for i in range(0, len(level), 2)]
+        return level[0]
+
+    @classmethod
+    def _leaf(cls, items):
+        rope = object.__new__(cls)
+        rope._items = items
+        rope._left = rope._right = None
+        rope._length = len(items)
+        rope._depth = 0
+        return rope
+
+    @classmethod
+    def _node(cls, left, right):
+        rope = object.__new__(cls)
+        rope._items = None
+        rope._left = left
+        rope._right = right
+        rope._length = left._length + right._length
+        left, right = left._depth, right._depth
+        rope._depth = (left if left > right else right) + 1
+        return rope
+
+    @classmethod
+    def _balance(cls, left, right):
+        """Join two ropes whose depths differ by at most two, rotating to
+        bring them back within one."""
+        if left._depth > right._depth + 1:
+            if left._left._depth >= left._right._depth:
+                return cls._node(left._left, cls._node(left._right, right))
+            inner = left._right
+            return cls._node(cls._node(left._left, inner._left),
+                             cls._node(inner._right, right))
+        if right._depth > left._depth + 1:
+            if right._right._depth >= right._left._depth:
+                return cls._node(cls._node(left, right._left), right._right)
+            inner = right._left
+            return cls._node(cls._node(left, inner._left),
+                             cls._node(inner._right, right._right))
+        return cls._node(left, right)
+
+    def __add__(self, other):
+        if not isinstance(other, Rope):
+            if not isinstance(other, (list, tuple)):
+                return NotImplemented
+            other = Rope(other)
+        if not other._length:
+            return self
+        if not self._length:
+            return other
+        if self._items is not None:
+            if other._items is not None:
+                if self._length + other._length <= self.LEAF_SIZE:
+                    return self._leaf(self._items + other._items)
+                return self._node(self, other)
+            # a leaf goes all the way down, to join the leaf at the edge
+            return self._balance(self + other._left, other._right)
+        if other._items is not None or self._depth > other._depth + 1:
+            return self._balance(self._left, self._right + other)
+        # walk down the deeper side until the two are close enough to join
+        if other._depth > self._depth + 1:
+            return self._balance(self + other._left, other._right)
+        return self._node(self, other)
+
+    def __radd__(self, other):
+        if not isinstance(other, (list, tuple)):
+            return NotImplemented
+        return Rope(other) + self
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        if self._items is not None:
+            return iter(self._items)
+        return itertools.chain.from_iterable(self._leaves())
+
+    def _leaves(self):
+        stack = [self]
+        while stack:
+            rope = stack.pop()
+            if rope._items is not None:
+                yield rope._items
+            else:
+                stack.append(rope._right)
+                stack.append(rope._left)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._length)
+            if step != 1:
+                return Rope(tuple(self)[key])
+            return self._slice(start, stop)
+        if self._items is not None:
+            return self._items[key]
+        position = range(self._length)[key]
+        rope = self
+        while rope._items is None:
+            if position < rope._left._length:
+                rope = rope._left
+            else:
+                position -= rope._left._length
+                rope = rope._right
+        return rope._items[position]
+
+    def _slice(self, start, stop):
+        if start <= 0 and stop >= self._length:
+            return self
+        if stop <= start:
+            return EMPTY_ROPE
+        if self._items is not None:
+            return self._leaf(self._items[start:stop])
+        split = self._left._length
+        if stop <= split:
+            return self._left._slice(start, stop)
+        if start >= split:
+            return self._right._slice(start - split, stop - split)
+        return self._left._slice(start, split) + self._right._slice(0, stop - split)
+
+    def replace(self, key, item):
+        """A rope with the item at key replaced by item."""
+        position = range(self._length)[key]
+        if self._items is not None:
+            items = list(self._items)
+            items[position] = item
+            return self._leaf(tuple(items))
+        split = self._left._length
+        if position < split:
+            return self._node(self._left.replace(position, item), self._right)
+        return self._node(self._left, self._right.replace(position - split, item))
+
+    def delete(self, key):
+        """A rope without the item, or slice of items, at key."""
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._length)
+            if step != 1:
+                items = list(self)
+                del items[key]
+                return Rope(items)
+            # a slice that ends before it starts is empty, as for a list
+            stop = max(start, stop)
+        else:
+            start = range(self._length)[key]
+            stop = start + 1
+        return self._slice(0, start) + self._slice(stop, self._length)
+
+    def __eq__(self, other):
+        if other is self:
+            return True
+        if isinstance(other, Rope):
+            if self._length != other._length:
+                return False
+            # ropes built the same way split into the same leaves, which can
+            # be compared a tuple at a time
+            for mine, theirs in zip(self._leaves(), other._leaves()):
+                if len(mine) != len(theirs):
+                    return list(self) == list(other)
+                if mine is not theirs and mine != theirs:
+                    return False
+            return True
+        if isinstance(other, (list, tuple)):
+            return self._length == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        return Rope, (tuple(self),)
+
+    def __repr__(self):
+        return f"Rope({list(self)!r})"
+
+
+EMPTY_ROPE = Rope()
+
 
 class Clip:
     """
     This class contains the contents of one (1) clipboard. It is empty on
     init, so typically you'll get it as a return value from Handler functions.
+
+    The Datums are held in a Rope, which is immutable, so clips share them:
+    Clip(other), clip + other and slicing cost O(log n) rather than a copy of
+    the data, and building a clip up by repeated addition isn't quadratic.
+    Assigning or deleting items gives the clip a new version of its Rope,
+    leaving every clip that shared the old one as it was. data is the Rope;
+    assigning a list to it replaces the clip's contents.
+
+    Clip keeps an index of where each format first appears, and the Datum
+    there, so find() only costs a dict lookup per priority. It's built by the
+    first find() and kept up to date from then on by add_data, item
+    assignment and item deletion. Clips that are never searched, like most
+    of a history, never pay for one.
+
+    content_digest sums up every Datum's format and content_digest, in
+    order, so two clips holding the same data have the same one whatever
+    their seq_num; it's a good key for spotting duplicate copies. Clips are
+    equal when their seq_nums and data are, and hash on seq_num and
+    content_digest. Once both clips' digests are known, comparing them only
+    compares the digests.
     """
+    __slots__ = ("seq_num", "_data", "_index", "_digest")
+
     running_id = -1
 
+    # type name of the data: name of the method that adds it
+    DATA_CONTAINERS = {
+        "Datum": "_add_datum",
+        "Clip": "_add_clip",
+        "Rope": "_add_rope",
+        "list": "_add_list",
+    }
+
     def __init__(self, data=None, seq_num=None):
         """
         Create a new clip with data; pass none for an empty clip
@@ -176,9 +986,24 @@ class Clip:
         else:
             self.seq_num = Clip.running_id
             Clip.running_id -= 1
-        self.data = []
-        self.data_containers = None
-        self.add_data(data)
+        self._index = None
+        self._digest = None
+        if isinstance(data, Clip):
+            self._data = data._data
+            self._digest = data._digest
+        else:
+            self._data = EMPTY_ROPE
+            self.add_data(data)
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = Rope(value)
+        self._index = None
+        self._digest = None
 
     def add_data(self, data, list_recursion=False):
         """ append an arbitrary data object to the end of this clip's data.
@@ -187,51 +1012,103 @@ class Clip:
         recurse into itself on individual items. However, it only does this;
         [[1, 2]] will load a single datum with data [1, 2]
         """
-        if self.data_containers is None:
-            self.data_containers = {
-                "Datum": self._add_datum,
-                "Clip": self._add_clip,
-                "list": self._add_list,
-            }
         if data is not None:
             data_type = type(data).__name__
             if data_type == "list" and list_recursion:
                 self._add_arg(data)
             else:
-                self.data_containers.get(data_type, self._add_arg)(data)
+                getattr(self, self.DATA_CONTAINERS.get(data_type, "_add_arg"))(data)
 
     def _add_datum(self, data):
-        self.data += [data]
+        self._add_rope(Rope._leaf((data,)))
 
     def _add_list(self, data):
-        for i in data:
-            self.add_data(i, list_recursion=True)
+        # gather runs of Datums into one Rope, rather than adding a Datum at
+        # a time; clips are added whole so they stay shared
+        run = []
+        for item in data:
+            data_type = type(item).__name__
+            if data_type in ("Clip", "Rope"):
+                self._add_rope(Rope(run))
+                run = []
+                self.add_data(item)
+            elif data_type == "Datum":
+                run.append(item)
+            elif item is not None:
+                run.append(Datum(item))
+        self._add_rope(Rope(run))
 
     def _add_clip(self, data):
-        self.data += data.data
+        self._add_rope(data._data)
+
+    def _add_rope(self, data):
+        index = self._index
+        if index is not None:
+            for position, datum in enumerate(data, len(self._data)):
+                index.setdefault(datum.format.id, (position, datum))
+        self._data += data
+        self._digest = None
 
     def _add_arg(self, data):
-        self.data += [Datum(data)]
+        self._add_datum(Datum(data))
+
+    def _reindex(self):
+        self._index = {}
+        for position, datum in enumerate(self._data):
+            self._index.setdefault(datum.format.id, (position, datum))
+        return self._index
+
+    def _unindex(self, format_id, position):
+        """position no longer holds format_id; point the index at the next
+        datum with that format, if there is one."""
+        if self._index is None or self._index.get(format_id, (None,))[0] != position:
+            return
+        for next_position, datum in enumerate(self._data[position:], position):
+            if datum.format.id == format_id:
+                self._index[format_id] = (next_position, datum)
+                return
+        del self._index[format_id]
 
     def formats(self):
-        return [x.format for x in self.data]
+        return [x.format for x in self._data]
+
+    @property
+    def content_digest(self):
+        """A digest of every Datum's format and content_digest, in order,
+        kept until the clip's data changes. Fetches deferred payloads."""
+        if self._digest is None:
+            digest = hashlib.blake2b(digest_size=16, person=b"clip")
+            for datum in self._data:
+                digest.update((datum.format.id or 0).to_bytes(4, "little"))
+                digest.update(datum.content_digest)
+            self._digest = digest.digest()
+        return self._digest
+
+    def materialize(self):
+        """Fetch every deferred payload in this clip now. Do this before the
+        clipboard moves on if the data is going to be needed later."""
+        for datum in self._data:
+            datum.materialize()
+        return self
 
     def find(self, format_order):
         if format_order is None:
             return Datum()
         if isinstance(format_order, int) or isinstance(format_order, Format):
-            format_order = [format_order]
-        clip_formats = self.formats()
+            format_order = (format_order,)
+        index = self._index
+        if index is None:
+            index = self._reindex()
         for format_ in format_order:
-            # note that Format.__eq__ accepts ints;
-            # this means you can do "13 in <list of Format>
-            if format_ in clip_formats:
-                return self.data[clip_formats.index(format_)]
+            # Formats hash like their id, so ints and Formats both work here
+            entry = index.get(format_)
+            if entry is not None:
+                return entry[1]
         raise LookupError(f"No priority formats in format_order present in clip data!")
 
     def print_all(self):
         print(f"***Clip ID {self.seq_num} with {len(self)} elements:")
-        for i in self.data:
+        for i in self._data:
             print("   " + str(i))
 
     def __str__(self):
@@ -247,223 +1124,889 @@ class Clip:
         return Clip(other) + self
 
     def __eq__(self, other):
-        return self.seq_num == other.seq_num and self.data == other.data
+        if other is self:
+            return True
+        if not isinstance(other, Clip):
+            return NotImplemented
+        if self.seq_num != other.seq_num or len(self) != len(other):
+            return False
+        if self._data is other._data:
+            return True
+        if self._digest is not None and other._digest is not None:
+            return self._digest == other._digest
+        return self._data == other._data
+
+    def __hash__(self):
+        return hash((self.seq_num, self.content_digest))
 
     def __len__(self):
-        return len(self.data)
+        return len(self._data)
+
+    def __reduce__(self):
+        return Clip, (self._data, self.seq_num)
 
     def __setitem__(self, key, value):
+        self._digest = None
         if isinstance(key, slice):
-            self.data[key] = [Datum(i) for i in value]
+            start, stop, step = key.indices(len(self._data))
+            value = Rope([Datum(i) for i in value])
+            if step == 1:
+                self._data = self._data[:start] + value + self._data[max(start, stop):]
+            else:
+                data = list(self._data)
+                data[key] = value
+                self._data = Rope(data)
+            self._index = None
         else:
-            self.data[key] = Datum(value)
+            position = range(len(self._data))[key]
+            old_format = self._data[position].format.id
+            datum = Datum(value)
+            self._data = self._data.replace(position, datum)
+            if self._index is not None:
+                self._unindex(old_format, position)
+                new_format = datum.format.id
+                if self._index.get(new_format, (position,))[0] >= position:
+                    self._index[new_format] = (position, datum)
 
     def __getitem__(self, key):
+        """A Datum, or for a slice a Rope of them, shared with this clip."""
         if len(self) == 0 and key == 0:
             return Datum()
-        return self.data[key]
+        return self._data[key]
 
     def __delitem__(self, key):
-        del self.data[key]
+        self._digest = None
+        if isinstance(key, slice):
+            self._data = self._data.delete(key)
+            self._index = None
+        else:
+            position = range(len(self._data))[key]
+            old_format = self._data[position].format.id
+            self._data = self._data.delete(position)
+            if self._index is not None:
+                for format_id, (first, datum) in self._index.items():
+                    if first > position:
+                        self._index[format_id] = (first - 1, datum)
+                self._unindex(old_format, position)
+
+
+class ClipboardLock:
+    """Hands the clipboard to one thread at a time, in the order they asked.
+
+    When the owner releases with others waiting, ownership passes straight to
+    the one that has waited longest, so a thread that keeps coming back can't
+    starve the rest. acquire() takes a timeout and gives up cleanly when it
+    runs out, and only the owner can release, so the lock never has to be
+    forced open from outside.
+
+    Each caller, named after its thread, gets histograms of how long it
+    waited for the lock and how long it held it, in microseconds, and a count
+    of the times it gave up; see stats().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (thread id, event set when the lock is handed over), oldest first
+        self._waiters = collections.deque()
+        self._owner = None
+        self._owner_name = None
+        self._acquired_at = 0.0
+        self._callers = {}
+
+    def _caller(self, name):
+        caller = self._callers.get(name)
+        if caller is None:
+            caller = self._callers[name] = {
+                "wait": Histogram(), "hold": Histogram(), "timeouts": 0}
+        return caller
+
+    def _take(self, ident, name):
+        self._owner = ident
+        self._owner_name = name
+        self._acquired_at = perf_counter()
+
+    def acquire(self, timeout=None):
+        """Wait up to timeout seconds, or for good if None, for the lock.
+        Returns whether we got it. The lock isn't reentrant: asking for it
+        again from the thread that holds it raises RuntimeError, rather than
+        waiting out the timeout on itself."""
+        start = perf_counter()
+        ident = threading.get_ident()
+        name = threading.current_thread().name
+        with self._lock:
+            caller = self._caller(name)
+            if self._owner is None and not self._waiters:
+                self._take(ident, name)
+                caller["wait"].record_since(start)
+                return True
+            if self._owner == ident:
+                raise RuntimeError("This thread already holds the clipboard lock")
+            if timeout is not None and timeout <= 0:
+                caller["timeouts"] += 1
+                return False
+            turn = (ident, threading.Event())
+            self._waiters.append(turn)
+        handed_over = turn[1].wait(timeout)
+        with self._lock:
+            # the lock may have been handed over just as we timed out
+            if not handed_over and not turn[1].is_set():
+                self._waiters.remove(turn)
+                caller["timeouts"] += 1
+                return False
+            self._owner_name = name
+        caller["wait"].record_since(start)
+        return True
+
+    def try_acquire(self):
+        """Take the lock if it's free and nobody is waiting for it."""
+        if self._owner == threading.get_ident():
+            # only this thread could change that, so no need to lock
+            return False
+        return self.acquire(0)
+
+    def release(self):
+        with self._lock:
+            if self._owner != threading.get_ident():
+                raise RuntimeError("Only the thread holding the clipboard lock "
+                                   "can release it")
+            self._caller(self._owner_name)["hold"].record_since(self._acquired_at)
+            if self._waiters:
+                ident, handed_over = self._waiters.popleft()
+                # the waiter fills in its name when it wakes up
+                self._take(ident, None)
+                handed_over.set()
+            else:
+                self._owner = None
+                self._owner_name = None
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def locked(self):
+        return self._owner is not None
+
+    def stats(self):
+        """For each caller, its wait and hold times and timeout count."""
+        with self._lock:
+            callers = list(self._callers.items())
+        return {name: {"wait_us": caller["wait"].snapshot(),
+                       "hold_us": caller["hold"].snapshot(),
+                       "timeouts": caller["timeouts"]}
+                for name, caller in callers}
 
 
 # module global for a global resource
-cb_mutex = QtCore.QMutex()
+clipboard_lock = ClipboardLock()
+
+
+class SettleTracker:
+    """Learns how long a backend needs after the clipboard is closed before it
+    will open again, instead of sleeping a fixed time after every close.
+
+    Handler asks for wait() before opening and reports how each open went.
+    A denied open that succeeds within `ceiling` seconds of our last close
+    raises the estimate to that gap; an open soon after a close that goes
+    straight through lets it decay, so the estimate keeps being probed. A
+    backend that never needs to settle never waits.
+    """
+    def __init__(self, ceiling=0.05, decay=0.9):
+        self.ceiling = ceiling
+        self.decay = decay
+        self.estimate = 0.0
+        self._closed_at = None
+
+    def closed(self):
+        self._closed_at = perf_counter()
+
+    def wait(self):
+        """Seconds still to wait before opening again."""
+        if not self.estimate or self._closed_at is None:
+            return 0.0
+        return max(0.0, self.estimate - (perf_counter() - self._closed_at))
+
+    def opened(self, denied):
+        """Record an open that succeeded, after being denied at least once
+        or not."""
+        if self._closed_at is None:
+            return
+        gap = perf_counter() - self._closed_at
+        if gap > self.ceiling:
+            # too long after our close to say anything about settling
+            return
+        if denied:
+            self.estimate = max(self.estimate, gap)
+        else:
+            self.estimate *= self.decay
+            if self.estimate < 1e-4:
+                self.estimate = 0.0
 
 
 class Handler:
-    """ Handler provides a contextmanager-type interface to win32clipboard
+    """ Handler provides a contextmanager-type interface to a clipboard backend
     which uses cliphandler data types and has useful utility functions.
 
-    Most references to win32clipboard should be in this class to make changing
-    libraries easier (if necessary), like if we ever want cross-platform support.
+    All clipboard access goes through self.backend (see clipbackend), which is
+    the default backend unless one is passed in.
+
+    How long the clipboard needs between a close and the next open is learned
+    per backend by a SettleTracker shared by every Handler on that backend.
+
+    Opening waits its turn for clipboard_lock and then retries the backend
+    until `timeout` seconds have passed, after which it raises LockTimeout if
+    the lock never came free, or the last AccessDenied if another
+    application kept the clipboard.
+
+    Every operation is timed into `metrics` (clipstats.metrics unless it's
+    replaced), along with per-format payload times, bytes moved, denied opens
+    and time spent waiting for the lock.
+
+    Payloads bigger than spill_threshold bytes (if the backend can tell) are
+    streamed SPILL_CHUNK bytes at a time into a memory-mapped file in
+    spill_dir (the temp directory if None) instead of being read whole, so
+    copying something huge doesn't take as much memory; see Datum.spilled.
+    spill_threshold=None reads everything into memory.
     """
-    # ref http://timgolden.me.uk/pywin32-docs/win32clipboard.html
+    _settle_trackers = weakref.WeakKeyDictionary()
+    TIMEOUT = 1.0  # seconds
+    SPILL_THRESHOLD = 64 * 1024 * 1024  # bytes
+    SPILL_CHUNK = 1024 * 1024  # bytes, even so UTF-16 text stays aligned
+    spill_dir = None
+    metrics = clipstats.metrics
+
     # https://docs.microsoft.com/en-us/windows/win32/dataxchg/clipboard-operations
-    def __init__(self):
+    def __init__(self, backend=None, timeout=TIMEOUT, spill_threshold=SPILL_THRESHOLD):
         logging.info("Initializing clipboard.")
+        self.backend = backend if backend is not None else clipbackend.get_default()
+        self.timeout = timeout
+        self.spill_threshold = spill_threshold
+        self.settle = self._settle_trackers.setdefault(self.backend, SettleTracker())
         self.current_seq = 0
+        self._open_thread = None
+        self._wrote = False
         self.seq()
 
     def write(self, data):
         """Write a piece of data to the clipboard, overwriting the current
         contents."""
-        wc.EmptyClipboard()
+        start = perf_counter()
         if not isinstance(data, Clip):
             data = Clip(data)
+        # deferred payloads are read off the clipboard, so fetch them all
+        # before emptying it; a StaleClipError leaves the clipboard as it was
+        payloads = [(item, item.data) for item in data]
+        self.backend.empty()
         success = False
-        for item in data:
-            if item.data is None:
-                logging.info(f"Skipping None: {item}")
+        for item, payload in payloads:
+            if payload is None:
+                logging.info(f"Skipping None: {item.format}")
                 continue
             try:
-                wc.SetClipboardData(item.format.id, item.data)
+                set_start = perf_counter()
+                self.backend.set_data(item.format.id, payload)
+                self._record_payload("set_data", "bytes_written", item.format.name,
+                                     set_start, payload)
                 success = True
-            except pywintypes.error:
-                error = sys.exc_info()
-                if error[1].strerror == "The handle is invalid.":
-                    logging.warning(f"The handle for {item} is invalid and will be skipped.")
+            except InvalidHandle:
+                logging.warning(f"The handle for {item.format} is invalid and will be skipped.")
+            except ClipboardError:
+                pass
         if not success:
             logging.error(f"Could not write {data} as all data were invalid.")
         self.seq()
-
-    def read(self):
-        """ Read the current contents of the clipboard and return it as a Clip"""
+        # some backends only publish the write on close, which moves the
+        # sequence number again
+        self._wrote = True
+        self.metrics.time("handler.write", start)
+
+    def _record_payload(self, operation, counter, name, start, payload):
+        """Time one format's payload going to or from the backend, and count
+        its size: bytes for binary payloads, characters for text."""
+        metrics = self.metrics
+        metrics.time(f"handler.{operation}.{name}", start)
+        if isinstance(payload, (bytes, bytearray, str)):
+            size = len(payload)
+        elif isinstance(payload, memoryview):
+            size = payload.nbytes
+        else:
+            return
+        metrics.count(counter, size)
+        metrics.count(f"{counter}.{name}", size)
+
+    def read(self, lazy=True, format_order=None, max_bytes=None, oversize="skip"):
+        """ Read the current contents of the clipboard and return it as a Clip.
+
+        If lazy, only the formats are read now and each Datum fetches its
+        payload the first time it's used. That works for as long as the
+        clipboard sequence number stays the same, after which it raises
+        StaleClipError; call Clip.materialize() to hold on to the data past
+        that point.
+
+        format_order narrows the read to the listed formats that are on the
+        clipboard, best first, so clip[0] is what clip.find(format_order) would
+        pick. It takes the same int, Format or list that Clip.find does.
+
+        max_bytes caps the payload size, either one cap for every format or a
+        dict of format id to cap. Payloads over their cap are left out if
+        oversize is "skip", or cut down to the cap if it's "truncate". Formats
+        whose size the backend can't tell are only ever truncated, and
+        payloads that aren't text or bytes are never cut."""
+        if oversize not in ("skip", "truncate"):
+            raise ValueError(f"oversize must be 'skip' or 'truncate', not {oversize}")
+        start = perf_counter()
         clip = Clip(seq_num=self.seq())
-        for format_ in self._get_all_formats():
-            clip.add_data(self._read_single(format_))
+        for format_ in self._select_formats(format_order):
+            cap = max_bytes.get(format_) if isinstance(max_bytes, dict) else max_bytes
+            if cap is not None:
+                size = self.backend.data_size(format_)
+                if size is not None and size <= cap:
+                    cap = None
+                elif size is not None and oversize == "skip":
+                    logging.info(f"Skipping {Format(format_, self.backend)}: "
+                                 f"{size} bytes is over the {cap} byte cap")
+                    continue
+            if lazy:
+                clip.add_data(self._defer_single(format_, clip.seq_num, cap))
+            else:
+                clip.add_data(self._read_single(format_, cap))
+        self.metrics.time("handler.read", start)
         return clip
 
-    @staticmethod
-    def _get_all_formats():
+    def _select_formats(self, format_order):
+        all_formats = self._get_all_formats()
+        if format_order is None:
+            return all_formats
+        if isinstance(format_order, int) or isinstance(format_order, Format):
+            format_order = [format_order]
+        # Format.__eq__ accepts ints, same as in Clip.find
+        return [x.id if isinstance(x, Format) else x
+                for x in format_order if x in all_formats]
+
+    def _get_all_formats(self):
         """ Read all data formats currently on the clipboard.
         Returns as a list of ints"""
-        all_formats = []
-        current_format = 0
-        while wc.EnumClipboardFormats(current_format) != 0:
-            current_format = wc.EnumClipboardFormats(current_format)
-            all_formats.append(current_format)
-        return all_formats
+        start = perf_counter()
+        formats = self.backend.enum_formats()
+        self.metrics.time("handler.formats", start)
+        return formats
 
-    @staticmethod
-    def _read_single(format_):
+    def _read_single(self, format_, cap=None):
         if isinstance(format_, Format):
             format_ = format_.id
         if format_ == 3:  # CF_METAFILEPICT NOT SUPPORTED BY win32clipboard
             logging.warning("CF_METAFILEPICT not supported by win32clipboard! Returning None")
             return Datum()
+        start = perf_counter()
         try:
-            data = wc.GetClipboardData(format_)
-            return Datum(data, format_)
-        except TypeError:
+            data = self._get_data(format_, cap)
+            return Datum(data, Format(format_, self.backend))
+        except FormatUnavailable:
             logging.warning(f"CLIPBOARD FORMAT UNAVAILABLE: "
-                            f"{Format.translate_format(format_)}")
+                            f"{Format.translate_format(format_, self.backend)}")
+            return Datum()
+        finally:
+            self.metrics.time("handler.read_single", start)
+
+    def _defer_single(self, format_, seq_num, cap=None):
+        if format_ == 3:  # CF_METAFILEPICT NOT SUPPORTED BY win32clipboard
+            logging.warning("CF_METAFILEPICT not supported by win32clipboard! Returning None")
             return Datum()
+        return Datum.deferred(Format(format_, self.backend),
+                              DeferredRead(self, format_, seq_num, cap))
+
+    def _get_data(self, format_, cap=None):
+        start = perf_counter()
+        if cap is not None:
+            data = self.backend.get_data_prefix(format_, cap)
+        elif self._should_spill(format_):
+            data = spill(self.backend.read_chunks(format_, self.SPILL_CHUNK), self.spill_dir)
+            self.metrics.count("spilled")
+        else:
+            data = self.backend.get_data(format_)
+        self._record_payload("get_data", "bytes_read", Format(format_, self.backend).name,
+                             start, data)
+        return data
+
+    def _should_spill(self, format_):
+        # CF_HDROP comes back from win32clipboard as a tuple of paths, which
+        # can't be streamed
+        if self.spill_threshold is None or format_ == 15:
+            return False
+        size = self.backend.data_size(format_)
+        return size is not None and size > self.spill_threshold
+
+    def fetch(self, format_, seq_num, cap=None):
+        """Read the payload of one format for a deferred Datum, opening the
+        clipboard unless this thread already has it open. Raises
+        StaleClipError if the clipboard has changed since seq_num."""
+        if self._open_thread == threading.get_ident():
+            return self._fetch(format_, seq_num, cap)
+        with self:
+            return self._fetch(format_, seq_num, cap)
+
+    def _fetch(self, format_, seq_num, cap):
+        if self.peek_seq() != seq_num:
+            raise StaleClipError(f"Clipboard changed since {seq_num}, can't read "
+                                 f"{Format.translate_format(format_, self.backend)}")
+        try:
+            return self._get_data(format_, cap)
+        except FormatUnavailable:
+            logging.warning(f"CLIPBOARD FORMAT UNAVAILABLE: "
+                            f"{Format.translate_format(format_, self.backend)}")
+            return None
 
     def clear(self):
         """Empties the contents of the current clipboard."""
-        wc.EmptyClipboard()
+        self.backend.empty()
         self.seq()
 
     def seq(self):
         """Reads the current clipboard sequence number and updates the internal
         seq variable."""
-        self.current_seq = wc.GetClipboardSequenceNumber()
+        start = perf_counter()
+        self.current_seq = self.peek_seq()
+        self.metrics.time("handler.seq", start)
         return self.current_seq
 
+    def peek_seq(self):
+        """Reads the current clipboard sequence number without updating the
+        internal seq variable, so the change is still pending for Monitor."""
+        return self.backend.seq()
+
     def __enter__(self):
-        try_count = 0
-        while try_count < 100:
-            if cb_mutex.tryLock(10):
-                try:
-                    wc.OpenClipboard()
-                    return self
-                except pywintypes.error as e:
-                    # do some wrangling to try to get the clipboard open
-                    if e.strerror == "Access is denied.":
-                        logging.warn(f"Clipboard access is denied.")
-                        # try:
-                        #     wc.CloseClipboard()
-                        #     sleep(0.005)
-                        # except pywintypes.error as e2:
-                        #     if e2.strerror != "Thread does not have a clipboard open":
-                        #         raise e2
-                        cb_mutex.unlock()
-                    else:
-                        raise e
-            else:
-                try_count += 1
-        raise RuntimeError("Cannot get clipboard mutex lock!")
+        start = perf_counter()
+        deadline = start + self.timeout
+        denied = False
+        retry_wait = max(self.settle.estimate, 0.001)
+        metrics = self.metrics
+        while True:
+            lock_start = perf_counter()
+            got_lock = clipboard_lock.acquire(max(0.0, deadline - lock_start))
+            metrics.time("handler.lock_wait", lock_start)
+            if not got_lock:
+                metrics.count("lock_timeouts")
+                raise LockTimeout(f"Could not get the clipboard lock within "
+                                  f"{self.timeout} s")
+            try:
+                wait = self.settle.wait()
+                if wait:
+                    sleep(wait)
+                self.backend.open()
+                self.settle.opened(denied)
+                self._open_thread = threading.get_ident()
+                metrics.time("handler.open", start)
+                return self
+            except AccessDenied:
+                # someone else has it, or it hasn't settled since our close;
+                # let whoever is queued for the lock go first meanwhile
+                logging.warning(f"Clipboard access is denied.")
+                metrics.count("open_retries")
+                denied = True
+                clipboard_lock.release()
+                if perf_counter() + retry_wait > deadline:
+                    raise
+                sleep(retry_wait)
+                retry_wait = min(retry_wait * 2, self.settle.ceiling)
+            except ClipboardError:
+                clipboard_lock.release()
+                raise
 
     def __exit__(self, exception_type=None, exception_value=None, traceback=None):
         # ref http://effbot.org/zone/python-with-statement.htm
         if exception_type:
             print(f"Exception found! {exception_type} {exception_value} {traceback}")
 
+        self._open_thread = None
+        start = perf_counter()
         try:
-            wc.CloseClipboard()
-            sleep(0.005)
-            cb_mutex.unlock()
-        except pywintypes.error as e:
-            if e.strerror == "Thread does not have a clipboard open.":
-                logging.warning("Could not close clipboard, "
-                                "thread does not have a clipboard open.")
-            else:
-                raise e
+            self.backend.close()
+            self.settle.closed()
+            if self._wrote:
+                self.seq()
+        except NotOpen:
+            logging.warning("Could not close clipboard, "
+                            "thread does not have a clipboard open.")
+        finally:
+            self._wrote = False
+            clipboard_lock.release()
+            self.metrics.time("handler.close", start)
+
+
+class DeferredRead:
+    """The loader behind a deferred Datum: reads one format from the
+    clipboard the first time it's called and hands back the same payload
+    after that, so copies of the Datum share one read. If cap is set only
+    that many bytes are read."""
+    def __init__(self, handler, format_id, seq_num, cap=None):
+        self.handler = handler
+        self.format_id = format_id
+        self.seq_num = seq_num
+        self.cap = cap
+        self.done = False
+        self.payload = None
+
+    def __call__(self):
+        if not self.done:
+            self.payload = self.handler.fetch(self.format_id, self.seq_num, self.cap)
+            self.done = True
+        return self.payload
+
+
+class PollScheduler:
+    """Decides how long Monitor waits between clipboard polls.
+
+    Right after a change it polls every `floor` ms, since copies tend to come
+    in bursts. Every poll that finds nothing new multiplies the wait by
+    `backoff`, up to `ceiling` ms, so an idle clipboard costs a handful of
+    wakeups a second instead of a core.
+    """
+    def __init__(self, floor=10, ceiling=500, backoff=2.0):
+        if floor < 1 or ceiling < floor:
+            raise ValueError(f"Need 1 <= floor <= ceiling, got floor {floor} "
+                             f"and ceiling {ceiling}")
+        if backoff < 1:
+            raise ValueError(f"Backoff must be at least 1, got {backoff}")
+        self.floor = floor
+        self.ceiling = ceiling
+        self.backoff = backoff
+        self.interval = floor
+
+    def changed(self):
+        """The last poll found a change; go back to polling fast.
+        Returns the next interval in ms."""
+        self.interval = self.floor
+        return self.interval
+
+    def idle(self):
+        """The last poll found nothing; back off. Returns the next interval in ms."""
+        self.interval = min(self.ceiling, self.interval * self.backoff)
+        return int(self.interval)
+
+    @staticmethod
+    def contended():
+        """The last poll couldn't get the clipboard; retry straight away
+        without touching the backoff, since Handler already waited."""
+        return 0
+
+    def worst_case_latency(self, check_time=0):
+        """The longest a change can go unnoticed, in ms: a full ceiling wait
+        plus however long a single check takes."""
+        return self.ceiling + check_time
+
+
+class WriteQueue(QtCore.QObject):
+    """Writes clips to the clipboard on a thread of its own, so whoever asks
+    for a write never waits on the clipboard lock or on another application
+    holding the clipboard open.
+
+    The clipboard only holds one clip, so a new write makes every pending
+    write of the same or lower priority pointless; those are dropped and
+    reported as superseded. Pending writes of a higher priority stay ahead of
+    it, so the most recent write is always the one left on the clipboard.
+
+    finished(clip, status) is emitted once for every clip put, with status
+    "written", "superseded" or "failed". stats() has the queue depth, the
+    counts, and histograms of how long writes waited in the queue and how
+    long they took, in microseconds.
+    """
+    finished = Signal(Clip, str)
+
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+
+    def __init__(self, handler, parent=None):
+        super().__init__(parent)
+        self.handler = handler
+        # (priority, clip, time put), highest priority first
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._busy = False
+        self._closing = False
+        self.max_depth = 0
+        self.counts = {"put": 0, "written": 0, "superseded": 0, "failed": 0}
+        self.wait_times = Histogram()
+        self.write_times = Histogram()
+
+    def put(self, clip, priority=NORMAL):
+        """Queue clip to be written, dropping any pending write it makes
+        pointless."""
+        with self._condition:
+            kept = [entry for entry in self._pending if entry[0] > priority]
+            superseded = [entry[1] for entry in self._pending if entry[0] <= priority]
+            kept.append((priority, clip, perf_counter()))
+            self._pending = kept
+            self.counts["put"] += 1
+            self.counts["superseded"] += len(superseded)
+            self.max_depth = max(self.max_depth, len(kept))
+            if self._thread is None:
+                self._closing = False
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name="clipboard writer")
+                self._thread.start()
+            self._condition.notify()
+        for old_clip in superseded:
+            self.finished.emit(old_clip, "superseded")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closing:
+                    self._condition.wait()
+                if not self._pending:
+                    self._thread = None
+                    return
+                _, clip, put_at = self._pending.pop(0)
+                self._busy = True
+            start = self.wait_times.record_since(put_at)
+            status = "failed"
+            try:
+                with self.handler:
+                    self.handler.write(clip)
+                status = "written"
+            except Exception as e:
+                # anything, so one bad payload can't stop the writer thread;
+                # str(clip) could fetch a stale payload and raise again
+                logging.error(f"Could not write clip {clip.seq_num} to the clipboard: "
+                              f"{type(e).__name__}: {e}")
+            finally:
+                self.write_times.record_since(start)
+                self.finished.emit(clip, status)
+                with self._condition:
+                    self._busy = False
+                    self.counts[status] += 1
+                    self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until every pending write is done and its finished signal
+        sent. Returns False if timeout seconds ran out first."""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._pending and not self._busy, timeout)
+
+    def close(self, timeout=None):
+        """Finish the pending writes and stop the writer thread. Putting
+        another clip starts it again."""
+        with self._condition:
+            thread = self._thread
+            self._closing = True
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join(timeout)
+
+    @property
+    def depth(self):
+        """Writes waiting, not counting one in progress."""
+        return len(self._pending)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            **self.counts,
+            "wait_us": self.wait_times.snapshot(),
+            "write_us": self.write_times.snapshot(),
+        }
 
 
 class Monitor(QtCore.QObject):
     """The top level clipboard handler class. Runs as its own thread, accepts
     events in and out to read/write/set.
+
+    With a notifier, Monitor checks the clipboard when the notifier says it
+    changed and only polls every FALLBACK_INTERVAL ms in case a notification
+    was missed. It uses the handler's backend's notifier unless it's given
+    one; if the backend can't notify, or notifier is False, it polls on the
+    schedule set by its PollScheduler.
+
+    Applications often set the clipboard several times in a row (empty it,
+    add text, add rich formats), so a change isn't read until the sequence
+    number has held still for `coalesce` ms, or `coalesce_limit` ms after the
+    burst began, whichever is first. coalesce=0 reads every change right
+    away. coalesce_stats counts the reads, the intermediate states a burst
+    went through that were seen and never read, and how long reads were
+    held back. A single copy of several formats bumps the sequence number
+    once per format, so the sequence numbers themselves can't tell states
+    apart.
+
+    load() hands clips to a WriteQueue and returns straight away; how each
+    one went comes back through load_finished.
     TODO: (bind to Clip objects when they're created??)
     """
     clipboard_updated = Signal()
     new_card_from_clipboard = Signal(Clip)
-
-    def __init__(self):
+    load_finished = Signal(Clip, str)
+
+    FALLBACK_INTERVAL = 1000  # ms, safety poll when there is a notifier
+    CHECK_TIME = 0  # ms, check_seq neither locks nor sleeps
+    COALESCE_WINDOW = 20  # ms the sequence number must hold still before a read
+    COALESCE_LIMIT = 200  # ms, the longest a burst can hold a read back
+
+    def __init__(self, notifier=None, handler=None, scheduler=None, lazy=False,
+                 format_order=None, max_bytes=None, coalesce=COALESCE_WINDOW,
+                 coalesce_limit=COALESCE_LIMIT):
+        """lazy, format_order and max_bytes are passed on to Handler.read.
+        Clips are read eagerly by default, since cards outlive the clipboard
+        contents they came from; lazy clips only stay readable until the
+        clipboard changes unless someone materializes them."""
         super().__init__()
         # if thread is None:
         #     thread = QtCore.QThread()
         # self.thread = thread
-        self.handler = Handler()
+        self.handler = handler if handler is not None else Handler()
+        if notifier is None:
+            notifier = self.handler.backend.notifier()
+        elif notifier is False:
+            notifier = None
+        self.notifier = notifier
+        self.lazy = lazy
+        self.format_order = format_order
+        self.max_bytes = max_bytes
+        self.scheduler = scheduler if scheduler is not None else PollScheduler()
         self.timer = None
         self.try_count = 0
+        self.coalesce = coalesce
+        self.coalesce_limit = coalesce_limit
+        # [first change seen, last change seen, last seq seen, states seen] of a burst
+        self._burst = None
+        self.coalesce_stats = {
+            "reads": 0,
+            "states_skipped": 0,
+            "max_states_skipped": 0,
+            "held_ms": 0.0,
+            "max_held_ms": 0.0,
+        }
+        self.write_queue = WriteQueue(self.handler, self)
+        self.write_queue.finished.connect(self.load_finished)
 
     @Slot()
     def check_clipboard(self):
-        if self.check_seq():
-            self.clipboard_updated.emit()
+        changed = self.check_seq()
+        if changed:
+            wait = self._hold_for_burst()
+            if wait:
+                self._schedule(changed, wait)
+                return
             try:
+                new_clip = None
                 with self.handler:
-                    new_clip = self.handler.read()
-                self.new_card_from_clipboard.emit(new_clip)
-            except RuntimeError as e:
-                if str(e) == "Cannot get clipboard mutex lock!":
-                    self._reset_clipboard_lock()
-                    # should attempt again because handler.seq hasn't been
-                    # updated since read would have failed.
+                    # the change may have been a write of our own that
+                    # finished while we waited for the lock
+                    if self.check_seq():
+                        new_clip = self.handler.read(lazy=self.lazy,
+                                                     format_order=self.format_order,
+                                                     max_bytes=self.max_bytes)
+                self.try_count = 0
+                if new_clip is not None:
+                    self._count_read(new_clip.seq_num)
+                    self.clipboard_updated.emit()
+                    self.new_card_from_clipboard.emit(new_clip)
+                else:
+                    self._burst = None
+            except (AccessDenied, LockTimeout):
+                # another application or thread is holding the clipboard; try
+                # again, since handler.seq hasn't moved past the change
+                self.try_count += 1
+        else:
+            # a burst that turned out to be our own write
+            self._burst = None
+        self._schedule(changed)
 
     def check_seq(self):
-        if cb_mutex.tryLock(10):
-            self.try_count = 0
-            new_seq = wc.GetClipboardSequenceNumber()
-            sleep(0.005)
-            cb_mutex.unlock()
-            return new_seq != self.handler.current_seq
-        if self.try_count < 500:
-            self.try_count += 1
-            # self.thread.yieldCurrentThread()
+        """True if the clipboard changed since the handler last looked. The
+        sequence number can be read without opening the clipboard, so this
+        takes no lock and never waits on anyone else."""
+        return self.handler.peek_seq() != self.handler.current_seq
+
+    def _hold_for_burst(self):
+        """Track a burst of changes, and return how many ms longer to hold off
+        reading it, or 0 to read now."""
+        if not self.coalesce:
+            return 0
+        now = perf_counter()
+        seq = self.handler.peek_seq()
+        if self._burst is None:
+            self._burst = [now, now, seq, 1]
+        elif seq != self._burst[2]:
+            self._burst[1:] = [now, seq, self._burst[3] + 1]
+        first, last = self._burst[:2]
+        quiet = (now - last) * 1000
+        age = (now - first) * 1000
+        if quiet >= self.coalesce or age >= self.coalesce_limit:
+            return 0
+        return min(self.coalesce - quiet, self.coalesce_limit - age)
+
+    def _count_read(self, seq):
+        held = 0.0
+        states_skipped = 0
+        if self._burst is not None:
+            first, _, last_seq, seen = self._burst
+            held = (perf_counter() - first) * 1000
+            # every state the burst was seen in, bar the one read
+            states_skipped = seen - (last_seq == seq)
+            self._burst = None
+        stats = self.coalesce_stats
+        stats["reads"] += 1
+        stats["states_skipped"] += states_skipped
+        stats["max_states_skipped"] = max(stats["max_states_skipped"], states_skipped)
+        stats["held_ms"] += held
+        stats["max_held_ms"] = max(stats["max_held_ms"], held)
+
+    def worst_case_latency(self):
+        """The longest a clipboard change can go unnoticed, in ms, even if a
+        notification goes missing, assuming the lock isn't held against us.
+        A burst that never stops can hold the read back coalesce_limit more."""
+        held = self.coalesce_limit if self.coalesce else 0
+        if self.notifier is not None:
+            return self.FALLBACK_INTERVAL + self.CHECK_TIME + held
+        return self.scheduler.worst_case_latency(self.CHECK_TIME) + held
+
+    def _schedule(self, changed, wait=None):
+        """Pick the next poll interval. A burst being coalesced is checked
+        again when its window is up, and contention retries right away,
+        since a change may still be unread; otherwise a notified Monitor drops
+        back to the slow fallback poll and a polling one asks its scheduler."""
+        if self.timer is None:
+            return
+        if wait is not None:
+            interval = max(1, math.ceil(wait))
+        elif self.try_count > 0:
+            interval = self.scheduler.contended()
+        elif self.notifier is not None:
+            interval = self.FALLBACK_INTERVAL
+        elif changed:
+            interval = self.scheduler.changed()
         else:
-            self._reset_clipboard_lock()
-            self.try_count = 0
-        return False
-
-    def _reset_clipboard_lock(self):
-        # DANGEROUS MAYBE
-        logging.error("Clipboard mutex hung and must be force reset")
-        try:
-            wc.CloseClipboard()
-        except pywintypes.error:
-            pass
-        cb_mutex.unlock()
+            interval = self.scheduler.idle()
+        if self.timer.interval() != interval:
+            self.timer.setInterval(interval)
 
     @Slot()
-    def load(self, clip):
-        with self.handler:
-            self.handler.write(clip)
+    def load(self, clip, priority=WriteQueue.NORMAL):
+        self.write_queue.put(clip, priority)
 
     @Slot()
     def begin(self):
         # self.thread.start()
         # self.moveToThread(self.thread)
+        if threading.current_thread() is not threading.main_thread():
+            # so clipboard_lock.stats() can tell our reads apart
+            threading.current_thread().name = "clipboard monitor"
         self.timer = QtCore.QTimer()
-        self.timer.setInterval(0)
         self.timer.timeout.connect(self.check_clipboard)
+        if self.notifier is None:
+            self.timer.setInterval(self.scheduler.floor)
+        else:
+            self.notifier.seq_changed.connect(self.check_clipboard)
+            self.timer.setInterval(self.FALLBACK_INTERVAL)
         self.timer.start()
 
     @Slot()
     def end(self):
         self.timer.stop()
+        self.write_queue.close()
+        if self.notifier is not None:
+            self.notifier.seq_changed.disconnect(self.check_clipboard)
         # self.thread.quit()
         # self.thread.wait()
 
@@ -0,0 +1,275 @@
+"""This module keeps the clip history on disk.
+
+A history directory holds:
+- entries.bin: one fixed-size record per clip (sequence number, where its
+    datum records start, how many there are)
+- index.bin: one fixed-size record per datum (format, payload kind, and where
+    the payload lives)
+- payloads-NNNN.seg: the payloads themselves, appended back to back in
+    segments that are memory-mapped for reading
+- formats.json: names of the registered formats used, since registered ids
+    change between Windows sessions. Records store an id of the history's
+    own for each name, from REGISTERED_BASE up, so an id Windows hands to a
+    different format in a later session can't be confused with it.
+
+Everything is append-only. A clip is written payloads first, then its datum
+records, then its entry, so a crash part way through leaves a history that
+simply ends one clip earlier.
+
+Opening a history only reads the two index files, which are kept as raw bytes
+and unpacked on demand, plus previews of the most recent clips. Payloads are
+read when a loaded clip's data is first used. The target is a cold start
+under 250 ms for a 50k-clip history; benchmarks/bench_history.py checks it.
+
+slots caught:
+append(Clip) (connect to Monitor.new_card_from_clipboard)
+"""
+
+import os
+import json
+import mmap
+import struct
+import logging
+import threading
+
+from PySide2 import QtCore
+
+import clipbackend
+from cliphandler import Clip, Datum, Format, StaleClipError, payload_preview, \
+    encode_payload, decode_payload, PAYLOAD_NONE, PAYLOAD_STR, PAYLOAD_BYTES, PAYLOAD_UTF16
+
+
+class HistoryStore:
+    """An on-disk, append-only history of Clips. See the module docstring
+    for the layout."""
+    # seq_num, first datum record, datum record count
+    ENTRY = struct.Struct("<qII")
+    # format id, payload kind (see cliphandler.encode_payload), segment,
+    # offset, length
+    RECORD = struct.Struct("<IBxHQQ")
+    # above any id Windows registers, so they don't clash with ids stored
+    # by histories written before names got ids of their own
+    REGISTERED_BASE = 0x10000
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    PREVIEW_LENGTH = 80
+
+    def __init__(self, path, preview_count=50, backend=None,
+                 segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.backend = backend if backend is not None else clipbackend.get_default()
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._formats = {}
+        os.makedirs(path, exist_ok=True)
+
+        self._entries = self._load_table("entries.bin", self.ENTRY.size)
+        record_count = 0
+        if self._entries:
+            _, first, count = self.ENTRY.unpack_from(self._entries, len(self._entries) - self.ENTRY.size)
+            record_count = first + count
+        self._records = self._load_table("index.bin", self.RECORD.size, record_count)
+        self._names = {}
+        names_path = os.path.join(path, "formats.json")
+        if os.path.exists(names_path):
+            with open(names_path) as names_file:
+                self._names = {int(k): v for k, v in json.load(names_file).items()}
+        self._name_ids = {name: stored_id for stored_id, name in self._names.items()}
+
+        self._segment = 0
+        while os.path.exists(self._segment_path(self._segment + 1)):
+            self._segment += 1
+        self._entries_file = open(os.path.join(path, "entries.bin"), "ab")
+        self._records_file = open(os.path.join(path, "index.bin"), "ab")
+        self._segment_file = open(self._segment_path(self._segment), "ab")
+
+        self.previews = {number: self.preview(number)
+                         for number in range(max(0, len(self) - preview_count), len(self))}
+
+    def _load_table(self, name, record_size, expected=None):
+        """Read one of the index files, dropping a torn record at the end, or
+        records past the last complete entry."""
+        table_path = os.path.join(self.path, name)
+        if not os.path.exists(table_path):
+            return bytearray()
+        with open(table_path, "rb") as table_file:
+            table = bytearray(table_file.read())
+        keep = len(table) // record_size
+        if expected is not None:
+            keep = min(keep, expected)
+        if keep * record_size != len(table):
+            logging.warning(f"Dropping an incomplete write from the end of {table_path}")
+            del table[keep * record_size:]
+            with open(table_path, "r+b") as table_file:
+                table_file.truncate(len(table))
+        return table
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f"payloads-{segment:04}.seg")
+
+    def __len__(self):
+        return len(self._entries) // self.ENTRY.size
+
+    @QtCore.Slot(Clip)
+    def append(self, clip):
+        """Add a clip to the end of the history and return its entry number.
+        Deferred payloads are fetched now; any the clipboard no longer has
+        are stored as None."""
+        with self._lock:
+            records = bytearray()
+            for datum in clip.data:
+                try:
+                    data = datum.data
+                except StaleClipError:
+                    logging.warning(f"{datum.format} changed before it could be saved")
+                    data = None
+                kind, payload = encode_payload(data, datum.format.id)
+                segment, offset = self._write_payload(payload)
+                records += self.RECORD.pack(self._format_id(datum.format), kind,
+                                            segment, offset, len(payload))
+            self._segment_file.flush()
+            first = len(self._records) // self.RECORD.size
+            self._records_file.write(records)
+            self._records_file.flush()
+            self._records += records
+            entry = self.ENTRY.pack(clip.seq_num, first, len(clip.data))
+            self._entries_file.write(entry)
+            self._entries_file.flush()
+            self._entries += entry
+            return len(self) - 1
+
+    @staticmethod
+    def _decode(kind, payload):
+        # spilled text loads back spilled, as a view of the segment; other
+        # payloads are copied, so they don't keep the segment mapped
+        return decode_payload(kind, payload, keep_views=kind == PAYLOAD_UTF16)
+
+    def _write_payload(self, payload):
+        offset = self._segment_file.tell()
+        if offset and offset + len(payload) > self.segment_size:
+            self._segment_file.close()
+            self._segment += 1
+            self._segment_file = open(self._segment_path(self._segment), "ab")
+            offset = 0
+        self._segment_file.write(payload)
+        return self._segment, offset
+
+    def _format_id(self, format_):
+        """The id a record stores for format_: standard ids as they are, and
+        for registered formats, the id this history keeps for the name."""
+        if format_.id is None or format_.id in Format.STANDARD_FORMATS:
+            return format_.id or 0
+        name = format_.name
+        if name not in self._name_ids:
+            stored_id = max([self.REGISTERED_BASE - 1, *self._names]) + 1
+            self._names[stored_id] = name
+            self._name_ids[name] = stored_id
+            names_path = os.path.join(self.path, "formats.json")
+            with open(names_path + ".tmp", "w") as names_file:
+                json.dump(self._names, names_file)
+            os.replace(names_path + ".tmp", names_path)
+        return self._name_ids[name]
+
+    def _format(self, stored_id):
+        """The Format this session uses for a stored format id."""
+        if stored_id not in self._formats:
+            if stored_id == 0 or stored_id in Format.STANDARD_FORMATS:
+                self._formats[stored_id] = Format(stored_id)
+            else:
+                format_id = self.backend.register_format(self._names[stored_id])
+                self._formats[stored_id] = Format(format_id, self.backend)
+        return self._formats[stored_id]
+
+    def _records_of(self, number):
+        if not 0 <= number < len(self):
+            raise IndexError(f"History has no entry {number}")
+        seq_num, first, count = self.ENTRY.unpack_from(self._entries, number * self.ENTRY.size)
+        return seq_num, [self.RECORD.unpack_from(self._records, (first + i) * self.RECORD.size)
+                         for i in range(count)]
+
+    def _view(self, segment, offset, length):
+        """A memoryview of part of a payload segment, mapping (or remapping,
+        if it has grown) the segment as needed."""
+        if length == 0:
+            return memoryview(b"")
+        segment_map = self._maps.get(segment)
+        if segment_map is None or offset + length > len(segment_map):
+            if segment == self._segment:
+                self._segment_file.flush()
+            with open(self._segment_path(segment), "rb") as segment_file:
+                segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = segment_map
+        return memoryview(segment_map)[offset:offset + length]
+
+    def seq_num(self, number):
+        return self.ENTRY.unpack_from(self._entries, number * self.ENTRY.size)[0]
+
+    def formats(self, number):
+        """The Formats of one entry, without touching its payloads."""
+        return [self._format(record[0]) for record in self._records_of(number)[1]]
+
+    def load(self, number):
+        """Returns one entry as a Clip whose Datums read their payloads from
+        disk the first time they're used."""
+        seq_num, records = self._records_of(number)
+        clip = Clip(seq_num=seq_num)
+        for format_id, kind, segment, offset, length in records:
+            if kind == PAYLOAD_NONE:
+                clip.add_data(Datum.deferred(self._format(format_id), lambda: None))
+                continue
+            clip.add_data(Datum.deferred(
+                self._format(format_id),
+                PayloadRead(self, kind, segment, offset, length)))
+        return clip
+
+    def preview(self, number, length=PREVIEW_LENGTH):
+        """A short string for one entry, read from the first text payload (or
+        the first payload, if there's no text) without loading the rest."""
+        records = self._records_of(number)[1]
+        if not records:
+            return ""
+        texts = [record for record in records
+                 if record[1] in (PAYLOAD_STR, PAYLOAD_UTF16)]
+        _, kind, segment, offset, size = texts[0] if texts else records[0]
+        if kind in (PAYLOAD_STR, PAYLOAD_UTF16):
+            # a character is at most 4 bytes of UTF-8 or UTF-16
+            head = self._view(segment, offset, min(size, length * 4))
+            return payload_preview(head, length,
+                                   "utf-8" if kind == PAYLOAD_STR else "utf-16-le")
+        if kind == PAYLOAD_BYTES:
+            return payload_preview(self._view(segment, offset, min(size, length)), length)
+        return payload_preview(self._decode(kind, self._view(segment, offset, size)), length)
+
+    def close(self):
+        with self._lock:
+            for handle in (self._entries_file, self._records_file, self._segment_file):
+                handle.close()
+            for segment_map in self._maps.values():
+                try:
+                    segment_map.close()
+                except BufferError:
+                    # a loaded UTF-16 payload still views it; the mapping
+                    # goes when the last of those does
+                    pass
+            self._maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type=None, exception_value=None, traceback=None):
+        self.close()
+
+
+class PayloadRead:
+    """The loader behind a Datum loaded from history: decodes its payload
+    from the segment the first time it's called."""
+    def __init__(self, store, kind, segment, offset, length):
+        self.store = store
+        self.kind = kind
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+    def __call__(self):
+        view = self.store._view(self.segment, self.offset, self.length)
+        return self.store._decode(self.kind, view)
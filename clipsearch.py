@@ -0,0 +1,199 @@
+"""This module keeps a full-text index of captured clips, so history can be
+searched while the user is still typing.
+
+Each clip's text (the first of CF_UNICODETEXT, CF_TEXT or CF_OEMTEXT it has)
+is casefolded, capped at MAX_TEXT characters, and added to two inverted
+indexes:
+- trigrams: every three-character run, for substring queries
+- tokens: every word, kept in a sorted vocabulary for prefix queries (new
+    words are merged in on the next prefix query)
+
+Posting lists are arrays of document numbers, which only ever grow at the end,
+so they stay sorted and adding a clip never rewrites the index. Queries walk
+the rarest posting list newest first and check each candidate against its
+text, stopping once they have enough results.
+
+slots caught:
+add(Clip) (connect to Monitor.new_card_from_clipboard)
+"""
+
+import re
+import bisect
+import logging
+from array import array
+
+from PySide2 import QtCore
+
+from cliphandler import Clip, StaleClipError
+
+
+class SearchIndex:
+    """An incrementally maintained token and trigram index over clip text.
+    Results come back as the keys clips were added with, newest first."""
+    TEXT_FORMATS = (13, 1, 7)
+    MAX_TEXT = 4096
+    TOKEN = re.compile(r"\w+")
+    # a prefix query scans everything rather than gather candidates matching
+    # more than 1/DENSE of the index
+    DENSE = 8
+
+    def __init__(self):
+        self._keys = []
+        self._texts = []
+        self._removed = set()
+        self._trigrams = {}
+        self._tokens = {}
+        self._vocabulary = []
+        self._new_tokens = []
+
+    def __len__(self):
+        return len(self._keys) - len(self._removed)
+
+    @staticmethod
+    def clip_text(clip):
+        """The text of a clip that gets indexed, or None if it has none."""
+        try:
+            datum = clip.find(SearchIndex.TEXT_FORMATS)
+        except LookupError:
+            return None
+        text = datum.data
+        if isinstance(text, memoryview):
+            # spilled, and too big to read in; only MAX_TEXT gets indexed
+            if datum.format.id == 13:  # CF_UNICODETEXT
+                return text[:SearchIndex.MAX_TEXT * 2].tobytes().decode(
+                    "utf-16-le", errors="ignore")
+            text = text[:SearchIndex.MAX_TEXT].tobytes()
+        if isinstance(text, bytes):
+            text = text.decode("latin-1")
+        if not isinstance(text, str):
+            return None
+        return text
+
+    @QtCore.Slot(Clip)
+    def add(self, clip, key=None):
+        """Index a clip under key (the clip itself if None). Clips without
+        text are skipped. Returns True if the clip was indexed."""
+        try:
+            text = self.clip_text(clip)
+        except StaleClipError:
+            # not {clip}, which would read the stale payloads again
+            logging.warning(f"Clip {clip.seq_num} changed before it could be indexed")
+            return False
+        if not text:
+            return False
+        self.add_text(clip if key is None else key, text)
+        return True
+
+    def add_text(self, key, text):
+        text = text[:self.MAX_TEXT].casefold()
+        document = len(self._keys)
+        self._keys.append(key)
+        self._texts.append(text)
+        trigrams = self._trigrams
+        for trigram in {text[i:i + 3] for i in range(len(text) - 2)}:
+            postings = trigrams.get(trigram)
+            if postings is None:
+                postings = trigrams[trigram] = array("I")
+            postings.append(document)
+        tokens = self._tokens
+        for token in set(self.TOKEN.findall(text)):
+            postings = tokens.get(token)
+            if postings is None:
+                postings = tokens[token] = array("I")
+                self._new_tokens.append(token)
+            postings.append(document)
+
+    def remove(self, key):
+        """Drop every document added under key from future results. Its
+        postings stay in place, so this doesn't shrink the index."""
+        for document, document_key in enumerate(self._keys):
+            if document_key == key:
+                self._removed.add(document)
+
+    def search(self, query, prefix=False, limit=50):
+        """Keys of clips containing every word of query, newest first. With
+        prefix, each word has to start a word in the clip rather than appear
+        anywhere in it. Matching ignores case."""
+        words = query.casefold().split()
+        if not words:
+            return []
+        if prefix:
+            candidates = self._prefix_candidates(words)
+            patterns = [re.compile(r"(?<!\w)" + re.escape(word)) for word in words]
+
+            def matches(text):
+                # a plain substring check rules most candidates out faster
+                return all(word in text for word in words) and \
+                    all(pattern.search(text) for pattern in patterns)
+        else:
+            candidates = self._substring_candidates(words)
+
+            def matches(text):
+                return all(word in text for word in words)
+
+        results = []
+        texts = self._texts
+        for document in candidates:
+            if document not in self._removed and matches(texts[document]):
+                results.append(self._keys[document])
+                if len(results) == limit:
+                    break
+        return results
+
+    def _substring_candidates(self, words):
+        """Documents, newest first, from the rarest trigram in the query.
+        Words too short for a trigram can only be checked by scanning."""
+        rarest = None
+        for word in words:
+            postings = self._rarest_trigram(word)
+            if postings is not None and (rarest is None or len(postings) < len(rarest)):
+                rarest = postings
+        if rarest is None:
+            return range(len(self._keys) - 1, -1, -1)
+        return reversed(rarest)
+
+    def _rarest_trigram(self, word):
+        """The shortest trigram posting list for word, an empty one if some
+        trigram never occurs, or None if word is shorter than a trigram."""
+        rarest = None
+        for i in range(len(word) - 2):
+            postings = self._trigrams.get(word[i:i + 3])
+            if postings is None:
+                return ()
+            if rarest is None or len(postings) < len(rarest):
+                rarest = postings
+        return rarest
+
+    def _prefix_candidates(self, words):
+        """Documents, newest first, from whichever query word narrows things
+        down most, through either the tokens it starts or its trigrams."""
+        if self._new_tokens:
+            # two sorted runs back to back, which timsort merges in one pass
+            self._new_tokens.sort()
+            self._vocabulary.extend(self._new_tokens)
+            self._vocabulary.sort()
+            self._new_tokens = []
+        best = None
+        best_size = len(self._keys)
+        for word in words:
+            if self.TOKEN.fullmatch(word):
+                start = bisect.bisect_left(self._vocabulary, word)
+                end = bisect.bisect_left(self._vocabulary, word + "\U0010ffff", start)
+                if start == end:
+                    return ()
+                postings = [self._tokens[token] for token in self._vocabulary[start:end]]
+                size = sum(map(len, postings))
+                if size < best_size:
+                    best, best_size = postings, size
+            trigram_postings = self._rarest_trigram(word)
+            if trigram_postings is not None and len(trigram_postings) < best_size:
+                best, best_size = [trigram_postings], len(trigram_postings)
+        if best is None or best_size > len(self._keys) // self.DENSE:
+            # matches are common enough that scanning stops early
+            return range(len(self._keys) - 1, -1, -1)
+        if len(best) == 1:
+            return reversed(best[0])
+        documents = set()
+        for postings in best:
+            documents.update(postings)
+        return sorted(documents, reverse=True)
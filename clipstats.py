@@ -0,0 +1,206 @@
+"""This module holds the histograms and counters the clipboard layer keeps
+its timings in.
+
+Histogram is log-linear, like HdrHistogram: values below 2 * SUB_BUCKETS
+each get their own bucket, and above that every power of two is split into
+SUB_BUCKETS buckets, so any recorded value is known to within about 3% while
+the whole range of an int fits in a few hundred counters. Recording is a
+couple of integer operations and takes no lock, so it's cheap enough to
+leave on everywhere; the price is that two threads recording into one
+histogram at the same instant can, very rarely, lose a count, which makes
+no odds to a percentile.
+
+Metrics is a registry of named histograms and counters; the module global
+`metrics` is the one Handler records every clipboard operation into. It can
+be read with snapshot() or written out as JSON with dump().
+
+Timings are recorded in microseconds.
+"""
+
+import json
+import time
+import threading
+from time import perf_counter
+
+
+class Histogram:
+    """A log-linear histogram of non-negative ints, with percentiles."""
+    SUB_BUCKET_BITS = 5
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = []
+            self.count = 0
+            self.total = 0
+            self._low = float("inf")
+            self._high = -1
+
+    @classmethod
+    def _bucket(cls, value):
+        if value < cls.SUB_BUCKETS:
+            return value
+        # shift so that value >> shift lands in [SUB_BUCKETS, 2 * SUB_BUCKETS)
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS - 1
+        return shift * cls.SUB_BUCKETS + (value >> shift)
+
+    @classmethod
+    def _highest(cls, bucket):
+        """The largest value that lands in bucket."""
+        if bucket < 2 * cls.SUB_BUCKETS:
+            return bucket
+        shift = bucket // cls.SUB_BUCKETS - 1
+        return ((bucket - shift * cls.SUB_BUCKETS + 1) << shift) - 1
+
+    @property
+    def min(self):
+        return self._low if self.count else None
+
+    @property
+    def max(self):
+        return self._high if self.count else None
+
+    def record(self, value, count=1):
+        # _bucket(), inline, since this is the hot path
+        value = int(value)
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - self.SUB_BUCKET_BITS - 1
+        bucket = value if shift <= 0 else (shift << self.SUB_BUCKET_BITS) + (value >> shift)
+        try:
+            self._counts[bucket] += count
+        except IndexError:
+            with self._lock:
+                counts = self._counts
+                if bucket >= len(counts):
+                    counts.extend([0] * (bucket + 1 - len(counts)))
+                counts[bucket] += count
+        self.count += count
+        self.total += value * count
+        if value > self._high:
+            self._high = value
+        if value < self._low:
+            self._low = value
+
+    def record_since(self, start):
+        """Record the microseconds since start, a time.perf_counter() reading.
+        Returns the time now, so consecutive steps can be chained."""
+        now = perf_counter()
+        self.record((now - start) * 1e6)
+        return now
+
+    def merge(self, other):
+        """Add another histogram's counts to this one."""
+        with other._lock:
+            counts = list(other._counts)
+            count, total, low, high = other.count, other.total, other.min, other.max
+        with self._lock:
+            if len(counts) > len(self._counts):
+                self._counts.extend([0] * (len(counts) - len(self._counts)))
+            for bucket, bucket_count in enumerate(counts):
+                self._counts[bucket] += bucket_count
+            self.count += count
+            self.total += total
+            if low is not None:
+                self._low = min(self._low, low)
+                self._high = max(self._high, high)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        """The value at or below which percent of recordings fall, to within
+        a bucket (never more than the largest value recorded)."""
+        with self._lock:
+            if not self.count:
+                return 0
+            target = max(1, -(-self.count * percent // 100))
+            seen = 0
+            for bucket, bucket_count in enumerate(self._counts):
+                seen += bucket_count
+                if seen >= target:
+                    return min(self._highest(bucket), self.max)
+            return self.max
+
+    def snapshot(self):
+        """Count, mean, min, max and the usual percentiles, as a dict."""
+        summary = {
+            "count": self.count,
+            "mean": self.mean,
+            "min": self.min or 0,
+            "max": self.max or 0,
+        }
+        for percent in self.PERCENTILES:
+            summary[f"p{percent:g}"] = self.percentile(percent)
+        return summary
+
+    def __len__(self):
+        return self.count
+
+
+class Metrics:
+    """Named histograms and counters, created the first time they're used.
+
+    Names are dotted, operation first: "handler.read" times every
+    Handler.read, "handler.get_data.UNICODETEXT" every payload read of that
+    format, "bytes_read.UNICODETEXT" counts what those reads returned.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    def time(self, name, start):
+        """Record the microseconds since start, a time.perf_counter() reading,
+        in the histogram called name. Returns the time now."""
+        now = perf_counter()
+        histogram = self._histograms.get(name) or self.histogram(name)
+        histogram.record((now - start) * 1e6)
+        return now
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def counter(self, name):
+        return self._counters.get(name, 0)
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+
+    def snapshot(self):
+        """Every counter, and a Histogram.snapshot() of every histogram."""
+        with self._lock:
+            counters = dict(sorted(self._counters.items()))
+            histograms = sorted(self._histograms.items())
+        return {
+            "counters": counters,
+            "histograms": {name: histogram.snapshot() for name, histogram in histograms},
+        }
+
+    def dump(self, path):
+        """Write snapshot(), with the time it was taken, to path as JSON.
+        Returns the snapshot."""
+        snapshot = {"time": time.time(), **self.snapshot()}
+        with open(path, "w") as file:
+            json.dump(snapshot, file, indent=1)
+        return snapshot
+
+
+# the registry the clipboard layer records into
+metrics = Metrics()
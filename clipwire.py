@@ -0,0 +1,169 @@
+"""This module packs Clips into a compact binary message, for moving them
+between threads, processes and files without pickling the object graph.
+
+A message (all little-endian) is:
+- a header: magic b"CLIP", version, seq_num, the message's size in bytes,
+    the number of datums and the size of the name table
+- the format table: one fixed-size record per datum (format id, payload
+    kind, length of its name, and where its payload is)
+- the name table: the names of the registered formats in the table, in
+    record order, since registered ids change between Windows sessions
+- the payloads, each starting on an ALIGNMENT boundary
+
+The message's size is padded to ALIGNMENT too, so messages can be written
+back to back into one file or shared buffer and every payload stays aligned.
+
+decode() only reads the header and the format table. Binary payloads are
+returned as memoryviews straight into the buffer when it's immutable
+(bytes, or an mmap opened with ACCESS_READ), so decoding a clip from a
+mapped file copies none of its payloads; they keep the buffer alive. Other
+buffers are copied, once, the way Datum copies any mutable buffer. Text is
+stored as UTF-8 and decoded to str. Spilled text is stored as the UTF-16 it
+is, and comes back spilled the same way binary payloads do, or as a str if
+it had to be copied. Payloads are encoded as cliphandler.encode_payload
+does for cliphistory.
+"""
+
+import struct
+import logging
+import weakref
+import threading
+
+import clipbackend
+from cliphandler import Clip, Datum, Format, StaleClipError, encode_payload, \
+    decode_payload, frozen_view, PAYLOAD_NONE, PAYLOAD_UTF16
+
+
+class WireFormatError(ValueError):
+    """A buffer isn't a clip message this version can decode."""
+
+
+MAGIC = b"CLIP"
+VERSION = 1
+ALIGNMENT = 8
+# magic, version, reserved, seq_num, message size, datum count, name table size
+HEADER = struct.Struct("<4sHHqQII")
+# format id, payload kind (see cliphandler.encode_payload), name length,
+# payload offset, payload length
+RECORD = struct.Struct("<IBxHQQ")
+
+_PADDING = bytes(ALIGNMENT)
+
+# backend: {registered format name: Format}
+_registered = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def encode(clip):
+    """Pack a Clip into a message and return it as bytes. Deferred payloads
+    are fetched now; any the clipboard no longer has are stored as None."""
+    entries = []
+    names = []
+    for datum in clip.data:
+        try:
+            data = datum.data
+        except StaleClipError:
+            logging.warning(f"{datum.format} changed before it could be encoded")
+            data = None
+        format_ = datum.format
+        kind, payload = encode_payload(data, format_.id)
+        name = b""
+        if format_.id is not None and format_.id not in Format.STANDARD_FORMATS:
+            name = (format_.name or "").encode("utf-8")
+            names.append(name)
+        entries.append((format_.id or 0, kind, len(name), payload))
+
+    names_size = sum(map(len, names))
+    position = HEADER.size + RECORD.size * len(entries) + names_size
+    table = bytearray()
+    body = []
+    for format_id, kind, name_length, payload in entries:
+        length = len(payload)
+        start = 0
+        if length:
+            start = _align(position)
+            body += [_PADDING[:start - position], payload]
+            position = start + length
+        table += RECORD.pack(format_id, kind, name_length, start, length)
+    size = _align(position)
+    body.append(_PADDING[:size - position])
+    header = HEADER.pack(MAGIC, VERSION, 0, clip.seq_num, size, len(entries), names_size)
+    return b"".join([header, table, *names, *body])
+
+
+def message_size(buffer):
+    """The size in bytes of the message at the start of buffer, read from its
+    header; the next message, if any, starts there."""
+    view = memoryview(buffer)
+    if view.nbytes < HEADER.size:
+        raise WireFormatError("Buffer is too short for a clip message header")
+    return _header(view)[2]
+
+
+def _header(view):
+    magic, version, _, seq_num, size, count, names_size = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise WireFormatError("Buffer doesn't start with a clip message")
+    if version != VERSION:
+        raise WireFormatError(f"Clip message version {version} isn't supported "
+                              f"(this is version {VERSION})")
+    return seq_num, count, size, names_size
+
+
+def decode(buffer, backend=None):
+    """Unpack the message at the start of buffer (anything that supports the
+    buffer protocol) into a Clip. Registered formats are looked up by name on
+    backend, or the default backend if it's None."""
+    view = memoryview(buffer)
+    if view.format != "B" or view.ndim != 1:
+        view = view.cast("B")
+    if view.nbytes < HEADER.size:
+        raise WireFormatError("Buffer is too short for a clip message header")
+    seq_num, count, size, names_size = _header(view)
+    names_at = HEADER.size + RECORD.size * count
+    if size > view.nbytes or names_at + names_size > size:
+        raise WireFormatError(f"Clip message is truncated: {size} bytes long, "
+                              f"{view.nbytes} in the buffer")
+    if backend is None:
+        backend = clipbackend.get_default()
+    registered = _registered_formats(backend)
+    keep_views = frozen_view(view)
+    datums = []
+    for record_at in range(HEADER.size, names_at, RECORD.size):
+        format_id, kind, name_length, offset, length = RECORD.unpack_from(view, record_at)
+        if name_length:
+            name = str(view[names_at:names_at + name_length], "utf-8")
+            names_at += name_length
+            format_ = registered.get(name)
+            if format_ is None:
+                format_ = registered[name] = Format(backend.register_format(name), backend)
+        else:
+            format_ = Format(format_id)
+        if offset + length > size:
+            raise WireFormatError(f"{format_}'s payload runs past the end of the message")
+        if not PAYLOAD_NONE <= kind <= PAYLOAD_UTF16:
+            raise WireFormatError(f"{format_} has an unknown payload kind {kind}")
+        if kind == PAYLOAD_NONE:
+            datum = Datum()
+            datum.format = format_
+        else:
+            payload = view[offset:offset + length]
+            datum = Datum(decode_payload(kind, payload, keep_views), format_)
+        datums.append(datum)
+    clip = Clip(seq_num=seq_num)
+    clip.data = datums
+    return clip
+
+
+def _registered_formats(backend):
+    """{name: Format} for the registered formats messages have used on
+    backend, so each name is only registered once."""
+    formats = _registered.get(backend)
+    if formats is None:
+        with _lock:
+            formats = _registered.setdefault(backend, {})
+    return formats
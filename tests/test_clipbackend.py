@@ -0,0 +1,116 @@
+import threading
+import pytest
+
+import clipbackend as cb
+
+
+@pytest.fixture
+def memory_backend():
+    return cb.MemoryBackend({49443: "HTML Format"})
+
+
+@pytest.fixture
+def open_backend(memory_backend):
+    memory_backend.open()
+    yield memory_backend
+    memory_backend.close()
+
+
+class TestMemoryBackend:
+    def test_seq(self, open_backend):
+        start = open_backend.seq()
+        open_backend.empty()
+        assert open_backend.seq() == start + 1
+        open_backend.set_data(13, "test")
+        assert open_backend.seq() == start + 2
+
+    def test_round_trip(self, open_backend):
+        open_backend.empty()
+        open_backend.set_data(13, "text")
+        open_backend.set_data(49443, b"<b>html</b>")
+        assert open_backend.enum_formats() == [13, 49443]
+        assert open_backend.get_data(13) == "text"
+        assert open_backend.get_data(49443) == b"<b>html</b>"
+
+    def test_unavailable(self, open_backend):
+        open_backend.empty()
+        with pytest.raises(cb.FormatUnavailable):
+            open_backend.get_data(13)
+        with pytest.raises(TypeError):
+            open_backend.get_data(13)
+
+    def test_invalid(self, open_backend):
+        with pytest.raises(cb.InvalidHandle):
+            open_backend.set_data(13, None)
+        with pytest.raises(cb.InvalidHandle):
+            open_backend.format_name(-1)
+
+    def test_not_open(self, memory_backend):
+        with pytest.raises(cb.NotOpen):
+            memory_backend.empty()
+        with pytest.raises(cb.NotOpen):
+            memory_backend.close()
+
+    def test_contention(self, open_backend):
+        errors = []
+
+        def other_thread():
+            try:
+                open_backend.open()
+            except cb.AccessDenied as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+        assert len(errors) == 1
+        with pytest.raises(cb.AccessDenied):
+            open_backend.copy({13: "other app"})
+
+    def test_copy(self, memory_backend):
+        start = memory_backend.seq()
+        memory_backend.copy({13: "a", 1: b"a"})
+        assert memory_backend.seq() == start + 3
+        memory_backend.open()
+        assert memory_backend.enum_formats() == [13, 1]
+        memory_backend.close()
+
+    def test_register_format(self, memory_backend):
+        png = memory_backend.register_format("PNG")
+        assert png >= cb.MemoryBackend.FIRST_REGISTERED
+        assert memory_backend.register_format("PNG") == png
+        assert memory_backend.register_format("HTML Format") == 49443
+        assert memory_backend.format_name(png) == "PNG"
+
+    def test_notifier(self, memory_backend):
+        seen = []
+        memory_backend.notifier().seq_changed.connect(lambda: seen.append(1))
+        memory_backend.copy({13: "notify"})
+        assert seen == [1]
+
+
+class TestQtBackend:
+    def test_off_gui_thread(self, qapp, qtbot):
+        backend = cb.QtBackend(qapp.clipboard())
+        outcome = []
+
+        def use():
+            backend.open()
+            try:
+                backend.empty()
+                backend.set_data(13, "off the GUI thread")
+            finally:
+                backend.close()
+            backend.open()
+            try:
+                outcome.append(backend.get_data(13))
+                backend.get_data(49927)
+            except cb.FormatUnavailable:
+                outcome.append("unavailable")
+            finally:
+                backend.close()
+        thread = threading.Thread(target=use)
+        thread.start()
+        qtbot.waitUntil(lambda: not thread.is_alive())
+        assert outcome == ["off the GUI thread", "unavailable"]
+        assert qapp.clipboard().text() == "off the GUI thread"
@@ -0,0 +1,106 @@
+import pytest
+from PySide2 import QtGui
+
+import clipbackend as cb
+import cliphandler as ch
+import clipderive
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = clipderive.DerivedCache()
+    monkeypatch.setattr(clipderive, "cache", cache)
+    return cache
+
+
+def cf_html(fragment):
+    """A CF_HTML payload, header and all, the way Windows writes one."""
+    before = "<html><head><style>b {}</style></head><body><!--StartFragment-->"
+    after = "<!--EndFragment--></body></html>"
+    header = ("Version:0.9\r\nStartHTML:{:08d}\r\nEndHTML:{:08d}\r\n"
+              "StartFragment:{:08d}\r\nEndFragment:{:08d}\r\n")
+    size = len(header.format(0, 0, 0, 0))
+    fragment = fragment.encode()
+    start = size + len(before)
+    end = start + len(fragment)
+    return (header.format(size, end + len(after), start, end).encode()
+            + before.encode() + fragment + after.encode())
+
+
+def image():
+    image = QtGui.QImage(7, 5, QtGui.QImage.Format_RGB32)
+    image.fill(QtGui.QColor(10, 200, 30))
+    return image
+
+
+class TestConversions:
+    def test_html(self, cache):
+        backend = cb.MemoryBackend({49443: "HTML Format"})
+        payload = cf_html("<p>one &amp; <b>two</b></p><script>x()</script><ul><li>three</li></ul>")
+        datum = ch.Datum(payload, ch.Format(49443, backend))
+        assert clipderive.derive(datum, "text") == "one & two\nthree"
+
+    def test_text(self, cache):
+        assert clipderive.derive(ch.Datum(b"caf\xe9", 1), "text") == "café"
+        assert clipderive.derive(ch.Datum(b"\xb0", 7), "text") == "░"
+        assert clipderive.derive(ch.Datum(("a", "b"), 15), "text") == "a\nb"
+
+    @pytest.mark.parametrize("codec", ["dib", "png"])
+    def test_images(self, cache, monkeypatch, codec):
+        # PNG is a registered format, which from_image looks up on the default backend
+        monkeypatch.setattr(cb, "_default", cb.MemoryBackend({49927: "PNG"}))
+        datum = ch.Datum.from_image(image(), codec)
+        derived = clipderive.derive(datum, "qimage")
+        assert derived.size() == image().size()
+        assert QtGui.QColor(derived.pixel(3, 2)) == QtGui.QColor(10, 200, 30)
+
+    def test_registered(self, cache):
+        backend = cb.MemoryBackend({0xC200: "Rich Text Format"})
+        datum = ch.Datum(b"{\\rtf1 hi}", ch.Format(0xC200, backend))
+        with pytest.raises(LookupError):
+            clipderive.derive(datum, "length")
+        clipderive.register("Rich Text Format", "length", len)
+        try:
+            assert clipderive.derive(datum, "length") == 10
+            assert clipderive.kinds(datum.format) == ["length"]
+        finally:
+            del clipderive._conversions[("Rich Text Format", "length")]
+
+
+class TestCache:
+    def test_hits(self, cache):
+        calls = []
+        clipderive.register(1, "upper", lambda data: calls.append(data) or data.upper())
+        try:
+            first = ch.Datum(b"shared text", 1)
+            assert clipderive.derive(first, "upper") == b"SHARED TEXT"
+            assert clipderive.derive(first, "upper") == b"SHARED TEXT"
+            # another Datum with the same payload shares the result
+            assert clipderive.derive(ch.Datum(b"shared text", 1), "upper") == b"SHARED TEXT"
+            clipderive.derive(ch.Datum(b"other text", 1), "upper")
+        finally:
+            del clipderive._conversions[(1, "upper")]
+        assert len(calls) == 2
+        assert cache.stats()["hits"] == 2
+        assert cache.stats()["misses"] == 2
+
+    def test_passed_through(self, cache):
+        text = "already text"
+        assert clipderive.derive(ch.Datum(text), "text") is text
+        assert cache.size == 0 and len(cache) == 1
+
+    def test_eviction(self):
+        cache = clipderive.DerivedCache(budget=300)
+        for key in range(3):
+            cache.put(key, f"value {key}", 60)
+        cache.get(0)
+        cache.put(3, "value 3", 150)
+        assert cache.size <= 300
+        # 1 was the least recently used
+        assert cache.get(1) is None
+        assert cache.get(0) is not None
+        assert cache.stats()["evictions"] == 1
+        assert not cache.put("big", "value", 400)
+        assert "big" not in cache._entries
+        cache.resize(150)
+        assert len(cache) == 1 and cache.size <= 150
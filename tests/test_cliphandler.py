@@ -1,3 +1,8 @@
+import time
+import pickle
+import random
+import logging
+import threading
 from time import sleep
 import pytest
 from contextlib import contextmanager
@@ -5,10 +10,56 @@ from contextlib import contextmanager
 from PySide2 import QtGui, QtCore, QtWidgets
 from PySide2.QtCore import Signal, Slot
 import pytestqt  # this is being used for qapp and qtbot
-import pywintypes
 
+import clipbackend as cb
+import clipstats
+import clipderive
+import clipsearch
+import cliphistory
 import cliphandler as ch
-import win32clipboard as wc
+
+# Tests that need the system clipboard itself; the rest run anywhere
+windows_only = pytest.mark.skipif(cb.wc is None, reason="needs the Windows clipboard")
+
+if cb.wc is None:
+    # the registered format ids these tests use are the ones Windows hands out
+    cb.set_default(cb.MemoryBackend({49443: "HTML Format", 49435: "Shell IDList Array",
+                                     49927: "PNG"}))
+
+
+class CountingBackend(cb.MemoryBackend):
+    def __init__(self, names=None):
+        super().__init__(names)
+        self.reads = []
+
+    def get_data(self, format_id):
+        self.reads.append(format_id)
+        return super().get_data(format_id)
+
+
+class SettlingBackend(cb.MemoryBackend):
+    """Denies opens for settle_time seconds after every close."""
+    def __init__(self, settle_time):
+        super().__init__()
+        self.settle_time = settle_time
+        self.closed_at = None
+        self.denials = 0
+
+    def open(self):
+        if self.closed_at is not None and \
+                time.perf_counter() - self.closed_at < self.settle_time:
+            self.denials += 1
+            raise cb.AccessDenied("Access is denied.")
+        super().open()
+
+    def close(self):
+        super().close()
+        self.closed_at = time.perf_counter()
+
+
+@pytest.fixture
+def memory_backend():
+    return CountingBackend({49443: "HTML Format"})
 
 
 @contextmanager
@@ -31,7 +82,7 @@ def find_data(data):
         buffer = QtCore.QBuffer(ba)
         buffer.open(QtCore.QIODevice.WriteOnly)
         data.save(buffer, "PNG")
-        return buffer.data()
+        return buffer.data().data()
     else:
         return data
 
@@ -68,7 +119,7 @@ class TestFormat:
         "format_, expectation, description",
         [
             (1, does_not_raise(), "None"),
-            (-1, pytest.raises(pywintypes.error), "The handle is invalid"),
+            (-1, pytest.raises(ch.InvalidHandle), "The handle is invalid"),
             # (None, pytest.raises(TypeError), "integer is required"),
             # (3, pytest.raises(ValueError), "CF_METAFILEPICT format not supported")
         ]
@@ -97,12 +148,26 @@ class TestFormat:
         assert format_str_1 != format_html
         assert format_html != format_str_1
 
-        format_delta = ch.Format(13)
-        format_delta.name = "Not Unicode Text"
-        assert format_str_1 == format_delta
-        format_delta.id = 1
-        format_delta.name = format_str_1.name
-        assert format_str_1 != format_delta
+        assert format_str_1 == 13
+        assert format_str_1 != 1
+        assert format_str_1 != "UNICODETEXT"
+
+    def test_interned(self):
+        format_str = ch.Format(13)
+        assert ch.Format(13) is format_str
+        assert ch.Format(format_str) is format_str
+        assert ch.Format(49443) is ch.Format(49443)
+        with pytest.raises(AttributeError):
+            format_str.name = "Not Unicode Text"
+        with pytest.raises(AttributeError):
+            format_str.id = 1
+        assert ch.Format(13).name == "UNICODETEXT"
+
+    def test_hash(self):
+        lookup = {ch.Format(13): "text", ch.Format(49443): "html"}
+        assert lookup[13] == "text"
+        assert lookup[ch.Format(49443)] == "html"
+        assert ch.Format(1) in {1, 2}
 
 
 add_params = [
@@ -178,7 +243,10 @@ class TestDatum:
 
     def test_str(self, class_params, my_datum, response_format):
         assert response_format.name in str(my_datum)
-        assert str(find_data(class_params["data"]))[0:40] in str(my_datum)
+        preview = my_datum.string_preview(40)
+        # cut between escapes, so never part way through a byte's \xNN
+        assert str(find_data(class_params["data"])).startswith(preview)
+        assert preview in str(my_datum)
 
     @pytest.mark.parametrize("addend", add_params, ids=add_ids)
     def test_add(self, my_datum, addend):
@@ -191,6 +259,55 @@ class TestDatum:
         assert result_reverse.data[0].data == find_data(addend)
         assert result_reverse.data[-1].data == my_datum.data
 
+    def test_deferred(self):
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return "deferred text"
+
+        datum = ch.Datum.deferred(13, loader)
+        assert datum.format == 13
+        assert datum.deferred_load and calls == []
+        assert datum.data == "deferred text"
+        assert not datum.deferred_load
+        datum.data = "replaced"
+        assert datum.data == "replaced" and len(calls) == 1
+
+    @pytest.mark.parametrize("codec, format_id", [
+        ("png", 49927),
+        ("png_fast", 49927),
+        ("dib", 8),
+    ])
+    def test_image_codecs(self, codec, format_id):
+        image = QtGui.QImage("punched.png")
+        datum = ch.Datum.from_image(image, codec)
+        assert datum.format == format_id
+        assert datum.deferred_load
+        encoded = datum.data
+        assert not datum.deferred_load and not datum.encoding
+        if format_id == 8:
+            # a BITMAPINFOHEADER, without the BMP file header before it;
+            # BMP has no alpha channel, so only the size survives exactly
+            assert encoded[:4] == b"\x28\x00\x00\x00"
+            decoded = QtGui.QImage.fromData(b"BM" + bytes(12) + encoded)
+            assert decoded.size() == image.size()
+        else:
+            decoded = QtGui.QImage.fromData(encoded)
+            assert decoded.convertToFormat(image.format()) == image
+
+    def test_image_quality(self):
+        image = QtGui.QImage("punched.png")
+        smallest = ch.Datum.from_image(image, "png", quality=0).data
+        fastest = ch.Datum.from_image(image, "png", quality=100).data
+        assert len(smallest) < len(fastest)
+
+    def test_image_on_caller(self, monkeypatch):
+        monkeypatch.setattr(ch.Datum, "image_pool", None)
+        datum = ch.Datum(QtGui.QImage("punched.png"))
+        assert not datum.deferred_load
+        assert datum.data == find_data(QtGui.QImage("punched.png"))
+
     def test_add_none(self, my_datum):
         result_forward = my_datum + None
         assert "Clip" in type(result_forward).__name__
@@ -311,7 +428,9 @@ class TestClip:
                         "currently implemented.")
         assert str(my_clip.seq_num) in str(my_clip)
         assert str(len(my_clip.data)) in str(my_clip)
-        assert str(clip_data)[:40] in str(my_clip)
+        preview = my_clip[0].string_preview(40)
+        assert str(clip_data).startswith(preview)
+        assert preview in str(my_clip)
 
     def test_formats(self, my_clip, clip_data, clip_params):
         if clip_data == "<b>Html Text</b>":
@@ -336,6 +455,57 @@ class TestClip:
     def test_priority_order(self, multiple_format_clip, formats, expected):
         assert multiple_format_clip.find(formats).format.id == expected
 
+    @staticmethod
+    def scan(clip, format_id):
+        for datum in clip.data:
+            if datum.format == format_id:
+                return datum
+        raise LookupError
+
+    def test_index_updates(self, multiple_format_clip):
+        clip = multiple_format_clip + ch.Datum("second text", 1)
+        assert clip.find(1).data == "datum 0"
+        del clip[0]
+        assert clip.find(1).data == "second text"
+        assert clip.find([4, 13]).data == "datum 2"
+        clip[0] = ch.Datum("first text", 1)
+        assert clip.find(1).data == "first text"
+        assert clip.find([2, 4]).data == "datum 2"
+        clip[-1] = ch.Datum("bitmap", 2)
+        assert clip.find(2).data == "bitmap"
+        assert clip.find(1).data == "first text"
+        del clip[1:3]
+        assert [datum.format.id for datum in clip.data] == [1, 13, 2]
+        assert clip.find([6, 2]).data == "bitmap"
+        with pytest.raises(LookupError):
+            clip.find([4, 6])
+
+    def test_compact(self):
+        clip = ch.Clip(["text", b"bytes"])
+        for item in [clip, clip[0], clip[0].format]:
+            assert not hasattr(item, "__dict__")
+
+    def test_index_random(self):
+        rng = random.Random(7)
+        clip = ch.Clip()
+        for step in range(500):
+            action = rng.random()
+            datum = ch.Datum(f"datum {step}", rng.choice([1, 2, 8, 13]))
+            if action < 0.5 or len(clip) < 2:
+                clip.add_data(datum)
+            elif action < 0.75:
+                clip[rng.randrange(len(clip))] = datum
+            else:
+                del clip[rng.randrange(len(clip))]
+            for format_id in [1, 2, 8, 13]:
+                try:
+                    expected = self.scan(clip, format_id)
+                except LookupError:
+                    with pytest.raises(LookupError):
+                        clip.find(format_id)
+                else:
+                    assert clip.find(format_id) is expected
+
     @pytest.mark.parametrize("addend", add_params, ids=add_ids)
     def test_add(self, my_clip, clip_data, addend):
         result_forward = my_clip + addend
@@ -354,6 +524,253 @@ class TestClip:
             assert a.data == b
 
 
+class TestBlobStore:
+    url = "https://example.com/a/link/people/copy/over/and/over"
+
+    @pytest.fixture
+    def store(self, monkeypatch):
+        store = ch.BlobStore()
+        monkeypatch.setattr(ch.Datum, "store", store)
+        return store
+
+    def test_dedup(self, store):
+        history = [ch.Clip(self.url) for _ in range(10)]
+        assert len(store) == 1
+        assert store.references == 10
+        assert all(clip[0].data is history[0][0].data for clip in history)
+        assert store.saved_bytes == 9 * len(self.url)
+        assert store.dedup_ratio == 10
+
+    def test_text_formats_share(self, store):
+        clip = ch.Clip([ch.Datum(self.url, 13), ch.Datum(self.url.encode(), 1)])
+        assert len(store) == 1
+        assert clip.find(1).data == self.url.encode()
+        assert clip.find(1).digest == clip.find(13).digest
+        html = ch.Datum(self.url.encode(), 49443)
+        assert len(store) == 2 and html.digest != clip.find(1).digest
+
+    def test_release(self, store):
+        clip = ch.Clip([self.url, self.url + " again"])
+        copy = ch.Datum(clip[0])
+        assert store.references == 3
+        del clip
+        assert len(store) == 1 and store.references == 1
+        copy.data = "short"
+        assert len(store) == 0
+        assert store.stats()["stored_bytes"] == 0
+
+    def test_small_and_other_payloads(self, store):
+        ch.Clip(["short", 44, [1, 2, 3], None])
+        assert len(store) == 0
+
+    def test_no_store(self, monkeypatch):
+        monkeypatch.setattr(ch.Datum, "store", None)
+        datum = ch.Datum(self.url)
+        assert datum.data == self.url and datum.digest is None
+
+
+
+class TestRope:
+    @staticmethod
+    def check_balanced(rope):
+        if rope._items is not None:
+            assert len(rope._items) <= ch.Rope.LEAF_SIZE
+            return 0
+        left, right = TestRope.check_balanced(rope._left), TestRope.check_balanced(rope._right)
+        assert abs(left - right) <= 1
+        assert rope._depth == max(left, right) + 1
+        return rope._depth
+
+    def test_sequence(self):
+        items = list(range(1000))
+        rope = ch.Rope(items)
+        self.check_balanced(rope)
+        assert len(rope) == 1000 and list(rope) == items
+        assert rope[0] == 0 and rope[-1] == 999 and rope[517] == 517
+        assert list(rope[30:700]) == items[30:700]
+        assert list(rope[::7]) == items[::7]
+        with pytest.raises(IndexError):
+            rope[1000]
+
+    def test_concatenation_balanced(self):
+        rope = ch.Rope()
+        items = []
+        for i in range(2000):
+            if i % 3:
+                rope = rope + [i]
+            else:
+                rope = [i] + rope
+            items.append(i) if i % 3 else items.insert(0, i)
+            if i % 97 == 0:
+                piece = ch.Rope(range(i))
+                rope, items = rope + piece, items + list(piece)
+        self.check_balanced(rope)
+        assert list(rope) == items
+        assert rope._depth < 20
+
+    def test_versions(self):
+        rope = ch.Rope(range(100))
+        replaced = rope.replace(-1, "last")
+        deleted = rope.delete(slice(10, 90))
+        assert list(rope) == list(range(100))
+        assert replaced[99] == "last" and replaced[:99] == list(range(99))
+        assert list(deleted) == list(range(10)) + list(range(90, 100))
+        assert list(rope.delete(0)) == list(range(1, 100))
+
+    @pytest.mark.parametrize("key", [slice(3, 1), slice(-1, -5), slice(-5, -1), slice(-70, 90),
+                                     slice(95, 200), slice(None, None, -3), -100])
+    def test_delete_slices(self, key):
+        items = list(range(100))
+        rope = ch.Rope(items)
+        del items[key]
+        assert list(rope.delete(key)) == items
+        clip = ch.Clip(["a", "b", "c", "d"])
+        letters = ["a", "b", "c", "d"]
+        if isinstance(key, slice):
+            del clip[key]
+            del letters[key]
+            assert [datum.data for datum in clip.data] == letters
+
+    def test_clip_shares(self):
+        clip = ch.Clip([f"item {i}" for i in range(100)])
+        longer = clip + "one more"
+        # only the path down to the last leaf is new
+        assert longer.data._left is clip.data._left
+        assert len(clip) == 100 and len(longer) == 101
+        longer[0] = "changed"
+        del longer[1]
+        assert clip[0].data == "item 0" and clip[1].data == "item 1"
+        assert longer[0].data == "changed" and longer[1].data == "item 2"
+        part = clip[10:20]
+        assert part[0] is clip[10]
+        assert ch.Clip(part, clip.seq_num).find(13).data == "item 10"
+
+    def test_repeated_addition(self):
+        clip = ch.Clip()
+        for i in range(500):
+            clip = clip + f"item {i}"
+        self.check_balanced(clip.data)
+        assert [datum.data for datum in clip.data] == [f"item {i}" for i in range(500)]
+        assert pickle.loads(pickle.dumps(clip)) == clip
+
+
+class TestDigest:
+    @pytest.fixture
+    def digests(self, monkeypatch):
+        """Counts payload_digest calls."""
+        calls = []
+        payload_digest = ch.payload_digest
+
+        def counting(payload, kind=None):
+            calls.append(kind)
+            return payload_digest(payload, kind)
+        monkeypatch.setattr(ch, "payload_digest", counting)
+        return calls
+
+    def test_datum(self, digests):
+        screenshot = bytes(range(256)) * 4096
+        first, second = ch.Datum(screenshot, 8), ch.Datum(bytearray(screenshot), 8)
+        # the blob store digests each payload as it comes in...
+        assert len(digests) == 2
+        assert first == second and hash(first) == hash(second)
+        # ...and that digest is reused
+        assert first.content_digest == first.digest and len(digests) == 2
+        assert first != ch.Datum(screenshot, 17)
+        assert ch.Datum("a", 1) != ch.Datum(b"a", 1)
+        assert ch.Datum(None, 1) == ch.Datum(None, 1)
+        assert len({first, second, ch.Datum(screenshot[:-1], 8)}) == 2
+
+    def test_cached(self, digests, monkeypatch):
+        monkeypatch.setattr(ch.Datum, "store", None)
+        datum, other = ch.Datum(b"payload", 1), ch.Datum(b"payload", 1)
+        # nothing's digested just to compare once
+        assert datum == other and not digests
+        assert hash(datum) == hash(other) and len(digests) == 2
+        for _ in range(3):
+            assert datum == other
+        assert len(digests) == 2
+        datum.data = b"changed"
+        assert datum != other and len(digests) == 2
+        assert datum.content_digest != other.content_digest and len(digests) == 3
+        assert ch.Datum(datum).content_digest == datum.content_digest and len(digests) == 3
+
+    def test_text_formats(self):
+        url = "https://example.com/a/link/people/copy/over/and/over"
+        text, ascii_text = ch.Datum(url, 13), ch.Datum(url.encode(), 1)
+        assert text.digest == ascii_text.digest
+        assert ascii_text.content_digest == ch.payload_digest(url.encode())
+        assert ascii_text != ch.Datum(url, 1)
+
+    def test_clip(self, digests):
+        clip = ch.Clip(["text", ch.Datum(b"<b>text</b>", 8)], seq_num=5)
+        copy = ch.Clip(["text", ch.Datum(b"<b>text</b>", 8)], seq_num=5)
+        later = ch.Clip(copy, seq_num=6)
+        assert clip == copy and hash(clip) == hash(copy)
+        assert clip != later and clip.content_digest == later.content_digest
+        calls = len(digests)
+        assert clip == copy and len(digests) == calls
+        copy[0] = "other text"
+        assert clip != copy
+        del copy[0]
+        copy.add_data("text")
+        assert clip.content_digest != copy.content_digest
+        # as a duplicate check, whatever the seq_num
+        seen = {clip.content_digest: clip}
+        assert later.content_digest in seen and len({clip, copy, later}) == 3
+
+
+class TestPreview:
+    @pytest.mark.parametrize("length", range(1, 30))
+    def test_escapes(self, length):
+        payload = bytes([0x89]) + b"PNG\r\n\x1a\n\\x00" + bytes(range(16))
+        preview = ch.payload_preview(payload, length)
+        assert len(preview) <= length and str(payload).startswith(preview)
+        assert len(preview) > length - 4
+        # a byte's escape is kept whole or left out
+        assert ch.shorten_preview(preview + "\\x9c", length) == preview
+
+    def test_multibyte(self):
+        text = "a\N{SNOWMAN}\N{GRINNING FACE}b" * 10
+        utf16 = text.encode("utf-16-le")
+        assert ch.payload_preview(memoryview(utf16)[:7], 10, "utf-16-le") == "a\N{SNOWMAN}"
+        assert ch.payload_preview(memoryview(utf16), 6, "utf-16-le") == text[:6]
+        assert ch.payload_preview(text.encode()[:5], 10, "utf-8") == "a\N{SNOWMAN}"
+        assert ch.payload_preview(b"caf\xe9 bad", 10, "utf-8") == "caf� bad"
+
+    def test_backslashes(self):
+        path = r"C:\xampp\htdocs\index.php and C:\Users\me\new\x41"
+        text = ch.Datum(path)
+        assert text.string_preview(40) == path[:40]
+        assert f"'{path[:40]}'" in str(text)
+        # repr escapes the zero width space as \u200b, which isn't cut in half
+        paths = ch.Datum((r"C:\xampp", "\u200b" * 20), 15)
+        assert str(paths.data).startswith(paths.string_preview(18))
+        assert paths.string_preview(18) == "('C:\\\\xampp', '"
+
+    def test_fetched(self, memory_backend):
+        memory_backend.copy({13: "copied text", 1: b"copied\x00text"})
+        with ch.Handler(memory_backend) as handler:
+            clip = handler.read()
+            clip.materialize()
+            handler.write(ch.Clip("moved on"))
+        # made when the payloads were fetched, so still there
+        assert clip.find(13).string_preview() == "copied text"
+        assert clip.find(1).string_preview() == "b'copied\\x00text'"
+
+    def test_stored(self, monkeypatch):
+        clip = ch.Clip(["x" * 1000000, b"\x00" * 1000000, ch.Datum(("a", "b"), 15)])
+        previews = []
+        monkeypatch.setattr(ch, "payload_preview",
+                            lambda *args: previews.append(args) or "")
+        str(clip), clip.print_all()
+        assert clip[0].string_preview() == "x" * ch.Datum.PREVIEW_LENGTH
+        assert clip[1].string_preview(10) == "b'\\x00\\x00"
+        assert clip[2].string_preview() == "('a', 'b')"
+        # made when the payloads were set, so showing them reads none of it
+        assert previews == []
+        clip[0].string_preview(ch.Datum.PREVIEW_LENGTH + 1)
+        assert len(previews) == 1
+
 # def qimage_from_clip_bitmap(clip):
 #     byte_str = clip.find(XYZZY):
 #     byte_array = QtCore.QByteArray(clip.find(XYZZY))
@@ -415,11 +832,13 @@ class TestHandler:
         with ch.Handler() as handler:
             yield handler
 
+    @windows_only
     @pytest.mark.usefixtures("load_qclipboard")
     def test_read(self, my_handler, load_params):
         clip = my_handler.read()
         assert find_data(load_params) == clip.find(ch.Datum(load_params).format.id).data
 
+    @windows_only
     @pytest.mark.usefixtures("clear_qclipboard")
     def test_write(self, read_qclipboard, load_params):
         clip = ch.Clip(load_params)
@@ -427,6 +846,7 @@ class TestHandler:
             my_handler.write(clip)
         assert read_qclipboard() == load_params
 
+    @windows_only
     @pytest.mark.usefixtures("load_qclipboard")
     def test_clear(self, read_qclipboard, load_params, qapp):
         assert read_qclipboard() == load_params
@@ -450,14 +870,14 @@ class TestHandler:
 
     def test_mutexes(self, qapp):
         handler_1 = ch.Handler()
-        assert ch.cb_mutex.try_lock() is True
-        ch.cb_mutex.unlock()
+        assert ch.clipboard_lock.try_acquire() is True
+        ch.clipboard_lock.release()
         handler_1.__enter__()
-        assert ch.cb_mutex.try_lock() is False
+        assert ch.clipboard_lock.try_acquire() is False
         handler_1.write("test mutex")
         handler_1.__exit__()
-        assert ch.cb_mutex.try_lock() is True
-        ch.cb_mutex.unlock()
+        assert ch.clipboard_lock.try_acquire() is True
+        ch.clipboard_lock.release()
         with handler_1:
             new_clip = handler_1.read()
         assert new_clip[0].data == "test mutex"
@@ -496,12 +916,7 @@ class TestMonitor:
 
     @staticmethod
     def mutex_please():
-        try_count = 0
-        while try_count < 50:
-            if ch.cb_mutex.tryLock(10):
-                return True
-            try_count += 1
-        return False
+        return ch.clipboard_lock.acquire(0.5)
 
     def test_thread_init(self, my_monitor, monitor_thread):
         assert monitor_thread.isRunning()
@@ -509,15 +924,15 @@ class TestMonitor:
 
     def test_mutex(self, my_monitor):
         assert self.mutex_please()
-        ch.cb_mutex.unlock()
+        ch.clipboard_lock.release()
         sleep(0.2)
         assert my_monitor.try_count < 1
+        # checking the sequence number doesn't need the mutex, so holding it
+        # doesn't hold up an idle monitor
         assert self.mutex_please()
-        sleep(0.5)
-        assert my_monitor.try_count >= 40
-        ch.cb_mutex.unlock()
-        sleep(0.2)
+        sleep(0.5 + my_monitor.scheduler.ceiling / 1000)
         assert my_monitor.try_count < 1
+        ch.clipboard_lock.release()
 
     def test_signals(self, my_monitor, load_params, qtbot):
         with qtbot.waitSignals([(my_monitor.clipboard_updated, "clipboard updated"),
@@ -554,4 +969,744 @@ class TestMonitor:
         monitor_thread.quit()
         monitor_thread.wait()
         sleep(0.5)
-        assert monitor_thread.isFinished()
\ No newline at end of file
+        assert monitor_thread.isFinished()
+
+class TestNotifiedMonitor:
+    @pytest.fixture
+    def notified_monitor(self, qapp):
+        monitor = ch.Monitor(notifier=cb.QtNotifier(qapp.clipboard()))
+        monitor.begin()
+        yield monitor
+        monitor.end()
+
+    def test_fallback_interval(self, notified_monitor):
+        assert notified_monitor.timer.interval() == ch.Monitor.FALLBACK_INTERVAL
+
+    def test_backend_notifier(self, memory_backend, qtbot):
+        monitor = ch.Monitor(handler=ch.Handler(memory_backend))
+        assert monitor.notifier is memory_backend.notifier()
+        monitor.begin()
+        try:
+            with qtbot.waitSignal(monitor.new_card_from_clipboard,
+                                  timeout=ch.Monitor.FALLBACK_INTERVAL // 2) as new_signal:
+                memory_backend.copy({13: "notified"})
+            assert new_signal.args[0].find(13).data == "notified"
+        finally:
+            monitor.end()
+
+    def test_polling(self, memory_backend):
+        monitor = ch.Monitor(handler=ch.Handler(memory_backend), notifier=False)
+        assert monitor.notifier is None
+        monitor.begin()
+        assert monitor.timer.interval() == monitor.scheduler.floor
+        monitor.end()
+
+    @windows_only
+    def test_notified_catch_clip(self, notified_monitor, load_params, qtbot):
+        # well inside the fallback poll, so only the notification can catch it
+        with qtbot.waitSignal(notified_monitor.new_card_from_clipboard,
+                              timeout=ch.Monitor.FALLBACK_INTERVAL // 2) as new_signal:
+            with ch.Handler() as my_handler:
+                my_handler.write(load_params)
+        assert new_signal.args[0][0].data == find_data(load_params)
+
+
+class TestQtHandler:
+    @pytest.fixture
+    def qt_handler(self, qapp):
+        return ch.Handler(cb.QtBackend(qapp.clipboard()))
+
+    def test_write_seq(self, qt_handler):
+        # QClipboard only changes on close, after write has read the seq
+        with qt_handler:
+            qt_handler.write("from qt")
+        assert qt_handler.peek_seq() == qt_handler.current_seq
+
+    def test_write_off_gui_thread(self, qt_handler, qapp, qtbot):
+        errors = []
+
+        def write():
+            try:
+                with qt_handler:
+                    qt_handler.write("from a thread")
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=write)
+        thread.start()
+        qtbot.waitUntil(lambda: not thread.is_alive())
+        assert errors == []
+        assert qapp.clipboard().text() == "from a thread"
+        assert qt_handler.peek_seq() == qt_handler.current_seq
+
+
+class TestPollScheduler:
+    def test_backoff(self):
+        scheduler = ch.PollScheduler(floor=10, ceiling=100, backoff=2)
+        assert [scheduler.idle() for _ in range(5)] == [20, 40, 80, 100, 100]
+        assert scheduler.changed() == 10
+        assert scheduler.idle() == 20
+
+    def test_contended(self):
+        scheduler = ch.PollScheduler(floor=10, ceiling=100)
+        scheduler.idle()
+        assert scheduler.contended() == 0
+        assert scheduler.idle() == 40
+
+    def test_worst_case_latency(self):
+        scheduler = ch.PollScheduler(floor=10, ceiling=250)
+        assert scheduler.worst_case_latency() == 250
+        assert scheduler.worst_case_latency(15) == 265
+
+    @pytest.mark.parametrize("kwargs", [
+        {"floor": 0},
+        {"floor": 50, "ceiling": 10},
+        {"backoff": 0.5},
+    ], ids=["zero_floor", "ceiling_below_floor", "shrinking_backoff"])
+    def test_invalid(self, kwargs):
+        with pytest.raises(ValueError):
+            ch.PollScheduler(**kwargs)
+
+
+class TestClipboardLock:
+    @staticmethod
+    def hold(lock, release):
+        """Take lock on another thread and keep it until release is set."""
+        taken = threading.Event()
+
+        def holder():
+            lock.acquire()
+            taken.set()
+            release.wait(5)
+            lock.release()
+        thread = threading.Thread(target=holder, name="holder")
+        thread.start()
+        taken.wait(5)
+        return thread
+
+    def test_fifo(self):
+        lock = ch.ClipboardLock()
+        order = []
+
+        def worker():
+            lock.acquire()
+            order.append(threading.current_thread().name)
+            lock.release()
+        assert lock.acquire()
+        threads = []
+        for i in range(5):
+            threads.append(threading.Thread(target=worker, name=f"worker {i}"))
+            threads[-1].start()
+            while lock.waiting <= i:
+                time.sleep(0.001)
+        # nobody can jump the queue, even with the lock free for a moment
+        lock.release()
+        for thread in threads:
+            thread.join()
+        assert order == [f"worker {i}" for i in range(5)]
+        assert not lock.locked()
+
+    def test_timeout(self):
+        lock = ch.ClipboardLock()
+        release = threading.Event()
+        holder = self.hold(lock, release)
+        start = time.perf_counter()
+        assert lock.acquire(0.05) is False
+        assert 0.05 <= time.perf_counter() - start < 1
+        assert lock.try_acquire() is False
+        assert lock.waiting == 0
+        release.set()
+        holder.join()
+        assert lock.acquire(1)
+        lock.release()
+        stats = lock.stats()
+        assert stats[threading.current_thread().name]["timeouts"] == 2
+        assert stats["holder"]["hold_us"]["min"] >= 50000
+
+    def test_owner_only(self):
+        lock = ch.ClipboardLock()
+        release = threading.Event()
+        holder = self.hold(lock, release)
+        with pytest.raises(RuntimeError):
+            lock.release()
+        release.set()
+        holder.join()
+        assert lock.acquire()
+        with pytest.raises(RuntimeError):
+            lock.acquire()
+        with pytest.raises(RuntimeError):
+            lock.acquire(5)
+        assert lock.try_acquire() is False
+        lock.release()
+
+    def test_nested_handlers(self, memory_backend):
+        start = time.perf_counter()
+        with ch.Handler(memory_backend):
+            with pytest.raises(RuntimeError):
+                with ch.Handler(memory_backend):
+                    pass
+        assert time.perf_counter() - start < ch.Handler.TIMEOUT / 2
+        assert not ch.clipboard_lock.locked()
+
+    def test_handler_timeout(self, memory_backend):
+        release = threading.Event()
+        holder = self.hold(ch.clipboard_lock, release)
+        try:
+            with pytest.raises(ch.LockTimeout):
+                with ch.Handler(memory_backend, timeout=0.02):
+                    pass
+            monitor = ch.Monitor(handler=ch.Handler(memory_backend, timeout=0.02),
+                                 coalesce=0)
+            cards = []
+            monitor.new_card_from_clipboard.connect(cards.append)
+            memory_backend.copy({13: "waiting"})
+            monitor.check_clipboard()
+            assert monitor.try_count == 1 and cards == []
+        finally:
+            release.set()
+            holder.join()
+        monitor.check_clipboard()
+        assert monitor.try_count == 0 and len(cards) == 1
+
+
+class TestCoalesce:
+    @staticmethod
+    def monitor(backend, **kwargs):
+        monitor = ch.Monitor(handler=ch.Handler(backend), **kwargs)
+        monitor.cards = []
+        monitor.new_card_from_clipboard.connect(monitor.cards.append)
+        return monitor
+
+    def test_disabled(self, memory_backend):
+        monitor = self.monitor(memory_backend, coalesce=0)
+        memory_backend.copy({13: "first"})
+        monitor.check_clipboard()
+        assert [clip.find(13).data for clip in monitor.cards] == ["first"]
+        assert monitor.coalesce_stats["held_ms"] == 0
+
+    def test_burst(self, memory_backend):
+        monitor = self.monitor(memory_backend, coalesce=30)
+        memory_backend.copy({})
+        monitor.check_clipboard()
+        memory_backend.copy({13: "text"})
+        monitor.check_clipboard()
+        memory_backend.copy({13: "text", 49443: b"<b>text</b>"})
+        monitor.check_clipboard()
+        assert monitor.cards == []
+        time.sleep(0.04)
+        monitor.check_clipboard()
+        assert len(monitor.cards) == 1
+        assert monitor.cards[0].find(49443).data == b"<b>text</b>"
+        stats = monitor.coalesce_stats
+        # three states seen, less the one read
+        assert stats["reads"] == 1 and stats["states_skipped"] == 2
+        assert 30 <= stats["held_ms"] == stats["max_held_ms"] < 1000
+
+    def test_one_copy(self, memory_backend):
+        monitor = self.monitor(memory_backend, coalesce=30)
+        # bumps the sequence number once per format
+        memory_backend.copy({13: "text", 1: b"text", 49443: b"<b>text</b>"})
+        monitor.check_clipboard()
+        time.sleep(0.04)
+        monitor.check_clipboard()
+        assert len(monitor.cards) == 1
+        assert monitor.coalesce_stats["states_skipped"] == 0
+
+    def test_limit(self, memory_backend):
+        monitor = self.monitor(memory_backend, coalesce=30, coalesce_limit=60)
+        start = time.perf_counter()
+        while not monitor.cards:
+            memory_backend.copy({13: f"still going {time.perf_counter()}"})
+            monitor.check_clipboard()
+            time.sleep(0.005)
+        assert 0.06 <= time.perf_counter() - start < 0.5
+
+    def test_worst_case_latency(self, memory_backend):
+        scheduler = ch.PollScheduler(ceiling=250)
+        monitor = self.monitor(memory_backend, notifier=False, scheduler=scheduler,
+                               coalesce_limit=100)
+        assert monitor.worst_case_latency() == 350
+        monitor.coalesce = 0
+        assert monitor.worst_case_latency() == 250
+
+
+class GatedBackend(cb.MemoryBackend):
+    """Holds every open until the gate is set."""
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+
+    def open(self):
+        self.gate.wait(5)
+        super().open()
+
+
+class TestWriteQueue:
+    @staticmethod
+    def finished(write_queue):
+        results = []
+        write_queue.finished.connect(
+            lambda clip, status: results.append((clip[0].data, status)))
+        return results
+
+    def test_write(self, memory_backend, qapp):
+        write_queue = ch.WriteQueue(ch.Handler(memory_backend))
+        results = self.finished(write_queue)
+        write_queue.put(ch.Clip("queued"))
+        assert write_queue.flush(5)
+        qapp.processEvents()
+        assert results == [("queued", "written")]
+        with ch.Handler(memory_backend) as handler:
+            assert handler.read()[0].data == "queued"
+        write_queue.close()
+
+    def test_superseded(self, qapp):
+        backend = GatedBackend()
+        write_queue = ch.WriteQueue(ch.Handler(backend))
+        results = self.finished(write_queue)
+        write_queue.put(ch.Clip("in progress"))
+        time.sleep(0.05)
+        write_queue.put(ch.Clip("urgent"), ch.WriteQueue.HIGH)
+        write_queue.put(ch.Clip("dropped"))
+        write_queue.put(ch.Clip("last"))
+        assert write_queue.depth == 2
+        backend.gate.set()
+        assert write_queue.flush(5)
+        qapp.processEvents()
+        assert results == [("dropped", "superseded"), ("in progress", "written"),
+                           ("urgent", "written"), ("last", "written")]
+        with ch.Handler(backend) as handler:
+            assert handler.read()[0].data == "last"
+        stats = write_queue.stats()
+        assert stats["put"] == 4 and stats["written"] == 3
+        assert stats["superseded"] == 1 and stats["max_depth"] == 2
+        assert stats["wait_us"]["count"] == stats["write_us"]["count"] == 3
+        write_queue.close()
+
+    def test_failed(self, memory_backend, qapp, caplog):
+        caplog.set_level(logging.CRITICAL)
+        write_queue = ch.WriteQueue(ch.Handler(memory_backend))
+        results = self.finished(write_queue)
+        memory_backend.open = lambda: (_ for _ in ()).throw(cb.ClipboardError("broken"))
+        write_queue.put(ch.Clip("lost"))
+        assert write_queue.flush(5)
+        qapp.processEvents()
+        assert results == [("lost", "failed")]
+        write_queue.close()
+
+    def test_unexpected_error(self, memory_backend, qapp, caplog):
+        caplog.set_level(logging.CRITICAL)
+        write_queue = ch.WriteQueue(ch.Handler(memory_backend))
+        results = self.finished(write_queue)
+        set_data = memory_backend.set_data
+        memory_backend.set_data = lambda format_id, data: (_ for _ in ()).throw(
+            TypeError("unsupported payload"))
+        write_queue.put(ch.Clip("unsupported"))
+        assert write_queue.flush(5)
+        memory_backend.set_data = set_data
+        write_queue.put(ch.Clip("fine"))
+        assert write_queue.flush(5)
+        qapp.processEvents()
+        assert results == [("unsupported", "failed"), ("fine", "written")]
+        assert write_queue.depth == 0 and not write_queue._busy
+        write_queue.close()
+
+    def test_write_back_card(self, memory_backend, qapp):
+        monitor = ch.Monitor(handler=ch.Handler(memory_backend), coalesce=0)
+        cards = []
+        monitor.new_card_from_clipboard.connect(cards.append)
+        memory_backend.copy({13: "earlier", 49443: b"<b>earlier</b>"})
+        monitor.check_clipboard()
+        memory_backend.copy({13: "later"})
+        monitor.check_clipboard()
+        assert len(cards) == 2
+        card = cards[0]
+        assert str(card) and hash(card)
+        monitor.load(card)
+        assert monitor.write_queue.flush(5)
+        with monitor.handler as handler:
+            assert sorted(memory_backend.enum_formats()) == [13, 49443]
+            assert handler.read(lazy=False) == ch.Clip(card, seq_num=handler.current_seq)
+        monitor.write_queue.close()
+
+    def test_write_back_lazy(self, memory_backend):
+        memory_backend.copy({13: "text", 49443: b"<b>text</b>"})
+        with ch.Handler(memory_backend) as handler:
+            clip = handler.read()
+            # the same clip, fetched before the clipboard is emptied
+            handler.write(clip)
+            assert memory_backend.get_data(49443) == b"<b>text</b>"
+            stale = handler.read()
+            handler.write(ch.Clip("moved on"))
+            with pytest.raises(ch.StaleClipError):
+                handler.write(stale)
+            # and the clipboard wasn't emptied for it
+            assert memory_backend.get_data(13) == "moved on"
+
+    def test_monitor_skips_own_write(self, memory_backend, qapp):
+        monitor = ch.Monitor(handler=ch.Handler(memory_backend), coalesce=0)
+        cards = []
+        monitor.new_card_from_clipboard.connect(cards.append)
+        monitor.load(ch.Clip("from a card"))
+        assert monitor.write_queue.flush(5)
+        monitor.check_clipboard()
+        assert cards == []
+        with monitor.handler:
+            assert monitor.handler.read()[0].data == "from a card"
+        monitor.write_queue.close()
+
+
+class TestMemoryHandler:
+    @pytest.fixture
+    def my_handler(self, memory_backend):
+        with ch.Handler(memory_backend) as handler:
+            yield handler
+
+    def test_read_write(self, my_handler):
+        html = ch.Format(49443, my_handler.backend)
+        my_handler.write(ch.Clip(["text", ch.Datum(b"<b>html</b>", html)]))
+        clip = my_handler.read()
+        assert clip.find(13).data == "text"
+        assert clip.find(49443).data == b"<b>html</b>"
+        assert clip.find(49443).format.name == "HTML Format"
+        assert clip.seq_num == my_handler.current_seq
+
+    def test_seq(self, my_handler):
+        current_seq = my_handler.seq()
+        my_handler.clear()
+        assert my_handler.current_seq == current_seq + 1
+        my_handler.write(ch.Clip("test"))
+        assert my_handler.current_seq == current_seq + 3
+
+    def test_mutex(self, memory_backend):
+        handler = ch.Handler(memory_backend)
+        with handler:
+            assert ch.clipboard_lock.try_acquire() is False
+        assert ch.clipboard_lock.try_acquire() is True
+        ch.clipboard_lock.release()
+
+    @pytest.fixture
+    def html_clip(self, memory_backend):
+        memory_backend.copy({13: "text", 49443: b"<b>html</b>", 1: b"text"})
+
+    @pytest.mark.usefixtures("html_clip")
+    def test_lazy_read(self, memory_backend):
+        handler = ch.Handler(memory_backend)
+        with handler:
+            clip = handler.read()
+        assert memory_backend.reads == []
+        assert [datum.format.id for datum in clip] == [13, 49443, 1]
+        assert clip.find(49443).data == b"<b>html</b>"
+        assert clip.find(49443).data == b"<b>html</b>"
+        assert memory_backend.reads == [49443]
+        assert clip.find(13).deferred_load
+
+    @pytest.mark.usefixtures("html_clip")
+    def test_lazy_read_inside_with(self, my_handler, memory_backend):
+        clip = my_handler.read()
+        assert clip.find(13).data == "text"
+        assert memory_backend.reads == [13]
+
+    @pytest.mark.usefixtures("html_clip")
+    def test_stale(self, memory_backend):
+        handler = ch.Handler(memory_backend)
+        with handler:
+            clip = handler.read()
+        clip.find(13).materialize()
+        memory_backend.copy({13: "newer"})
+        assert clip.find(13).data == "text"
+        with pytest.raises(ch.StaleClipError):
+            clip.find(49443).data
+
+    @pytest.mark.usefixtures("html_clip")
+    def test_materialize(self, memory_backend):
+        handler = ch.Handler(memory_backend)
+        with handler:
+            clip = handler.read().materialize()
+        memory_backend.copy({13: "newer"})
+        assert [datum.data for datum in clip] == ["text", b"<b>html</b>", b"text"]
+        assert not any(datum.deferred_load for datum in clip)
+
+    @pytest.mark.usefixtures("html_clip")
+    def test_eager_read(self, my_handler, memory_backend):
+        clip = my_handler.read(lazy=False)
+        assert memory_backend.reads == [13, 49443, 1]
+        assert not clip.find(1).deferred_load
+
+    @pytest.mark.usefixtures("html_clip")
+    @pytest.mark.parametrize("format_order, expected", [
+        (None, [13, 49443, 1]),
+        (1, [1]),
+        ([49443, 13], [49443, 13]),
+        ([8, 1, 17, 13], [1, 13]),
+        ([ch.Format(13), 2], [13]),
+        ([2, 8], []),
+    ])
+    def test_format_order(self, my_handler, memory_backend, format_order, expected):
+        clip = my_handler.read(lazy=False, format_order=format_order)
+        assert [datum.format.id for datum in clip.data] == expected
+        assert sorted(memory_backend.reads) == sorted(expected)
+
+    @pytest.mark.usefixtures("html_clip")
+    @pytest.mark.parametrize("lazy", [True, False], ids=["lazy", "eager"])
+    def test_max_bytes_skip(self, my_handler, lazy):
+        clip = my_handler.read(lazy=lazy, max_bytes=8)
+        assert [datum.data for datum in clip] == ["text", b"text"]
+        clip = my_handler.read(lazy=lazy, max_bytes={13: 4, 1: 2})
+        assert [datum.data for datum in clip] == [b"<b>html</b>"]
+
+    @pytest.mark.usefixtures("html_clip")
+    @pytest.mark.parametrize("lazy", [True, False], ids=["lazy", "eager"])
+    def test_max_bytes_truncate(self, my_handler, lazy):
+        clip = my_handler.read(lazy=lazy, max_bytes=4, oversize="truncate")
+        assert [datum.data for datum in clip] == ["te", b"<b>h", b"text"]
+
+    @pytest.mark.parametrize("lazy", [True, False], ids=["lazy", "eager"])
+    def test_max_bytes_not_a_buffer(self, memory_backend, lazy):
+        # a bitmap handle, say, which can't be sized or cut
+        memory_backend.copy({2: 0x1234, 1: b"some text"})
+        with ch.Handler(memory_backend) as handler:
+            clip = handler.read(lazy=lazy, max_bytes=4)
+            assert [datum.data for datum in clip] == [0x1234]
+            clip = handler.read(lazy=lazy, max_bytes=4, oversize="truncate")
+            assert [datum.data for datum in clip] == [0x1234, b"some"]
+
+    def test_bad_oversize(self, my_handler):
+        with pytest.raises(ValueError):
+            my_handler.read(max_bytes=4, oversize="shrink")
+
+    @pytest.mark.parametrize("lazy", [True, False], ids=["lazy", "eager"])
+    def test_zero_copy_round_trip(self, memory_backend, lazy):
+        """Counts copies of a binary payload from capture, through Clips and
+        the blob store, to being written back to the clipboard."""
+        payload = bytes(range(256)) * 256
+        # ASCII CF_TEXT shares a blob with the CF_UNICODETEXT it matches
+        ascii_text = b"https://example.com/copied/%d/times" % id(payload)
+        memory_backend.copy({49443: payload, 13: ascii_text.decode(), 1: ascii_text})
+        handler = ch.Handler(memory_backend)
+        with handler:
+            captured = handler.read(lazy=lazy).materialize()
+        copies = 0
+        html, text = captured.find(49443), captured.find(1)
+        copies += html.data is not payload
+        copies += html.view.obj is not payload
+        copies += text.data is not ascii_text
+        copies += text.view.obj is not ascii_text
+        stored = ch.Clip(captured) + "note"
+        copies += stored.find(49443).data is not payload
+        copies += stored.find(1).data is not ascii_text
+        # the same payload captured again shares the bytes already stored
+        html_format = ch.Format(49443, memory_backend)
+        copies += ch.Datum(b"%s" % payload, html_format).data is not payload
+        memory_backend.copy({13: "something else"})
+        with handler:
+            handler.write(stored)
+        memory_backend.open()
+        copies += memory_backend.get_data(49443) is not payload
+        copies += memory_backend.get_data(1) is not ascii_text
+        memory_backend.close()
+        assert copies == 0
+
+    def test_mutable_buffers_frozen(self):
+        buffer = bytearray(b"<b>mutable</b>")
+        datum = ch.Datum(buffer, 8)
+        buffer[:3] = b"<i>"
+        assert datum.data == b"<b>mutable</b>"
+        assert datum.view.readonly
+        assert ch.Datum(memoryview(b"view"), 1).data == b"view"
+        assert ch.Datum(ch.QtCore.QByteArray(b"qt"), 1).data == b"qt"
+
+
+class TestFormatNames:
+    class NameCountingBackend(cb.MemoryBackend):
+        def __init__(self, names=None):
+            super().__init__(names)
+            self.lookups = 0
+
+        def format_name(self, format_id):
+            self.lookups += 1
+            return super().format_name(format_id)
+
+    def test_cached(self):
+        backend = self.NameCountingBackend({49443: "HTML Format"})
+        html = ch.Format(49443, backend)
+        assert ch.Format(49443, backend) is html
+        assert backend.lookups == 1
+        assert html.name == "HTML Format"
+
+    def test_per_backend(self):
+        backend_a = cb.MemoryBackend({0xC001: "Format A"})
+        backend_b = cb.MemoryBackend({0xC001: "Format B"})
+        assert ch.Format(0xC001, backend_a).name == "Format A"
+        assert ch.Format(0xC001, backend_b).name == "Format B"
+        assert ch.Format(0xC001, backend_a) == ch.Format(0xC001, backend_b)
+
+    def test_unknown_not_cached(self):
+        backend = self.NameCountingBackend()
+        for _ in range(2):
+            with pytest.raises(cb.InvalidHandle):
+                ch.Format(0xC123, backend)
+        assert backend.lookups == 2
+
+    def test_forget_names(self):
+        backend = self.NameCountingBackend({49443: "HTML Format"})
+        html = ch.Format(49443, backend)
+        ch.Format.forget_names(backend)
+        assert ch.Format(49443, backend) is not html
+        assert ch.Format(49443, backend) == html
+        assert backend.lookups == 2
+
+
+class TestSettle:
+    def test_no_settling(self, memory_backend):
+        handler = ch.Handler(memory_backend)
+        for _ in range(50):
+            with handler:
+                handler.seq()
+        assert handler.settle.estimate == 0
+        assert handler.settle.wait() == 0
+
+    def test_learns_settle_time(self, caplog):
+        caplog.set_level(logging.ERROR)
+        backend = SettlingBackend(0.01)
+        handler = ch.Handler(backend)
+        for _ in range(60):
+            with handler:
+                pass
+        # every open after the first would be denied with no waiting at all;
+        # the estimate keeps decaying, so it's still probed now and then
+        assert backend.denials < 20
+        assert 0.005 < handler.settle.estimate <= handler.settle.ceiling
+        assert ch.Handler(backend).settle is handler.settle
+
+    def test_ignores_old_closes(self):
+        settle = ch.SettleTracker(ceiling=0.01)
+        settle.closed()
+        time.sleep(0.02)
+        settle.opened(denied=True)
+        assert settle.estimate == 0
+
+    def test_check_seq_lock_free(self, memory_backend):
+        monitor = ch.Monitor(handler=ch.Handler(memory_backend))
+        assert ch.clipboard_lock.try_acquire()
+        try:
+            assert not monitor.check_seq()
+            memory_backend.copy({13: "changed"})
+            assert monitor.check_seq()
+        finally:
+            ch.clipboard_lock.release()
+
+
+class TestMetrics:
+    @pytest.fixture
+    def handler(self, memory_backend):
+        handler = ch.Handler(memory_backend)
+        handler.metrics = clipstats.Metrics()
+        return handler
+
+    def test_operations(self, handler):
+        with handler:
+            handler.write(ch.Clip(["some text", ch.Datum(b"<b>html</b>", 49443)]))
+        with handler:
+            handler.read(lazy=False)
+        snapshot = handler.metrics.snapshot()
+        histograms = snapshot["histograms"]
+        for name in ("read", "write", "read_single", "formats", "seq", "open",
+                     "close", "lock_wait", "get_data.UNICODETEXT",
+                     "set_data.HTML Format"):
+            assert histograms[f"handler.{name}"]["count"] >= 1, name
+        assert histograms["handler.open"]["count"] == 2
+        counters = snapshot["counters"]
+        assert counters["bytes_written.HTML Format"] == len(b"<b>html</b>")
+        assert counters["bytes_read"] == counters["bytes_written"] > 0
+
+    def test_lazy_reads_count_on_fetch(self, handler, memory_backend):
+        memory_backend.copy({13: "fetched later"})
+        with handler:
+            clip = handler.read()
+        assert handler.metrics.counter("bytes_read") == 0
+        assert clip[0].data == "fetched later"
+        assert handler.metrics.counter("bytes_read.UNICODETEXT") == len("fetched later")
+
+    def test_retries(self, caplog):
+        caplog.set_level(logging.ERROR)
+        handler = ch.Handler(SettlingBackend(0.01))
+        handler.metrics = clipstats.Metrics()
+        for _ in range(10):
+            with handler:
+                pass
+        # the first opens after a close are denied until the settle time is learned
+        assert handler.metrics.counter("open_retries") >= 1
+        assert handler.metrics.histogram("handler.open").max >= 5000
+
+
+class TestSpill:
+    TEXT = "spilled text \N{SNOWMAN} " * 200
+    BINARY = bytes(range(256)) * 20
+
+    @pytest.fixture
+    def big_clip(self, memory_backend):
+        memory_backend.copy({13: self.TEXT, 49443: self.BINARY, 1: b"small"})
+
+    @pytest.fixture
+    def handler(self, memory_backend, tmp_path):
+        handler = ch.Handler(memory_backend, spill_threshold=1000)
+        handler.spill_dir = str(tmp_path)
+        handler.metrics = clipstats.Metrics()
+        return handler
+
+    def test_read_chunks(self, memory_backend, big_clip):
+        with ch.Handler(memory_backend):
+            chunks = list(memory_backend.read_chunks(13, 1000))
+            assert max(len(chunk) for chunk in chunks) == 1000
+            assert b"".join(chunks) == self.TEXT.encode("utf-16-le")
+            assert b"".join(memory_backend.read_chunks(49443, 999)) == self.BINARY
+
+    @pytest.mark.parametrize("lazy", [True, False])
+    @pytest.mark.usefixtures("big_clip")
+    def test_spilled(self, handler, lazy):
+        with handler:
+            clip = handler.read(lazy=lazy)
+        text, html, small = clip.find(13), clip.find(49443), clip.find(1)
+        assert text.spilled and html.spilled and not small.spilled
+        assert text.data.readonly
+        assert text.data == self.TEXT.encode("utf-16-le")
+        assert html.view.tobytes() == self.BINARY
+        assert small.data == b"small"
+        assert text.string_preview(14) == "spilled text \N{SNOWMAN}"
+        assert handler.metrics.counter("spilled") == 2
+        assert handler.metrics.counter("bytes_read.HTML Format") == len(self.BINARY)
+
+    @pytest.mark.usefixtures("big_clip")
+    def test_pickle_text(self, handler):
+        with handler:
+            text = handler.read(lazy=False).find(13)
+        copied = pickle.loads(pickle.dumps(text))
+        assert copied.data == self.TEXT and not copied.spilled
+        assert copied == ch.Datum(self.TEXT)
+        assert copied.string_preview(14) == "spilled text \N{SNOWMAN}"
+        assert clipderive.derive(copied, "text") == self.TEXT
+
+    @pytest.mark.usefixtures("big_clip")
+    def test_no_threshold(self, handler):
+        handler.spill_threshold = None
+        with handler:
+            clip = handler.read(lazy=False)
+        assert clip.find(13).data == self.TEXT
+        assert not clip.find(49443).spilled
+
+    @pytest.mark.usefixtures("big_clip")
+    def test_uses(self, handler, memory_backend, tmp_path):
+        with handler:
+            clip = handler.read(lazy=False)
+        index = clipsearch.SearchIndex()
+        assert index.add(clip)
+        assert index.search("spilled") == [clip]
+        with cliphistory.HistoryStore(str(tmp_path / "history"), backend=memory_backend) as store:
+            store.append(clip)
+            assert store.load(0).find(49443).data == self.BINARY
+        copied = pickle.loads(pickle.dumps(clip[1]))
+        assert copied.data == self.BINARY and not copied.spilled
+        with handler:
+            handler.write(clip)
+        with ch.Handler(memory_backend, spill_threshold=None) as reader:
+            assert reader.read(lazy=False).find(49443).data == self.BINARY
@@ -0,0 +1,161 @@
+import os
+import pytest
+
+import clipbackend as cb
+import cliphandler as ch
+import clipderive
+import cliphistory
+import clipsearch
+
+
+@pytest.fixture
+def backend():
+    return cb.MemoryBackend({49443: "HTML Format"})
+
+
+@pytest.fixture
+def history(tmp_path, backend):
+    with cliphistory.HistoryStore(str(tmp_path), backend=backend) as store:
+        yield store
+
+
+def html_clip(backend, text, seq_num=1):
+    return ch.Clip([text, ch.Datum(f"<b>{text}</b>".encode(), ch.Format(49443, backend)),
+                    ch.Datum(text.encode(), 1)], seq_num=seq_num)
+
+
+class TestHistoryStore:
+    def test_round_trip(self, history, backend):
+        assert history.append(html_clip(backend, "first", 5)) == 0
+        assert history.append(html_clip(backend, "second", 6)) == 1
+        assert len(history) == 2
+        clip = history.load(1)
+        assert clip.seq_num == 6
+        assert [datum.format.id for datum in clip] == [13, 49443, 1]
+        assert all(datum.deferred_load for datum in clip)
+        assert clip == html_clip(backend, "second", 6)
+        assert history.seq_num(0) == 5
+        assert history.formats(0) == [13, 49443, 1]
+
+    def test_reopen(self, tmp_path, backend):
+        with cliphistory.HistoryStore(str(tmp_path), backend=backend) as store:
+            for i in range(10):
+                store.append(html_clip(backend, f"clip {i}", i))
+        with cliphistory.HistoryStore(str(tmp_path), preview_count=3, backend=backend) as store:
+            assert len(store) == 10
+            assert store.previews == {7: "clip 7", 8: "clip 8", 9: "clip 9"}
+            assert store.load(4).find(49443).data == b"<b>clip 4</b>"
+            store.append(html_clip(backend, "after", 10))
+            assert store.load(10).find(13).data == "after"
+
+    def test_kinds(self, history):
+        data = ["text", b"bytes", None, bytearray(b"frozen"), [1, 2]]
+        history.append(ch.Clip([ch.Datum(item, format_id)
+                                for item, format_id in zip(data, [13, 1, 7, 8, 17])]))
+        loaded = [datum.data for datum in history.load(0)]
+        assert loaded == data
+        assert type(loaded[3]) is bytes
+
+    def test_registered_ids_move(self, tmp_path, backend):
+        with cliphistory.HistoryStore(str(tmp_path), backend=backend) as store:
+            store.append(html_clip(backend, "html"))
+        # a later session where HTML Format got a different id
+        later = cb.MemoryBackend({0xC200: "HTML Format"})
+        with cliphistory.HistoryStore(str(tmp_path), backend=later) as store:
+            html = store.load(0).find(0xC200)
+            assert html.format.name == "HTML Format"
+            assert html.data == b"<b>html</b>"
+
+    def test_registered_ids_reused(self, tmp_path, backend):
+        with cliphistory.HistoryStore(str(tmp_path), backend=backend) as store:
+            store.append(html_clip(backend, "html"))
+        # a later session where HTML Format's old id went to PNG
+        later = cb.MemoryBackend({49443: "PNG", 0xC200: "HTML Format"})
+        with cliphistory.HistoryStore(str(tmp_path), backend=later) as store:
+            store.append(ch.Clip([ch.Datum(b"\x89PNG", ch.Format(49443, later))]))
+        with cliphistory.HistoryStore(str(tmp_path), backend=later) as store:
+            assert store.formats(0)[1].name == "HTML Format"
+            assert store.formats(1)[0].name == "PNG"
+            assert store.load(1)[0].data == b"\x89PNG"
+
+    def test_old_names_file(self, tmp_path, backend):
+        """Histories that stored registered ids as the clipboard gave them."""
+        with cliphistory.HistoryStore(str(tmp_path), backend=backend) as store:
+            store.append(html_clip(backend, "html"))
+        with open(tmp_path / "index.bin", "r+b") as index:
+            record = cliphistory.HistoryStore.RECORD
+            index.seek(record.size)
+            old = record.unpack(index.read(record.size))
+            index.seek(record.size)
+            index.write(record.pack(49443, *old[1:]))
+        with open(tmp_path / "formats.json", "w") as names:
+            names.write('{"49443": "HTML Format"}')
+        with cliphistory.HistoryStore(str(tmp_path), backend=backend) as store:
+            assert store.load(0).find(49443).data == b"<b>html</b>"
+            store.append(html_clip(backend, "again"))
+            assert store.formats(1) == [13, 49443, 1]
+
+    def test_segments(self, tmp_path, backend):
+        with cliphistory.HistoryStore(str(tmp_path), backend=backend, segment_size=64) as store:
+            for i in range(20):
+                store.append(html_clip(backend, f"clip {i}"))
+            assert [store.load(i).find(1).data for i in range(20)] == \
+                   [f"clip {i}".encode() for i in range(20)]
+        assert os.path.exists(os.path.join(str(tmp_path), "payloads-0001.seg"))
+        with cliphistory.HistoryStore(str(tmp_path), backend=backend, segment_size=64) as store:
+            store.append(html_clip(backend, "last"))
+            assert store.load(20).find(13).data == "last"
+            assert store.load(0).find(13).data == "clip 0"
+
+    def test_torn_write(self, tmp_path, backend):
+        with cliphistory.HistoryStore(str(tmp_path), backend=backend) as store:
+            store.append(html_clip(backend, "kept"))
+            store.append(html_clip(backend, "torn"))
+        # the second clip's entry was only partly written
+        with open(os.path.join(str(tmp_path), "entries.bin"), "r+b") as entries:
+            entries.truncate(cliphistory.HistoryStore.ENTRY.size + 5)
+        with cliphistory.HistoryStore(str(tmp_path), backend=backend) as store:
+            assert len(store) == 1
+            store.append(html_clip(backend, "replacement"))
+            assert store.load(1).find(13).data == "replacement"
+            assert store.load(0).find(13).data == "kept"
+
+    def test_preview(self, history):
+        history.append(ch.Clip([ch.Datum(b"bytes only", 1)]))
+        history.append(ch.Clip([ch.Datum(b"\x89PNG", 8), "x" * 500]))
+        history.append(ch.Clip())
+        assert history.preview(0) == "b'bytes only'"
+        assert history.preview(1) == "x" * history.PREVIEW_LENGTH
+        assert history.preview(2) == ""
+        with pytest.raises(IndexError):
+            history.preview(3)
+
+    def test_spilled(self, history, backend, tmp_path):
+        text = "spilled text \N{SNOWMAN} " * 200
+        backend.copy({13: text, 1: b"small"})
+        handler = ch.Handler(backend, spill_threshold=1000)
+        handler.spill_dir = str(tmp_path)
+        with handler:
+            clip = handler.read(lazy=False)
+        assert clip.find(13).spilled
+        history.append(clip)
+        loaded = history.load(0)
+        datum = loaded.find(13)
+        # still spilled, now straight out of the history segment
+        assert datum.spilled
+        assert str(datum.data, "utf-16-le") == text
+        assert loaded == clip
+        assert history.preview(0) == text[:history.PREVIEW_LENGTH]
+        assert datum.string_preview(20) == text[:20]
+        assert clipderive.derive(datum, "text") == text
+        assert clipsearch.SearchIndex.clip_text(loaded).startswith("spilled text \N{SNOWMAN}")
+
+    def test_stale_datum(self, history, backend):
+        backend.copy({13: "text", 1: b"text"})
+        handler = ch.Handler(backend)
+        with handler:
+            clip = handler.read()
+        clip.find(13).materialize()
+        backend.copy({13: "newer"})
+        history.append(clip)
+        assert [datum.data for datum in history.load(0)] == ["text", None]
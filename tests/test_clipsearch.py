@@ -0,0 +1,86 @@
+import pytest
+
+import clipbackend as cb
+import cliphandler as ch
+import clipsearch
+
+
+@pytest.fixture
+def index():
+    search_index = clipsearch.SearchIndex()
+    for key, text in enumerate([
+        "The quick brown fox",
+        "jumps over the lazy dog",
+        "def quicksort(items): return sorted(items)",
+        "Brown bread and butter",
+    ]):
+        search_index.add_text(key, text)
+    return search_index
+
+
+class TestSearchIndex:
+    def test_substring(self, index):
+        assert index.search("brown") == [3, 0]
+        assert index.search("ort(it") == [2]
+        assert index.search("QUICK") == [2, 0]
+        assert index.search("zebra") == []
+        assert index.search("") == []
+
+    def test_several_words(self, index):
+        assert index.search("the dog") == [1]
+        assert index.search("brown quick") == [0]
+
+    def test_short_words(self, index):
+        assert index.search("j") == [1]
+        assert index.search("ov la") == [1]
+
+    def test_prefix(self, index):
+        assert index.search("quick", prefix=True) == [2, 0]
+        assert index.search("uick", prefix=True) == []
+        assert index.search("uick") == [2, 0]
+        assert index.search("b", prefix=True) == [3, 0]
+        assert index.search("sorted(i", prefix=True) == [2]
+
+    def test_prefix_after_add(self, index):
+        assert index.search("brow", prefix=True) == [3, 0]
+        index.add_text(4, "browser tabs")
+        assert index.search("brow", prefix=True) == [4, 3, 0]
+
+    def test_limit(self, index):
+        for key in range(4, 100):
+            index.add_text(key, f"note {key}")
+        assert index.search("note", limit=3) == [99, 98, 97]
+        assert len(index.search("note", limit=None)) == 96
+
+    def test_remove(self, index):
+        index.remove(3)
+        assert index.search("brown") == [0]
+        assert len(index) == 3
+
+    def test_max_text(self, index):
+        index.add_text(4, "x" * index.MAX_TEXT + "needle")
+        assert index.search("needle") == []
+
+    def test_add_clip(self):
+        backend = cb.MemoryBackend({49443: "HTML Format"})
+        search_index = clipsearch.SearchIndex()
+        unicode_clip = ch.Clip(["unicode text", ch.Datum(b"cf_text", 1)])
+        byte_clip = ch.Clip([ch.Datum(b"<b>html</b>", ch.Format(49443, backend)),
+                             ch.Datum(b"caf\xe9 text", 1)])
+        assert search_index.add(unicode_clip)
+        assert search_index.add(byte_clip)
+        assert not search_index.add(ch.Clip([ch.Datum(b"\x89PNG", 8)]))
+        assert search_index.search("text") == [byte_clip, unicode_clip]
+        assert search_index.search("cf_text") == []
+        assert search_index.search("café") == [byte_clip]
+
+    def test_add_stale_clip(self, caplog):
+        backend = cb.MemoryBackend()
+        backend.copy({13: "copied text"})
+        with ch.Handler(backend) as handler:
+            clip = handler.read()
+        backend.copy({13: "something newer"})
+        search_index = clipsearch.SearchIndex()
+        assert not search_index.add(clip)
+        assert f"Clip {clip.seq_num} changed" in caplog.text
+        assert search_index.search("text") == []
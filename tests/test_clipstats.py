@@ -0,0 +1,68 @@
+import json
+import time
+import random
+
+import pytest
+
+from clipstats import Histogram, Metrics
+
+
+class TestHistogram:
+    def test_empty(self):
+        histogram = Histogram()
+        assert histogram.percentile(99) == 0
+        assert histogram.snapshot()["count"] == 0
+
+    def test_exact_small_values(self):
+        histogram = Histogram()
+        for value in range(1, 65):
+            histogram.record(value)
+        assert histogram.percentile(50) == 32
+        assert histogram.percentile(100) == 64
+        assert histogram.min == 1 and histogram.max == 64
+
+    @pytest.mark.parametrize("seed", range(3))
+    def test_precision(self, seed):
+        rng = random.Random(seed)
+        values = sorted(int(rng.lognormvariate(8, 2)) for _ in range(5000))
+        histogram = Histogram()
+        for value in values:
+            histogram.record(value)
+        for percent in (50, 90, 99):
+            exact = values[-(-len(values) * percent // 100) - 1]
+            assert exact <= histogram.percentile(percent) <= exact * 1.07 + 1
+        assert histogram.mean == pytest.approx(sum(values) / len(values))
+
+    def test_merge(self):
+        low, high = Histogram(), Histogram()
+        for value in range(100):
+            low.record(value)
+            high.record(value + 10000)
+        low.merge(high)
+        assert low.count == 200
+        assert low.min == 0 and low.max == 10099
+        assert low.percentile(25) < 100 <= 10000 <= low.percentile(75)
+
+
+class TestMetrics:
+    def test_count_and_time(self):
+        metrics = Metrics()
+        metrics.count("bytes_read", 10)
+        metrics.count("bytes_read", 5)
+        metrics.time("handler.read", time.perf_counter() - 0.001)
+        assert metrics.counter("bytes_read") == 15
+        assert metrics.counter("never counted") == 0
+        assert metrics.histogram("handler.read").min >= 1000
+        metrics.reset()
+        assert metrics.snapshot() == {"counters": {}, "histograms": {}}
+
+    def test_dump(self, tmp_path):
+        metrics = Metrics()
+        metrics.count("open_retries")
+        metrics.histogram("handler.seq").record(12)
+        path = tmp_path / "metrics.json"
+        metrics.dump(path)
+        dumped = json.loads(path.read_text())
+        assert dumped["counters"] == {"open_retries": 1}
+        assert dumped["histograms"]["handler.seq"]["p50"] == 12
+        assert dumped["time"] > 0
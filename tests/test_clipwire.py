@@ -0,0 +1,96 @@
+import mmap
+import pytest
+
+import clipbackend as cb
+import cliphandler as ch
+import clipwire
+
+
+@pytest.fixture
+def backend():
+    return cb.MemoryBackend({49443: "HTML Format"})
+
+
+def html_clip(backend, text, seq_num=1):
+    return ch.Clip([text, ch.Datum(f"<b>{text}</b>".encode(), ch.Format(49443, backend)),
+                    ch.Datum(text.encode(), 1)], seq_num=seq_num)
+
+
+class TestWire:
+    def test_round_trip(self, backend):
+        clip = html_clip(backend, "copied", 7)
+        decoded = clipwire.decode(clipwire.encode(clip), backend)
+        assert decoded.seq_num == 7
+        assert [datum.format.id for datum in decoded] == [13, 49443, 1]
+        assert decoded == clip
+
+    def test_kinds(self, backend):
+        data = ["text \ud800", b"bytes", None, bytearray(b"frozen"), [1, 2], b""]
+        clip = ch.Clip([ch.Datum(item, format_id)
+                        for item, format_id in zip(data, [13, 1, 7, 8, 17, 2])])
+        decoded = [datum.data for datum in clipwire.decode(clipwire.encode(clip), backend)]
+        assert decoded == data
+        assert decoded[2] is None
+
+    def test_aligned(self, backend):
+        message = clipwire.encode(ch.Clip(["a", b"bc", ch.Datum(b"def", 1)]))
+        assert len(message) % clipwire.ALIGNMENT == 0
+        header = clipwire.HEADER.unpack_from(message)
+        for number in range(header[5]):
+            offset = clipwire.RECORD.unpack_from(
+                message, clipwire.HEADER.size + number * clipwire.RECORD.size)[3]
+            assert offset % clipwire.ALIGNMENT == 0
+
+    def test_registered_ids_move(self, backend):
+        message = clipwire.encode(html_clip(backend, "html"))
+        # another process, where HTML Format got a different id
+        later = cb.MemoryBackend({0xC200: "HTML Format"})
+        html = clipwire.decode(message, later).find(0xC200)
+        assert html.format.name == "HTML Format"
+        assert html.data == b"<b>html</b>"
+
+    def test_zero_copy(self, backend, tmp_path):
+        path = tmp_path / "clips.bin"
+        messages = [clipwire.encode(html_clip(backend, f"clip {i}", i + 1)) for i in range(3)]
+        path.write_bytes(b"".join(messages))
+        with open(path, "rb") as file:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+        clips = []
+        while view:
+            clips.append(clipwire.decode(view, backend))
+            view = view[clipwire.message_size(view):]
+        assert [clip.find(1).data for clip in clips] == [b"clip 0", b"clip 1", b"clip 2"]
+        html = clips[2].find(49443)
+        assert html.view.obj is mapping
+        assert html.spilled
+
+        in_memory = clipwire.decode(messages[0], backend).find(1)
+        assert in_memory.view.obj is messages[0]
+        assert not in_memory.spilled
+        # a writable buffer could change under the Datum, so it's copied
+        copied = clipwire.decode(bytearray(messages[0]), backend).find(1)
+        assert type(copied.data) is bytes
+
+    def test_spilled_text(self, backend, tmp_path):
+        text = "spilled text \N{SNOWMAN} " * 50
+        spilled = ch.Datum(ch.spill([text.encode("utf-16-le")], str(tmp_path)), 13)
+        message = clipwire.encode(ch.Clip([spilled]))
+        kept = clipwire.decode(message, backend).find(13)
+        assert kept.view.obj is message
+        assert kept.string_preview(14) == "spilled text \N{SNOWMAN}"
+        # copied out of a writable buffer, it can't stay UTF-16
+        copied = clipwire.decode(bytearray(message), backend).find(13)
+        assert copied.data == text
+        assert copied.string_preview(14) == "spilled text \N{SNOWMAN}"
+
+    @pytest.mark.parametrize("mangle, message", [
+        (lambda m: m[:10], "too short"),
+        (lambda m: b"JUNK" + m[4:], "doesn't start"),
+        (lambda m: m[:4] + b"\x09\x00" + m[6:], "version 9"),
+        (lambda m: m[:-8], "truncated"),
+    ])
+    def test_bad_messages(self, backend, mangle, message):
+        good = clipwire.encode(html_clip(backend, "some text"))
+        with pytest.raises(clipwire.WireFormatError, match=message):
+            clipwire.decode(mangle(good), backend)